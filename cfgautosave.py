@@ -0,0 +1,261 @@
+# (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Journaled autosave of the running config, run by the resident cfgdbutil
+# server (cfgdbd --autosave).
+#
+# The running db is watched through the server's warm ops.dc idl. Once
+# its config columns change, the changes are coalesced for
+# AUTOSAVE_INTERVAL_MSEC, then the config is read from the replica,
+# diffed against the last saved one, and the differences are appended
+# to the journal of the startup config (see cfgdb.JOURNAL_TYPE) as one
+# row. Only the changes are encoded and written; the startup config is
+# rewritten whole (compacting the journal into it) when the journal
+# grows past AUTOSAVE_COMPACT_ROWS rows or half the size of the startup
+# config.
+#
+# The last saved config starts as the stored startup config and its
+# journal. Nothing is written before the running config changes, nor
+# while System:cur_cfg is unset: until cfgd has pushed the startup
+# config (at boot or after a db reset) the running config is not the
+# one to keep.
+
+import ovs.db.idl
+import ovs.timeval
+import ovs.vlog
+from ovs.db import error
+
+import cfgdb
+import cfgdbutil
+
+vlog = ovs.vlog.Vlog("cfgautosave")
+
+# Time changes are coalesced for before being written, and journal rows
+# written before the journal is compacted. They can be changed through
+# $CFGD_AUTOSAVE_INTERVAL_MSEC and $CFGD_AUTOSAVE_COMPACT_ROWS.
+AUTOSAVE_INTERVAL_MSEC = 5000
+AUTOSAVE_COMPACT_ROWS = 64
+
+
+def _is_set(datum):
+    '''
+    Returns True if datum holds something other than the default value of
+    its column (an empty set, or 0, "" or False).
+    '''
+    for key, value in datum.values.iteritems():
+        if key.value or (value is not None and value.value):
+            return True
+    return False
+
+
+class Autosave(object):
+    '''
+    Journaled autosave of the running config of an ops.dc idl (see the
+    comment at the top of this module), which must replicate
+    System:cur_cfg. run() and wait() are called from the main loop of
+    the process that keeps the idl in sync.
+    '''
+    def __init__(self, extschema, opsidl, interval_msec=None,
+                 compact_rows=None):
+        if interval_msec is None:
+            interval_msec = cfgdb.env_int("CFGD_AUTOSAVE_INTERVAL_MSEC",
+                                          AUTOSAVE_INTERVAL_MSEC)
+        if compact_rows is None:
+            compact_rows = cfgdb.env_int("CFGD_AUTOSAVE_COMPACT_ROWS",
+                                         AUTOSAVE_COMPACT_ROWS)
+
+        self.extschema = extschema
+        self.idl = opsidl
+        self.interval_msec = interval_msec
+        self.compact_rows = compact_rows
+
+        # Last saved config, and the startup config its journal applies
+        # to (its digest and date, None if there is none)
+        self.data = None
+        self.base = None
+        self.date = None
+        self.size = 0
+        self.seq = 0
+        self.journal_bytes = 0
+
+        # Time of the first change not saved yet (None if there is none)
+        self.dirty_msec = None
+
+        self._notify = opsidl.notify
+        opsidl.notify = self.notify
+
+    def notify(self, event, row, updates=None):
+        self._notify(event, row, updates)
+
+        if self.dirty_msec is not None:
+            return
+
+        ext_table = self.extschema.ovs_tables.get(row._table.name)
+        if ext_table is None:
+            return
+
+        if event == ovs.db.idl.ROW_UPDATE and updates is not None:
+            columns = updates._data.keys()
+        else:
+            # Rows inserted or deleted with only status and statistics
+            # (or default) values are not saved either
+            columns = [column for column, datum in row._data.iteritems()
+                       if _is_set(datum)]
+
+        # Status and statistics columns are not saved
+        for column in columns:
+            if column in ext_table.config or \
+               column in ext_table.references:
+                break
+        else:
+            return
+
+        self.dirty_msec = ovs.timeval.msec()
+
+    def start(self):
+        '''
+        Load the startup config and its journal as the last saved config.
+        If there is none (or it can not be read), the running config is
+        saved whole on its first change.
+        '''
+        self.dirty_msec = None
+        cfg = cfgdbutil.open_cfgdb(cfgdb.METADATA_COLUMNS)
+        try:
+            self.load(cfg)
+        except (ValueError, error.Error), e:
+            vlog.warn("Unable to read the startup config, it will be saved "
+                      "whole on the next change: %s" % e)
+            self.data = None
+        finally:
+            cfgdbutil.close_cfgdb(cfg)
+
+    def load(self, cfg):
+        '''
+        Load the startup config and its journal from the Cfgdb session cfg.
+        '''
+        row = cfg.find_row("startup")
+        if row is None:
+            self.data = None
+            return
+
+        config = cfg.read_config(row)
+        chunks = cfg.read_chunks(config)
+        data = dict(cfgdb.iter_config_tables(config, chunks=chunks))
+        # Measured like compact() does
+        size = len(cfgdb.serialize_config(data))
+
+        journal = cfg.read_configs(cfg.list_rows(cfgdb.JOURNAL_TYPE))
+        entries = cfgdb.journal_entries(config, journal)
+        for entry, entry_size in entries:
+            cfgdb.apply_config_changes(data, entry["changes"])
+
+        self.data = data
+        self.base = cfgdb.get_config_digest(config)
+        self.date = cfgdb.column_value(row.date)
+        self.size = size
+        self.seq = max([entry["seq"] for entry, _ in entries] or [0])
+        self.journal_bytes = sum(entry_size for _, entry_size in entries)
+
+    def pushed(self):
+        '''
+        Returns True if cfgd has pushed the startup config to the running
+        db (System:cur_cfg is set).
+        '''
+        for row in self.idl.tables["System"].rows.itervalues():
+            if row.cur_cfg:
+                return True
+        return False
+
+    def compact(self):
+        '''
+        Rewrite the startup config with the last saved config, dropping
+        its journal, along with its restore plan.
+        '''
+        raw = cfgdb.serialize_config(self.data)
+        digest = cfgdb.config_digest(raw)
+        date = cfgdb.current_date()
+
+        if not cfgdbutil.save_startup_config(self.data, raw, digest, date,
+                                             self.extschema, self.idl):
+            vlog.err("Unable to save the startup config")
+            return False
+
+        self.base = digest
+        self.date = date
+        self.size = len(raw)
+        self.seq = 0
+        self.journal_bytes = 0
+        vlog.dbg("Startup config saved, journal compacted")
+        return True
+
+    def save(self):
+        '''
+        Append the changes made to the running config since the last
+        save to the journal, compacting it if it got too large.
+        '''
+        import ops.dc
+
+        if not self.pushed():
+            # Keep the changes pending until cfgd is done
+            self.dirty_msec = ovs.timeval.msec()
+            return True
+
+        self.dirty_msec = None
+        data = ops.dc.read(self.extschema, self.idl)
+        if self.data is None or self.base is None:
+            # No startup config, or one saved without a digest that a
+            # journal could refer to
+            self.data = data
+            return self.compact()
+
+        changes = cfgdb.diff_config(self.data, data)
+        self.data = data
+        if not changes:
+            return True
+
+        cfg = cfgdbutil.open_cfgdb(cfgdb.METADATA_COLUMNS)
+        size = cfg.append_journal(self.base, self.date, self.seq + 1,
+                                  changes)
+        cfgdbutil.close_cfgdb(cfg)
+
+        if size is None:
+            # The startup config was saved (or deleted) by someone else
+            return self.compact()
+
+        self.seq += 1
+        self.journal_bytes += size
+        if (self.seq >= self.compact_rows or
+                self.journal_bytes * 2 >= self.size):
+            return self.compact()
+
+        return True
+
+    def run(self):
+        if self.dirty_msec is None:
+            return
+
+        if ovs.timeval.msec() >= self.dirty_msec + self.interval_msec:
+            self.save()
+
+    def wait(self, poller):
+        if self.dirty_msec is not None:
+            poller.timer_wait_until(self.dirty_msec + self.interval_msec)
+
+    def close(self):
+        '''
+        Save the pending changes and stop watching the idl.
+        '''
+        if self.dirty_msec is not None:
+            self.save()
+        self.idl.notify = self._notify
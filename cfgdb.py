@@ -14,11 +14,20 @@
 
 import os
 import sys
+import base64
+import hashlib
+import json
+import re
+import zlib
+from datetime import datetime
 
 import ovs.dirs
 from ovs.db import error
 from ovs.db import types
 import ovs.db.idl
+import ovs.jsonrpc
+import ovs.stream
+import ovs.timeval
 import ovs.vlog
 import ovs.poller
 
@@ -43,24 +52,723 @@ WRITER = "writer"
 DATE = "date"
 HARDWARE = "hardware"
 
+# Every column but the (possibly multi-MB) config blob. Sessions that only
+# look rows up or delete them register these, and read the blob on demand
+# with Cfgdb.read_config().
+METADATA_COLUMNS = [TYPE, NAME, WRITER, DATE, HARDWARE]
+ALL_COLUMNS = METADATA_COLUMNS + [CONFIG]
+
+# Checkpoints are rows of type "checkpoint", one per name. Saving one
+# evicts other checkpoints (in the same transaction) to stay within
+# checkpoint_max_count rows and checkpoint_max_bytes of config, counting
+# the chunks each one references in the chunked layout (0 means no
+# limit). Eviction picks the row with the oldest date first: with the
+# "oldest" policy date is the time the checkpoint was saved, with "lru"
+# restoring a checkpoint also refreshes it.
+CHECKPOINT_TYPE = "checkpoint"
+EVICT_OLDEST = "oldest"
+EVICT_LRU = "lru"
+EVICTION_POLICIES = [EVICT_OLDEST, EVICT_LRU]
+# The limits are read from $CFGD_CHECKPOINT_MAX_COUNT and
+# $CFGD_CHECKPOINT_MAX_BYTES on first use (see checkpoint_limits()).
+DEFAULT_CHECKPOINT_MAX_COUNT = 16
+DEFAULT_CHECKPOINT_MAX_BYTES = 0
+checkpoint_max_count = None
+checkpoint_max_bytes = None
+checkpoint_eviction = os.environ.get("CFGD_CHECKPOINT_EVICTION",
+                                     EVICT_OLDEST)
+
+# Format of the date column (sorts in time order)
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Storage format of the config column.
+# Legacy rows hold base64(json). Versioned rows hold
+#   "<CONFIG_MAGIC>1:<codec>:" + base64(compressed json)
+#   "<CONFIG_MAGIC>2:<codec>:<digest>:" + base64(compressed json)
+#   "<CONFIG_MAGIC>3:chunks:<digest>:" + comma separated chunk hashes
+# where digest is the sha256 of the canonical (key sorted) json, used to
+# skip saving a config identical to the stored one. The digest lives in
+# the header rather than in a column of its own as the configdb schema is
+# installed by ops-openvswitch; get_config_digest() reads it without
+# decoding the config.
+# The legacy base64 alphabet has no ':', so the formats never collide.
+CONFIG_MAGIC = "opscfg"
+CONFIG_FORMAT_VERSION = 2
+CONFIG_CODEC_ZLIB = "zlib"
+CONFIG_COMPRESS_LEVEL = 6
+
+# Version 3 is the chunked layout: each table of the config is stored
+# in a row of type "chunk" named after the digest of its content (the
+# chunk itself is a version 2 config holding that table only), and the
+# saved row lists its chunks. Saved rows share identical chunks. The
+# writer column of a chunk row lists the rows that use it (see
+# chunk_owners()), so chunks no longer used by any row are found and
+# deleted when rows are saved or deleted without reading their configs.
+CONFIG_CHUNKS_VERSION = 3
+CONFIG_CODEC_CHUNKS = "chunks"
+CHUNK_TYPE = "chunk"
+
+# The startup config can be followed by a journal: rows of type
+# "journal" named by sequence number, each holding (as a version 2
+# config) {"base": <digest>, "seq": <N>, "changes": [...]}, the changes
+# made to the config since the previous row (see diff_config()). Rows
+# only apply to the startup config with the digest in their base.
+# Saving the startup config deletes the journal in the same transaction.
+JOURNAL_TYPE = "journal"
+
+# The startup config can also come with a restore plan: a row of type
+# "plan" named "<version>:<schema fingerprint>:<startup config digest>"
+# (see plan_name()), holding as a version 2 config the operations cfgd
+# pushes the startup config with (see cfgrestore.compile_plan()). Saving
+# the startup config deletes the plan in the same transaction, the new
+# plan is written right after.
+PLAN_TYPE = "plan"
+# Bump when the format of the restore plans changes
+PLAN_VERSION = 2
+
+# Max time to wait for the session to see the rows written by a
+# transaction sent on a separate connection
+UPDATE_WAIT_MSEC = 2000
+
+# Lock an idl session takes and releases to catch up with the db (see
+# sync_idl()). No other client takes it.
+SYNC_LOCK = "cfgdb_sync_%d"
+
+# Layout used when saving configs
+LAYOUT_BLOB = "blob"
+LAYOUT_CHUNKS = "chunks"
+CONFIG_LAYOUTS = [LAYOUT_BLOB, LAYOUT_CHUNKS]
+config_layout = os.environ.get("CFGD_CONFIG_LAYOUT", LAYOUT_BLOB)
+
+
+# Size of the base64 chunks handled at a time by iter_config_tables()
+CONFIG_DECODE_CHUNK = 64 * 1024
+
+# Tokens that matter when splitting the top level json object: strings
+# (skipped whole), a lone quote (string not complete yet), brackets and
+# member separators.
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\],]')
+
+
+def env_int(name, default):
+    '''
+    Returns the integer value of the environment variable name, or default
+    if it is unset or not an integer (with a warning, so a bad value does
+    not keep the daemons from starting).
+    '''
+    value = os.environ.get(name)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        vlog.warn("Ignoring %s=\"%s\", not an integer, using %d"
+                  % (name, value, default))
+        return default
+
+
+def checkpoint_limits():
+    '''
+    Returns the default (max count, max bytes) of the checkpoints.
+    '''
+    global checkpoint_max_count
+    global checkpoint_max_bytes
+
+    if checkpoint_max_count is None:
+        checkpoint_max_count = env_int("CFGD_CHECKPOINT_MAX_COUNT",
+                                       DEFAULT_CHECKPOINT_MAX_COUNT)
+    if checkpoint_max_bytes is None:
+        checkpoint_max_bytes = env_int("CFGD_CHECKPOINT_MAX_BYTES",
+                                       DEFAULT_CHECKPOINT_MAX_BYTES)
+
+    return checkpoint_max_count, checkpoint_max_bytes
+
+
+def serialize_config(data):
+    '''
+    Canonical (key sorted, compact) json serialization of a config.
+    '''
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+
+def config_digest(raw):
+    '''
+    Digest of a serialized config, as stored in the config column header.
+    '''
+    return hashlib.sha256(raw).hexdigest()
+
+
+def encode_config(data=None, raw=None, digest=None):
+    '''
+    Encode a config object (or its serialize_config() output in raw, and
+    optionally its digest) into the current storage format of the config
+    column.
+    '''
+    if raw is None:
+        raw = serialize_config(data)
+    if digest is None:
+        digest = config_digest(raw)
+    payload = base64.b64encode(zlib.compress(raw, CONFIG_COMPRESS_LEVEL))
+
+    return "%s%d:%s:%s:%s" % (CONFIG_MAGIC, CONFIG_FORMAT_VERSION,
+                              CONFIG_CODEC_ZLIB, digest, payload)
+
+
+def split_config(data):
+    '''
+    Split a config object into one chunk per table for the chunked
+    layout. Returns the config column listing the chunks and a dict of
+    chunk hash to chunk.
+    '''
+    chunks = {}
+    hashes = []
+    # The canonical json of the whole config is the members of the table
+    # chunks joined, so its digest is computed without serializing it.
+    digest = hashlib.sha256("{")
+    for table in sorted(data):
+        raw = serialize_config({table: data[table]})
+        chunk_hash = config_digest(raw)
+        chunks[chunk_hash] = encode_config(raw=raw, digest=chunk_hash)
+        if hashes:
+            digest.update(",")
+        digest.update(raw[1:-1])
+        hashes.append(chunk_hash)
+    digest.update("}")
+
+    config = "%s%d:%s:%s:%s" % (CONFIG_MAGIC, CONFIG_CHUNKS_VERSION,
+                                CONFIG_CODEC_CHUNKS, digest.hexdigest(),
+                                ",".join(hashes))
+    return config, chunks
+
+
+def _parse_config_header(config):
+    '''
+    Returns (codec, digest, offset of the base64 payload) for a config
+    column. codec and digest are None for the legacy format, digest is
+    None for version 1.
+    '''
+    if not config.startswith(CONFIG_MAGIC):
+        return None, None, 0
+
+    version_end = config.find(":", len(CONFIG_MAGIC))
+    codec_end = config.find(":", version_end + 1)
+    if version_end < 0 or codec_end < 0:
+        raise ValueError("Malformed config header")
+
+    version = config[len(CONFIG_MAGIC):version_end]
+    codec = config[version_end + 1:codec_end]
+
+    if version not in ("1", "2", "3"):
+        raise ValueError("Unsupported config format version %s" % version)
+
+    if codec != (CONFIG_CODEC_CHUNKS if version == "3" else
+                 CONFIG_CODEC_ZLIB):
+        raise ValueError("Unsupported config codec %s" % codec)
+
+    if version == "1":
+        return codec, None, codec_end + 1
+
+    digest_end = config.find(":", codec_end + 1)
+    if digest_end < 0:
+        raise ValueError("Malformed config header")
+
+    return codec, config[codec_end + 1:digest_end], digest_end + 1
+
+
+def get_config_digest(config):
+    '''
+    Returns the digest stored in the header of a config column, or None
+    if it has none (legacy or version 1 format).
+    '''
+    try:
+        return _parse_config_header(config)[1]
+    except ValueError:
+        return None
+
+
+def config_chunk_hashes(config):
+    '''
+    Returns the hashes of the chunks of a config column in the chunked
+    layout (see split_config()), or None for the other formats.
+    '''
+    codec, unused, offset = _parse_config_header(config)
+    if codec != CONFIG_CODEC_CHUNKS:
+        return None
+
+    payload = config[offset:]
+    return payload.split(",") if payload else []
+
+
+def decode_config(config, chunks=None):
+    '''
+    Deserialize the content of a config column, in either the versioned
+    format written by encode_config() or split_config() or the legacy
+    base64 json format. Chunked configs are read from chunks, a dict of
+    chunk hash to chunk.
+
+    Raises ValueError if the content can not be decoded.
+    '''
+    codec, unused, offset = _parse_config_header(config)
+    if codec == CONFIG_CODEC_CHUNKS:
+        return dict(iter_config_tables(config, chunks=chunks))
+    if codec is None:
+        return json.loads(base64.b64decode(config))
+
+    try:
+        raw = zlib.decompress(base64.b64decode(config[offset:]))
+    except (TypeError, zlib.error), e:
+        raise ValueError("Corrupted config payload: %s" % e)
+
+    return json.loads(raw)
+
+
+def _iter_config_text(config, chunk_size):
+    '''
+    Yield the json text of a config column a piece at a time, decoding
+    (and decompressing) one base64 chunk per step.
+    '''
+    codec, unused, offset = _parse_config_header(config)
+    if codec == CONFIG_CODEC_CHUNKS:
+        raise ValueError("Config chunk is itself chunked")
+    decompressor = None
+    if codec == CONFIG_CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+
+    # Keep chunks aligned on base64 quanta
+    chunk_size = max(4, chunk_size - chunk_size % 4)
+
+    try:
+        for pos in xrange(offset, len(config), chunk_size):
+            text = base64.b64decode(config[pos:pos + chunk_size])
+            if decompressor is not None:
+                text = decompressor.decompress(text)
+            if text:
+                yield text
+        if decompressor is not None:
+            text = decompressor.flush()
+            if text:
+                yield text
+    except (TypeError, zlib.error), e:
+        raise ValueError("Corrupted config payload: %s" % e)
+
+
+def iter_config_tables(config, chunk_size=CONFIG_DECODE_CHUNK, chunks=None):
+    '''
+    Incrementally decode a config column, yielding (table, value) pairs
+    one top level table at a time.
+
+    Only the raw column, one chunk of decoded text and the table being
+    parsed are held in memory, never the whole decoded document.
+    Chunked configs are read from chunks, a dict of chunk hash to chunk.
+
+    Raises ValueError if the content can not be decoded.
+    '''
+    hashes = config_chunk_hashes(config)
+    if hashes is None:
+        for item in _iter_blob_tables(config, chunk_size):
+            yield item
+        return
+
+    if chunks is None:
+        raise ValueError("Chunked config read without its chunks")
+    for chunk_hash in hashes:
+        chunk = chunks.get(chunk_hash)
+        if chunk is None:
+            raise ValueError("Missing config chunk %s" % chunk_hash)
+        for item in _iter_blob_tables(chunk, chunk_size):
+            yield item
+
+
+def _iter_blob_tables(config, chunk_size):
+    buf = ""
+    pos = 0
+    depth = 0
+    done = False
+
+    for text in _iter_config_text(config, chunk_size):
+        buf += text
+        while not done:
+            m = _JSON_TOKEN.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+
+            token = m.group()
+            if token == '"':
+                # String split across chunks, wait for the rest of it
+                pos = m.start()
+                break
+            pos = m.end()
+            if token[0] == '"':
+                continue
+
+            if token in "{[":
+                depth += 1
+                if depth == 1:
+                    if token != "{" or buf[:m.start()].strip():
+                        raise ValueError("Config is not a json object")
+                    buf = buf[pos:]
+                    pos = 0
+                continue
+
+            if token in "}]":
+                depth -= 1
+                if depth < 0:
+                    raise ValueError("Unbalanced config object")
+            if depth > 1 or (depth == 1 and token != ","):
+                continue
+
+            # End of a top level member
+            member = buf[:m.start()]
+            buf = buf[pos:]
+            pos = 0
+            if depth == 0:
+                done = True
+            if member.strip():
+                for item in json.loads("{%s}" % member).iteritems():
+                    yield item
+
+        if done and buf.strip():
+            raise ValueError("Extra data after config object")
+
+    if not done:
+        raise ValueError("Truncated config object")
+
+
+def transact(remote, db_name, operations):
+    '''
+    Run operations in one transaction on db_name, on a new connection to
+    the db server at remote, without an idl. Returns the results of the
+    operations.
+
+    Raises error.Error if the transaction fails.
+    '''
+    err, stream = ovs.stream.Stream.open_block(
+        ovs.stream.Stream.open(remote))
+    if err:
+        raise error.Error("Unable to connect to %s: %s"
+                          % (remote, os.strerror(err)))
+
+    conn = ovs.jsonrpc.Connection(stream)
+    request = ovs.jsonrpc.Message.create_request(
+        "transact", [db_name] + operations)
+    err, reply = conn.transact_block(request)
+    conn.close()
+
+    if err:
+        raise error.Error("%s transaction failed: %s"
+                          % (db_name, os.strerror(err)))
+    if reply.error is not None:
+        raise error.Error("%s transaction failed" % db_name, reply.error)
+    for result in reply.result:
+        if not isinstance(result, dict) or "error" in result:
+            raise error.Error("%s transaction failed" % db_name,
+                              reply.result)
+
+    return reply.result
+
+
+def _uuid_condition(row):
+    return ["_uuid", "==", ["uuid", str(row.uuid)]]
+
+
+def select_configs(remote, db_name, rows):
+    '''
+    Returns the config columns of rows (of an idl on db_name at remote
+    that does not replicate them), read with one transaction.
+
+    Raises error.Error if the transaction fails or a row is gone.
+    '''
+    if not rows:
+        return []
+
+    selects = [{"op": "select",
+                "table": CONFIG_TABLE,
+                "where": [_uuid_condition(row)],
+                "columns": [CONFIG]} for row in rows]
+    configs = []
+    for row, result in zip(rows, transact(remote, db_name, selects)):
+        if not result["rows"]:
+            raise error.Error("%s row %s no longer exists"
+                              % (CONFIG_TABLE, row.uuid))
+        value = result["rows"][0][CONFIG]
+        # An empty optional column comes back as an empty set
+        if isinstance(value, list):
+            value = value[1][0] if value[1] else None
+        configs.append(value)
+
+    return configs
+
+
+def current_date():
+    '''
+    The current time in the format of the date column.
+    '''
+    return datetime.utcnow().strftime(DATE_FORMAT)
+
+
+def column_value(value):
+    '''
+    An optional column as a plain value (None when unset).
+    '''
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+
+def row_key(row):
+    '''
+    The (type, name) of a config row, name being None when unset.
+    '''
+    return (row.type, column_value(row.name))
+
+
+def chunk_owners(row):
+    '''
+    Returns the keys (see row_key()) of the rows using a chunk row, as
+    listed in its writer column, or None for a chunk saved before they
+    were listed.
+    '''
+    value = column_value(row.writer)
+    if not value:
+        return None
+
+    try:
+        return set((cfgtype, name) for cfgtype, name in json.loads(value))
+    except (ValueError, TypeError):
+        return None
+
+
+def encode_chunk_owners(owners):
+    '''
+    The writer column of a chunk row used by the rows with keys owners.
+    '''
+    return json.dumps(sorted([cfgtype, name] for cfgtype, name in owners))
+
+
+def diff_config(old, new, path=None):
+    '''
+    Returns the changes turning config old into new, as a list of
+    ["set", path, value] and ["delete", path] where path is the list of
+    keys leading to the value. Objects are compared member by member,
+    anything else is replaced whole.
+    '''
+    if path is None:
+        path = []
+
+    changes = []
+    for key, value in new.iteritems():
+        old_value = old.get(key)
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            changes.extend(diff_config(old_value, value, path + [key]))
+        elif key not in old or old_value != value:
+            changes.append(["set", path + [key], value])
+
+    for key in old:
+        if key not in new:
+            changes.append(["delete", path + [key]])
+
+    return changes
+
+
+def apply_config_changes(data, changes):
+    '''
+    Apply changes from diff_config() to config data, in place.
+    '''
+    for change in changes:
+        path = change[1]
+        parent = data
+        for key in path[:-1]:
+            child = parent.get(key)
+            if not isinstance(child, dict):
+                child = parent[key] = {}
+            parent = child
+
+        if change[0] == "set":
+            parent[path[-1]] = change[2]
+        else:
+            parent.pop(path[-1], None)
+
+
+def plan_name(fingerprint, digest):
+    '''
+    Name of the plan row of a restore plan for the schemas with the given
+    fingerprint and the startup config with the given digest.
+    '''
+    return "%d:%s:%s" % (PLAN_VERSION, fingerprint, digest)
+
+
+def _plan_row(name, plan):
+    '''
+    The columns of the plan row of a restore plan named name.
+    '''
+    return {TYPE: PLAN_TYPE, NAME: name, CONFIG: encode_config(plan)}
+
+
+def journal_entries(config, journal):
+    '''
+    Returns the journal rows (their config columns, in any order) that
+    apply to the config column config, decoded, in journal order, as
+    (entry, size of the row's config column) pairs.
+
+    Raises ValueError if a journal row can not be decoded.
+    '''
+    base = get_config_digest(config)
+    if base is None:
+        return []
+
+    entries = [(decode_config(entry), len(entry)) for entry in journal]
+    entries = [(entry, size) for entry, size in entries
+               if entry.get("base") == base]
+    entries.sort(key=lambda item: item[0]["seq"])
+    return entries
+
+
+def journal_changes(config, journal):
+    '''
+    Returns the changes of the journal rows (their config columns, in
+    any order) that apply to the config column config, in journal order.
+
+    Raises ValueError if a journal row can not be decoded.
+    '''
+    changes = []
+    for entry, size in journal_entries(config, journal):
+        changes.extend(entry["changes"])
+    return changes
+
+
+def sync_idl(idl, timeout_msec=UPDATE_WAIT_MSEC):
+    '''
+    Run idl until it has the changes of all the transactions committed
+    to its db before the call, for a session that was left idle. The db
+    server sends a client the updates it has pending before it reads its
+    next request, so once the reply to a request sent on the session is
+    in, so are the updates. The request is a lock on SYNC_LOCK, whose
+    reply the idl tracks (has_lock), released right after.
+
+    Returns False if the reply did not come in timeout_msec (the session
+    is not connected, for instance).
+    '''
+    idl.set_lock(SYNC_LOCK % os.getpid())
+    deadline = ovs.timeval.msec() + timeout_msec
+    try:
+        while True:
+            idl.run()
+            if idl.has_lock or idl.is_lock_contended:
+                return True
+            if ovs.timeval.msec() >= deadline:
+                return False
+            poller = ovs.poller.Poller()
+            idl.wait(poller)
+            poller.timer_wait_until(deadline)
+            poller.block()
+    finally:
+        idl.set_lock(None)
+
+
+class IndexedIdl(ovs.db.idl.Idl):
+    '''
+    Idl on the configdb that keeps the config table rows indexed by type
+    and by (type, name). The index is updated from the idl row change
+    notifications, and rebuilt only when the idl drops its replica (on
+    reconnection).
+    '''
+    def __init__(self, remote, schema_helper):
+        super(IndexedIdl, self).__init__(remote, schema_helper)
+        self._rows_by_key = {}
+        self._rows_by_type = {}
+        self._keys = {}
+        self._indexed_rows = self.tables[CONFIG_TABLE].rows
+
+    def notify(self, event, row, updates=None):
+        if self.tables[CONFIG_TABLE].rows is not self._indexed_rows:
+            # Replica dropped, the index is rebuilt on next use
+            return
+
+        self.__remove(row.uuid)
+        if event != ovs.db.idl.ROW_DELETE:
+            self.__add(row)
+
+    def __add(self, row):
+        key = (row.type, column_value(row.name))
+        self._keys[row.uuid] = key
+        self._rows_by_key.setdefault(key, {})[row.uuid] = row
+        self._rows_by_type.setdefault(key[0], {})[row.uuid] = row
+
+    def __remove(self, uuid):
+        key = self._keys.pop(uuid, None)
+        if key is None:
+            return
+
+        for index, index_key in [(self._rows_by_key, key),
+                                 (self._rows_by_type, key[0])]:
+            rows = index[index_key]
+            del rows[uuid]
+            if not rows:
+                del index[index_key]
+
+    def __check_index(self):
+        rows = self.tables[CONFIG_TABLE].rows
+        if rows is self._indexed_rows:
+            return
+
+        self._rows_by_key = {}
+        self._rows_by_type = {}
+        self._keys = {}
+        self._indexed_rows = rows
+        for row in rows.itervalues():
+            self.__add(row)
+
+    def lookup(self, cfgtype, name=None):
+        '''
+        Returns the row with type cfgtype and the given name (any row of
+        that type if name is None), or None if there is none.
+        '''
+        self.__check_index()
+        if name is None:
+            rows = self._rows_by_type.get(cfgtype)
+        else:
+            rows = self._rows_by_key.get((cfgtype, name))
+
+        if not rows:
+            return None
+        return next(rows.itervalues())
+
+    def rows_of_type(self, cfgtype=None):
+        '''
+        Returns the rows with type cfgtype (all rows if None).
+        '''
+        self.__check_index()
+        if cfgtype is None:
+            return self._indexed_rows.values()
+        return self._rows_by_type.get(cfgtype, {}).values()
+
 
 class Cfgdb(object):
-    def __init__(self, location=None):
+    def __init__(self, location=None, columns=None):
         '''
-        Creates a Idl connection to the configdb and register all the columns
-        with schema helper.
+        Creates a Idl connection to the configdb and register the columns
+        (all of them by default, the type and name columns are always
+        registered) with schema helper. Only the registered columns are replicated, so
+        sessions that don't need the config blob should pass
+        METADATA_COLUMNS.
 
         Maintain the self global value for all the columns in configdb that
         can be modified and updated to existing row or inserted as new row.
         '''
+        if columns is None:
+            columns = ALL_COLUMNS
+
         self.idl = None
         self.txn = None
+        self.columns = [TYPE, NAME] + [col for col in columns
+                                       if col not in [TYPE, NAME]]
         self.schema_helper = ovs.db.idl.SchemaHelper(location=cfgdb_schema)
-        self.schema_helper.register_columns(CONFIG_TABLE,
-                                            [TYPE, NAME, WRITER,
-                                             DATE, CONFIG, HARDWARE])
+        self.db_name = self.schema_helper.schema_json["name"]
+        self.schema_helper.register_columns(CONFIG_TABLE, self.columns)
 
-        self.idl = ovs.db.idl.Idl(def_db, self.schema_helper)
+        self.idl = IndexedIdl(def_db, self.schema_helper)
 
         self.config = None
         self.type = "startup"
@@ -80,29 +788,282 @@ class Cfgdb(object):
 
     def find_row_by_type(self, cfgtype):
         '''
-        Walk through the rows in the config table (if any)
-        looking for a row with type parsed in argument
+        Look up a row with type parsed in argument in the config
+        table (if any)
 
         If row found set variable tbl_found to True and return
         the row object to caller function
         '''
-        tbl_found = False
-        ovs_rec = None
-        for ovs_rec in self.idl.tables[CONFIG_TABLE].rows.itervalues():
-            if ovs_rec.type == cfgtype:
-                tbl_found = True
+        ovs_rec = self.idl.lookup(cfgtype)
+
+        return ovs_rec, ovs_rec is not None
+
+    def find_row(self, cfgtype, name=None):
+        '''
+        Returns the row with the given type and name (any row of the
+        type if name is None), or None if there is no such row.
+        '''
+        return self.idl.lookup(cfgtype, name)
+
+    def list_rows(self, cfgtype=None):
+        '''
+        Returns the rows of the given type (all rows if None), sorted
+        by name.
+        '''
+        return sorted(self.idl.rows_of_type(cfgtype),
+                      key=lambda row: column_value(row.name))
+
+    def read_config(self, row):
+        '''
+        Returns the config column of row. If this session does not
+        replicate it, it is fetched from the configdb now.
+        '''
+        return self.read_configs([row])[0]
+
+    def read_configs(self, rows):
+        '''
+        Returns the config columns of rows. If this session does not
+        replicate them, they are fetched with a single transaction.
+        '''
+        if CONFIG in self.columns:
+            return [column_value(row.config) for row in rows]
+
+        return select_configs(def_db, self.db_name, rows)
+
+    def read_chunks(self, config):
+        '''
+        Returns the chunks of a config column in the chunked layout, as a
+        dict of chunk hash to chunk (empty for the other formats).
+
+        Raises ValueError if a chunk is missing.
+        '''
+        hashes = config_chunk_hashes(config)
+        if not hashes:
+            return {}
+
+        rows = []
+        for chunk_hash in set(hashes):
+            row = self.find_row(CHUNK_TYPE, chunk_hash)
+            if row is None:
+                raise ValueError("Missing config chunk %s" % chunk_hash)
+            rows.append(row)
+
+        return dict(zip([column_value(row.name) for row in rows],
+                        self.read_configs(rows)))
+
+    def iter_config(self, row):
+        '''
+        Incrementally decode the config of a row (see iter_config_tables()),
+        in any layout. The journal of the startup config is applied to
+        it, in which case it is decoded whole first.
+        '''
+        config = self.read_config(row)
+        tables = iter_config_tables(config, chunks=self.read_chunks(config))
+
+        journal = self.list_rows(JOURNAL_TYPE)
+        if row.type != "startup" or not journal:
+            return tables
+
+        changes = journal_changes(config, self.read_configs(journal))
+        if not changes:
+            return tables
+
+        data = dict(tables)
+        apply_config_changes(data, changes)
+        return iter(sorted(data.iteritems()))
+
+    def __transact(self, operations):
+        '''
+        Run operations in one transaction on a separate connection to the
+        configdb, for columns this session does not replicate and for
+        bulk writes. Returns the results of the operations.
+        '''
+        return transact(def_db, self.db_name, operations)
+
+    def __wait_for_update(self):
+        '''
+        Wait (for a bounded time) for the idl to see a change, after a
+        transaction sent by __transact().
+        '''
+        curr_seqno = self.idl.change_seqno
+        deadline = ovs.timeval.msec() + UPDATE_WAIT_MSEC
+        while True:
+            self.idl.run()
+            if (curr_seqno != self.idl.change_seqno or
+                    ovs.timeval.msec() >= deadline):
                 break
+            poller = ovs.poller.Poller()
+            self.idl.wait(poller)
+            poller.timer_wait_until(deadline)
+            poller.block()
+
+    def __listed_chunks(self, dropped_rows):
+        '''
+        Returns chunk hash -> keys of the saved rows (but dropped_rows)
+        listing the chunk, read from their configs.
+        '''
+        dropped = set(row.uuid for row in dropped_rows)
+        saved = [row for row in self.idl.rows_of_type()
+                 if row.type not in [CHUNK_TYPE, JOURNAL_TYPE, PLAN_TYPE] and
+                 row.uuid not in dropped]
+
+        listed = {}
+        for row, config in zip(saved, self.read_configs(saved)):
+            try:
+                hashes = config_chunk_hashes(config or "") or []
+            except ValueError:
+                continue
+            for chunk_hash in hashes:
+                listed.setdefault(chunk_hash, set()).add(row_key(row))
+        return listed
 
-        return ovs_rec, tbl_found
+    def chunk_changes(self, dropped_rows, owner=None, hashes=()):
+        '''
+        Returns the chunk rows to delete, and chunk row -> owners (see
+        chunk_owners()) for the chunk rows whose owners change, once
+        dropped_rows are deleted or rewritten and the row with key owner,
+        if given, is saved with the chunks in hashes.
+
+        Only the owners of the chunks the dropped rows used change, and no
+        config is read, but for chunks saved before their owners were
+        listed: those get their owners from the configs of the saved
+        rows.
+        '''
+        chunk_rows = self.idl.rows_of_type(CHUNK_TYPE)
+        if not chunk_rows:
+            return [], {}
+
+        dropped = set(row_key(row) for row in dropped_rows)
+        hashes = set(hashes)
+        listed = None
+
+        deleted = []
+        updated = {}
+        for row in chunk_rows:
+            chunk_hash = column_value(row.name)
+            owners = chunk_owners(row)
+            if owners is None:
+                if listed is None:
+                    listed = self.__listed_chunks(dropped_rows)
+                new_owners = set(listed.get(chunk_hash, ()))
+            else:
+                new_owners = owners - dropped
+            if owner is not None and chunk_hash in hashes:
+                new_owners.add(owner)
+
+            if not new_owners:
+                deleted.append(row)
+            elif new_owners != owners:
+                updated[row] = new_owners
+        return deleted, updated
+
+    def __release_chunks(self, dropped_rows):
+        '''
+        In the current idl transaction, delete the chunks only used by
+        dropped_rows and drop them from the owners of the others.
+        '''
+        deleted, updated = self.chunk_changes(dropped_rows)
+        for chunk_row in deleted:
+            chunk_row.delete()
+        for chunk_row, owners in updated.iteritems():
+            setattr(chunk_row, WRITER, encode_chunk_owners(owners))
+
+    def write_chunked(self, cfgtype, name, data, evict=None, deleted_rows=(),
+                      plan=None):
+        '''
+        Save a config object in the chunked layout (see split_config()) as
+        the row with the given type and name, with the other user values.
+        Only the chunks that are not stored yet are written.
+
+        evict(size), if given, returns rows to delete in the same
+        transaction (see checkpoint_evictions()), or None if a config of
+        size bytes, its chunks included, can not be saved (nothing is
+        written then and the status is "Invalid"). Chunks left unreferenced
+        and deleted_rows are deleted in it too, and plan, a (name, restore
+        plan) pair if given, is inserted as the plan row. The transaction
+        is sent on a separate connection so the session does not need to
+        replicate the config column.
+
+        Returns the status and the list of names of the evicted rows.
+        '''
+        config, chunks = split_config(data)
+        row = self.find_row(cfgtype, name)
+        evicted = []
+        if evict is not None:
+            evicted = evict(len(config) + sum(len(chunk) for chunk
+                                              in chunks.itervalues()))
+            if evicted is None:
+                return "Invalid", []
+
+        values = {TYPE: cfgtype, CONFIG: config}
+        for column, value in [(NAME, name), (WRITER, self.writer),
+                              (DATE, self.date), (HARDWARE, self.hardware)]:
+            if value is not None:
+                values[column] = value
+
+        owner = (cfgtype, name)
+        operations = []
+        for chunk_hash in sorted(chunks):
+            if self.find_row(CHUNK_TYPE, chunk_hash) is None:
+                operations.append({"op": "insert",
+                                   "table": CONFIG_TABLE,
+                                   "row": {TYPE: CHUNK_TYPE,
+                                           NAME: chunk_hash,
+                                           WRITER: encode_chunk_owners(
+                                               [owner]),
+                                           CONFIG: chunks[chunk_hash]}})
+
+        if row is None:
+            operations.append({"op": "insert",
+                               "table": CONFIG_TABLE,
+                               "row": values})
+            dropped = evicted
+        else:
+            operations.append({"op": "update",
+                               "table": CONFIG_TABLE,
+                               "where": [_uuid_condition(row)],
+                               "row": values})
+            dropped = evicted + [row]
+
+        dropped += list(deleted_rows)
+        deleted_chunks, updated_chunks = self.chunk_changes(dropped, owner,
+                                                            chunks)
+        for chunk_row, owners in sorted(updated_chunks.iteritems(),
+                                        key=lambda item: item[0].uuid):
+            operations.append({"op": "update",
+                               "table": CONFIG_TABLE,
+                               "where": [_uuid_condition(chunk_row)],
+                               "row": {WRITER: encode_chunk_owners(owners)}})
+        for deleted_row in evicted + list(deleted_rows) + deleted_chunks:
+            operations.append({"op": "delete",
+                               "table": CONFIG_TABLE,
+                               "where": [_uuid_condition(deleted_row)]})
+        if plan is not None:
+            operations.append({"op": "insert",
+                               "table": CONFIG_TABLE,
+                               "row": _plan_row(*plan)})
+
+        evicted_names = [column_value(evicted_row.name)
+                         for evicted_row in evicted]
+        try:
+            self.__transact(operations)
+        except error.Error, e:
+            vlog.err("Unable to save %s config: %s" % (cfgtype, e))
+            return ovs.db.idl.Transaction.ERROR, []
+
+        self.__wait_for_update()
+
+        return ovs.db.idl.Transaction.SUCCESS, evicted_names
 
     def __set_column_value(self, row):
         status = "Invalid"
 
         if self.config is not None:
+            if CONFIG not in self.columns:
+                return status
             setattr(row, CONFIG, self.config)
 
-        #Currently only "startup" type is supported
-        if self.type is not "startup":
+        if not self.type:
             return status
         else:
             setattr(row, TYPE, self.type)
@@ -122,11 +1083,13 @@ class Cfgdb(object):
 
         return status
 
-    def insert_row(self):
+    def insert_row(self, deleted_rows=(), plan=None):
         '''
         Insert a new row in configdb and update the columns with
         user values (default values are taken if columns values
-        not given by user) in global variables.
+        not given by user) in global variables. deleted_rows are
+        deleted in the same transaction, and plan, a (name, restore
+        plan) pair if given, is inserted as the plan row.
         '''
         self.txn = ovs.db.idl.Transaction(self.idl)
         row = self.txn.insert(self.idl.tables[CONFIG_TABLE])
@@ -136,45 +1099,301 @@ class Cfgdb(object):
         if (status is not "success"):
             return None, status
         else:
+            for deleted_row in deleted_rows:
+                deleted_row.delete()
+            if plan is not None:
+                self.__insert_plan(*plan)
             status = self.txn.commit_block()
 
         return row, status
 
-    def update_row(self, row):
+    def update_row(self, row, deleted_rows=(), plan=None):
         '''
-        Update the row with the latest modified values.
+        Update the row with the latest modified values, deleting
+        deleted_rows and inserting plan, a (name, restore plan) pair if
+        given, as the plan row in the same transaction.
         '''
         self.txn = ovs.db.idl.Transaction(self.idl)
+        if self.config is not None and CONFIG in self.columns:
+            # Release the chunks the row had in the chunked layout, before
+            # its type and name change
+            self.__release_chunks([row])
 
         status = self.__set_column_value(row)
 
         if (status is not "success"):
             return None, status
         else:
+            for deleted_row in deleted_rows:
+                deleted_row.delete()
+            if plan is not None:
+                self.__insert_plan(*plan)
             status = self.txn.commit_block()
 
         return row, status
 
+    def __insert_plan(self, name, plan):
+        '''
+        Insert the plan row of a restore plan in the current idl
+        transaction.
+        '''
+        plan_row = self.txn.insert(self.idl.tables[CONFIG_TABLE])
+        for column, value in _plan_row(name, plan).iteritems():
+            setattr(plan_row, column, value)
+
+    def append_journal(self, base, date, seq, changes):
+        '''
+        Add changes to the journal of the startup config whose digest is
+        base, as the row for sequence number seq. The row is only
+        written if the startup row still has the given date (the value
+        of its date column, None if unset), so changes are never added
+        to the journal of a startup config saved since.
+
+        Returns the size of the row's config column, or None if it was
+        not written.
+        '''
+        config = encode_config({"base": base, "seq": seq,
+                                "changes": changes})
+
+        if date is None:
+            date_json = ["set", []]
+        else:
+            date_json = date
+        operations = [{"op": "wait",
+                       "table": CONFIG_TABLE,
+                       "timeout": 0,
+                       "where": [[TYPE, "==", "startup"]],
+                       "columns": [DATE],
+                       "until": "==",
+                       "rows": [{DATE: date_json}]},
+                      {"op": "insert",
+                       "table": CONFIG_TABLE,
+                       "row": {TYPE: JOURNAL_TYPE,
+                               NAME: "%08d" % seq,
+                               CONFIG: config}}]
+        try:
+            self.__transact(operations)
+        except error.Error, e:
+            vlog.warn("Journal row %d not written: %s" % (seq, e))
+            return None
+
+        return len(config)
+
+    def delete_journal(self):
+        '''
+        Delete the journal rows of the startup config.
+        '''
+        rows = self.idl.rows_of_type(JOURNAL_TYPE)
+        if not rows:
+            return ovs.db.idl.Transaction.UNCHANGED
+
+        self.txn = ovs.db.idl.Transaction(self.idl)
+        for row in rows:
+            row.delete()
+
+        return self.txn.commit_block()
+
+    def write_plan(self, name, plan):
+        '''
+        Write a restore plan as the plan row, named name (see
+        plan_name()), replacing any previous plan. Returns True if it was
+        written.
+        '''
+        operations = [{"op": "delete",
+                       "table": CONFIG_TABLE,
+                       "where": [[TYPE, "==", PLAN_TYPE]]},
+                      {"op": "insert",
+                       "table": CONFIG_TABLE,
+                       "row": _plan_row(name, plan)}]
+        try:
+            self.__transact(operations)
+        except error.Error, e:
+            vlog.warn("Restore plan not written: %s" % e)
+            return False
+
+        return True
+
+    def delete_plan(self):
+        '''
+        Delete the restore plan of the startup config.
+        '''
+        rows = self.idl.rows_of_type(PLAN_TYPE)
+        if not rows:
+            return ovs.db.idl.Transaction.UNCHANGED
+
+        self.txn = ovs.db.idl.Transaction(self.idl)
+        for row in rows:
+            row.delete()
+
+        return self.txn.commit_block()
+
+    def config_sizes(self, rows):
+        '''
+        Returns the sizes in bytes of the configs of rows, with the
+        chunks they reference in the chunked layout (a chunk shared by
+        several rows counts for each of them). The configs and chunks
+        are read with one transaction if the session does not replicate
+        them.
+        '''
+        if not rows:
+            return []
+
+        keys = set(row_key(row) for row in rows)
+        chunk_rows = []
+        for chunk_row in self.idl.rows_of_type(CHUNK_TYPE):
+            owners = chunk_owners(chunk_row)
+            # Chunks saved before their owners were listed may be used
+            if owners is None or owners & keys:
+                chunk_rows.append(chunk_row)
+
+        configs = self.read_configs(list(rows) + chunk_rows)
+        chunk_sizes = dict((column_value(chunk_row.name), len(config or ""))
+                           for chunk_row, config
+                           in zip(chunk_rows, configs[len(rows):]))
+
+        sizes = []
+        for config in configs[:len(rows)]:
+            size = len(config or "")
+            for chunk_hash in config_chunk_hashes(config or "") or []:
+                size += chunk_sizes.get(chunk_hash, 0)
+            sizes.append(size)
+        return sizes
+
+    def checkpoint_evictions(self, name, size, max_count=None,
+                             max_bytes=None):
+        '''
+        Returns the checkpoints to evict (oldest date first) so that
+        saving a checkpoint of size bytes under name stays within
+        max_count checkpoints and max_bytes of config, chunks included
+        (module defaults if None, 0 means no limit), or None if size
+        alone is over max_bytes.
+        '''
+        if max_count is None:
+            max_count = checkpoint_limits()[0]
+        if max_bytes is None:
+            max_bytes = checkpoint_limits()[1]
+
+        if max_bytes > 0 and size > max_bytes:
+            return None
+
+        others = [row for row in self.idl.rows_of_type(CHECKPOINT_TYPE)
+                  if column_value(row.name) != name]
+        others.sort(key=lambda row: (column_value(row.date),
+                                     column_value(row.name)))
+
+        count = len(others) + 1
+        total = size
+        sizes = {}
+        if max_bytes > 0:
+            sizes = dict(zip([row.uuid for row in others],
+                             self.config_sizes(others)))
+            total += sum(sizes.itervalues())
+
+        evicted = []
+        for row in others:
+            if ((max_count <= 0 or count <= max_count) and
+                    (max_bytes <= 0 or total <= max_bytes)):
+                break
+            evicted.append(row)
+            count -= 1
+            total -= sizes.get(row.uuid, 0)
+
+        return evicted
+
+    def save_checkpoint(self, name, max_count=None, max_bytes=None,
+                        data=None):
+        '''
+        Save the user values (self.config at least) as the checkpoint
+        named name, replacing any checkpoint with that name. Checkpoints
+        returned by checkpoint_evictions() are deleted in the same
+        transaction. With data, the config object is saved in the chunked
+        layout instead (see write_chunked()).
+
+        Returns the status and the list of evicted checkpoint names, the
+        status being "Invalid" if the checkpoint alone is over max_bytes.
+        '''
+        if data is not None:
+            self.date = current_date()
+            return self.write_chunked(
+                CHECKPOINT_TYPE, name, data,
+                lambda size: self.checkpoint_evictions(name, size,
+                                                       max_count, max_bytes))
+
+        if self.config is None or CONFIG not in self.columns:
+            return "Invalid", []
+
+        evicted = self.checkpoint_evictions(name, len(self.config),
+                                            max_count, max_bytes)
+        if evicted is None:
+            return "Invalid", []
+        evicted_names = [column_value(row.name) for row in evicted]
+
+        self.type = CHECKPOINT_TYPE
+        self.name = name
+        self.date = current_date()
+
+        row = self.find_row(CHECKPOINT_TYPE, name)
+        dropped = evicted + ([row] if row is not None else [])
+
+        self.txn = ovs.db.idl.Transaction(self.idl)
+        if row is None:
+            row = self.txn.insert(self.idl.tables[CONFIG_TABLE])
+
+        status = self.__set_column_value(row)
+        if (status is not "success"):
+            self.txn.abort()
+            return status, []
+
+        self.__release_chunks(dropped)
+        for deleted_row in evicted:
+            deleted_row.delete()
+
+        return self.txn.commit_block(), evicted_names
+
+    def touch_row(self, row):
+        '''
+        Set the date of a row to now (used to track the last use of
+        checkpoints for the "lru" eviction policy).
+        '''
+        self.txn = ovs.db.idl.Transaction(self.idl)
+        setattr(row, DATE, current_date())
+
+        return self.txn.commit_block()
+
+    def write_row(self, cfgtype, name=None):
+        '''
+        Update the row with the given type and name with the user
+        values, inserting it if it does not exist yet.
+        '''
+        self.type = cfgtype
+        self.name = name
+
+        row = self.find_row(cfgtype, name)
+        if row is None:
+            return self.insert_row()
+
+        return self.update_row(row)
+
     '''
-    OPS_TODO: This probably should be by TYPE and NAME. In
-    the future we could possibly have multiple row of same
-    type with different names. However, currently we support
-    only one row and "startup" is supposed to be a "one only"
-    type so there is no ambiguity of which is the startup config.
+    "startup" is supposed to be a "one only" type, so deleting by
+    type alone has no ambiguity for it. Other types can have several
+    rows with different names.
     '''
-    def delete_row_by_type(self, cfgtype):
+    def delete_row_by_type(self, cfgtype, name=None):
         '''
         Delete a specific row from configdb based on
-        config type passed as argument
+        config type (and name, if given) passed as argument
 
         If specified row is found, variable row_found
         is updated to True and delete status is returned
         '''
         self.txn = ovs.db.idl.Transaction(self.idl)
-        row, row_found = self.find_row_by_type(cfgtype)
+        row = self.find_row(cfgtype, name)
+        row_found = row is not None
         status = "unchanged"
 
         if row_found:
+            self.__release_chunks([row])
             row.delete()
             status = self.txn.commit_block()
 
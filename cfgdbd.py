@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import argparse
+from StringIO import StringIO
+
+import ovs.daemon
+import ovs.poller
+import ovs.unixctl
+import ovs.unixctl.server
+import ovs.util
+import ovs.vlog
+
+from opsrest.settings import settings
+
+import cfgautosave
+import cfgdb
+import cfgdbutil
+import cfgschema
+
+# System columns replicated along with the config columns: the autosave
+# waits for cur_cfg (see cfgautosave)
+SYSTEM_COLUMNS = ["cur_cfg"]
+
+# Program control
+exiting = False
+
+# VLOG
+vlog = ovs.vlog.Vlog("cfgdbd")
+
+
+class Sessions(object):
+    '''
+    Idl sessions kept open between cfgdbutil commands: one Cfgdb session
+    per set of columns and one config idl per db remote. The main loop
+    keeps them in sync so commands find them ready to use, and a session
+    is brought up to date with the db (see cfgdb.sync_idl()) before a
+    command uses it, so it sees what other clients committed just before.
+    '''
+    def __init__(self):
+        self._cfgdbs = {}
+        self._idls = {}
+
+    def cfgdb(self, columns=None):
+        if columns is None:
+            columns = cfgdb.ALL_COLUMNS
+        key = tuple(sorted(columns))
+
+        cfg = self._cfgdbs.get(key)
+        if cfg is None:
+            cfg = cfgdb.Cfgdb(columns=columns)
+            self._cfgdbs[key] = cfg
+        else:
+            self.__sync(cfg.idl)
+        return cfg
+
+    def running_idl(self, extschema, remote):
+        opsidl = self._idls.get(remote)
+        if opsidl is None:
+            opsidl = cfgschema.register_config_idl(
+                extschema, settings.get('ovs_schema'), remote,
+                SYSTEM_COLUMNS)
+            curr_seqno = opsidl.change_seqno
+            while True:
+                opsidl.run()
+                if curr_seqno != opsidl.change_seqno:
+                    break
+                poller = ovs.poller.Poller()
+                opsidl.wait(poller)
+                poller.block()
+            self._idls[remote] = opsidl
+        else:
+            self.__sync(opsidl)
+        return opsidl
+
+    def __sync(self, idl):
+        if not cfgdb.sync_idl(idl):
+            vlog.warn("Idl session not synced with the db, it may be stale")
+
+    def run(self):
+        for cfg in self._cfgdbs.itervalues():
+            cfg.idl.run()
+        for opsidl in self._idls.itervalues():
+            opsidl.run()
+
+    def wait(self, poller):
+        for cfg in self._cfgdbs.itervalues():
+            cfg.idl.wait(poller)
+        for opsidl in self._idls.itervalues():
+            opsidl.wait(poller)
+
+    def close(self):
+        for cfg in self._cfgdbs.itervalues():
+            cfg.close()
+        self._cfgdbs = {}
+        for opsidl in self._idls.itervalues():
+            opsidl.close()
+        self._idls = {}
+
+
+#####################  unixctl commands ######################
+
+#------------------ unixctl_exit() ----------------
+def unixctl_exit(conn, unused_argv, unused_aux):
+    global exiting
+
+    exiting = True
+    conn.reply(None)
+
+
+#------------------ unixctl_command() ----------------
+def unixctl_command(conn, argv, command_name):
+    '''
+    Run a cfgdbutil command forwarded by cfgdbutil.forward_command() and
+    reply with its output.
+    '''
+    words = [arg for arg in argv if not arg.startswith('-')]
+    if not words or words[0] != command_name:
+        argv = [command_name] + argv
+
+    output = StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        status = cfgdbutil.run_command("cfgdbutil", argv)
+    except Exception, e:
+        vlog.exception("cfgdbutil %s failed" % command_name)
+        print("Error: \"%s\" \n" % e)
+        status = 2
+    finally:
+        sys.stdout = stdout
+
+    if status:
+        conn.reply_error(output.getvalue())
+    else:
+        conn.reply(output.getvalue())
+
+
+###############################  main  ###########################
+def main():
+    '''cfgdbd.main()
+
+    Resident cfgdbutil server: keeps the parsed extended schema and warm
+    idl sessions to the configdb and the running db, and runs the
+    cfgdbutil commands forwarded over its unixctl socket. With
+    --autosave, it also saves the running config changes to the journal
+    of the startup config (see cfgautosave).
+    '''
+
+    global exiting
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--autosave', action='store_true',
+                        help="Save the running config changes to the "
+                             "startup config as they happen.",
+                        dest='autosave')
+    parser.add_argument('--autosave-interval', metavar="MSEC", type=int,
+                        help="Time changes are coalesced for before "
+                             "being saved (default: %d)."
+                             % cfgautosave.AUTOSAVE_INTERVAL_MSEC,
+                        dest='autosave_interval')
+    parser.add_argument('--autosave-compact', metavar="ROWS", type=int,
+                        help="Rewrite the startup config after ROWS "
+                             "journal rows (default: %d)."
+                             % cfgautosave.AUTOSAVE_COMPACT_ROWS,
+                        dest='autosave_compact')
+    ovs.vlog.add_args(parser)
+    ovs.daemon.add_args(parser)
+    args = parser.parse_args()
+    ovs.vlog.handle_args(args)
+    ovs.daemon.handle_args(args)
+
+    # Parse (or load the cached) schema once for all commands
+    extschema = cfgschema.load_extschema()
+
+    ovs.daemon.daemonize()
+
+    sessions = Sessions()
+    cfgdbutil.sessions = sessions
+
+    ovs.unixctl.command_register("exit", "", 0, 0, unixctl_exit, None)
+    for command_name in cfgdbutil.commands:
+        ovs.unixctl.command_register("cfgdbutil/%s" % command_name,
+                                     "[ARG...]", 0, 8, unixctl_command,
+                                     command_name)
+    error, unixctl_server = ovs.unixctl.server.UnixctlServer.create(
+        cfgdbutil.SERVER_CTL)
+    if error:
+        ovs.util.ovs_fatal(error, "could not create unixctl server", vlog)
+
+    autosave = None
+    if args.autosave:
+        opsidl = sessions.running_idl(extschema, settings.get('ovs_remote'))
+        autosave = cfgautosave.Autosave(extschema, opsidl,
+                                        args.autosave_interval,
+                                        args.autosave_compact)
+        autosave.start()
+
+    while not exiting:
+        unixctl_server.run()
+        if exiting:
+            break
+
+        sessions.run()
+        if autosave is not None:
+            autosave.run()
+
+        poller = ovs.poller.Poller()
+        unixctl_server.wait(poller)
+        sessions.wait(poller)
+        if autosave is not None:
+            autosave.wait(poller)
+        poller.block()
+
+    if autosave is not None:
+        autosave.close()
+    sessions.close()
+    unixctl_server.close()
+
+    return
+
+if __name__ == '__main__':
+    try:
+        main()
+    except SystemExit:
+        # Let system.exit() calls complete normally
+        raise
+    except:
+        vlog.exception("traceback")
+        sys.exit(ovs.daemon.RESTART_EXIT_CODE)
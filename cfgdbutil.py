@@ -13,13 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-
-
-from opsrest.settings import settings
-import ops.dc
-from opslib import restparser
-
-import base64
+# opsrest, ops.dc and the schema parser are slow to import and are only
+# needed by the commands that touch the running db, so they are imported
+# by those commands rather than here. "show startup-config json" and
+# "delete startup-config" only load cfgdb.
 import getopt
 import os
 import json
@@ -30,13 +27,109 @@ from ovs.db import error
 from ovs.db import types
 import ovs.poller
 import ovs.db.idl
+import ovs.unixctl.client
+import ovs.vlog
 import cfgdb
+import cfgprofile
+import cfgschema
 
 type_startup_config = "startup"
 
 vlog = ovs.vlog.Vlog("cfgmgmt")
 TEMPORARY_DB_SHOW_STARTUP = "unix:/var/run/openvswitch/temp_startup.sock"
 
+# Max rows per transaction for "copy startup-config running-config"
+# (0 = write the whole config in one transaction)
+restore_batch_size = 0
+# Only write what differs from the running config
+restore_only_changed = False
+
+# Layout of the saved configs (see cfgdb.CONFIG_CHUNKS_VERSION)
+config_layout = cfgdb.config_layout
+
+# Checkpoint retention, defaults from cfgdb (see cfgdb.CHECKPOINT_TYPE),
+# set by run_command()
+checkpoint_max_count = None
+checkpoint_max_bytes = None
+checkpoint_eviction = cfgdb.checkpoint_eviction
+
+# Where to write cProfile and memory profiles of the command stages
+# (see cfgprofile)
+profile_dir = cfgprofile.profile_dir
+
+# unixctl socket of the resident cfgdbutil server (see cfgdbd.py)
+SERVER_CTL = "%s/ops-cfgdbd.ctl" % ovs.dirs.RUNDIR
+
+# Idl sessions kept warm between commands by the cfgdbutil server, None
+# when cfgdbutil runs as a one shot command.
+sessions = None
+
+
+def open_cfgdb(columns=None):
+    '''
+    Returns a Cfgdb session replicating columns (all of them by default).
+    '''
+    if sessions is not None:
+        return sessions.cfgdb(columns)
+    return cfgdb.Cfgdb(columns=columns)
+
+
+def close_cfgdb(cfg):
+    if sessions is None:
+        cfg.close()
+
+
+def open_running_idl(extschema, remote=None):
+    '''
+    Returns an idl in sync with the db at remote (the running db by
+    default), replicating the columns ops.dc reads and writes configs
+    with (see cfgschema.config_columns()).
+    '''
+    from opsrest.settings import settings
+
+    if remote is None:
+        remote = settings.get('ovs_remote')
+
+    if sessions is not None:
+        return sessions.running_idl(extschema, remote)
+
+    opsidl = cfgschema.register_config_idl(extschema,
+                                           settings.get('ovs_schema'), remote)
+    curr_seqno = opsidl.change_seqno
+    while True:
+        opsidl.run()
+        if curr_seqno != opsidl.change_seqno:
+            break
+        poller = ovs.poller.Poller()
+        opsidl.wait(poller)
+        poller.block()
+
+    return opsidl
+
+
+def close_running_idl(opsidl):
+    if sessions is None:
+        opsidl.close()
+
+
+def print_config_json(tables):
+    '''
+    Print a saved config as indented json, decoding and printing one
+    table at a time (tables is a Cfgdb.iter_config() iterator) so the
+    whole document is never held in memory.
+    '''
+    sep = "{\n"
+    for table, value in tables:
+        text = json.dumps({table: value}, indent=4, sort_keys=True)
+        # Strip the enclosing "{\n" and "\n}" of the single member object
+        sys.stdout.write(sep + text[2:-2])
+        sep = ",\n"
+
+    if sep == "{\n":
+        print("{}")
+    else:
+        print("\n}")
+
 
 def show_config(args):
     ret = True
@@ -44,44 +137,40 @@ def show_config(args):
         print("Unknown config \"%s\" (Use --help for help)" % args[0])
         return False
 
-    cfg = cfgdb.Cfgdb()
+    # The config blob is read once the row is found
+    cfgprofile.phase("read_startup")
+    cfg = open_cfgdb(cfgdb.METADATA_COLUMNS)
 
     #OPS TODO: To get confg type from user as args
     row, tbl_found = cfg.find_row_by_type("startup")
 
     if tbl_found:
         try:
-            data = json.loads(base64.b64decode(row.config))
-            print("Startup configuration:")
+            cfgprofile.phase("decode")
             if (args[1] == "json"):
-                print json.dumps(data,  indent=4, sort_keys=True)
+                print("Startup configuration:")
+                print_config_json(cfg.iter_config(row))
             elif (args[1] == "cli"):
+                import cfgrestore
+
+                data = dict(cfg.iter_config(row))
+                print("Startup configuration:")
                 # Here we copy saved configuration from config DB to temporary
                 # DB and the current startup configuration command displays
-                # output by traversing the temporary DB.
-                extschema = restparser.parseSchema(settings.get('ext_schema'))
-                ovsschema = settings.get('ovs_schema')
-                ovsremote = TEMPORARY_DB_SHOW_STARTUP
-
-                # initialize idl
-                opsidl = ops.dc.register(extschema, ovsschema, ovsremote)
-                curr_seqno = opsidl.change_seqno
-                while True:
-                    opsidl.run()
-                    if curr_seqno != opsidl.change_seqno:
-                        break
-                    poller = ovs.poller.Poller()
-                    opsidl.wait(poller)
-                    poller.block()
-
-                # write to db
-                txn = ovs.db.idl.Transaction(opsidl)
-                result = ops.dc.write(data, extschema, opsidl, txn)
-                if result == ovs.db.idl.Transaction.INCOMPLETE:
-                    result = txn.commit_block()
+                # output by traversing the temporary DB. The rows are built
+                # here from the saved config and the schemas and written in
+                # one transaction, with no idl on the temporary DB.
+                cfgprofile.phase("schema_parse")
+                extschema = cfgschema.load_extschema()
+                schema = cfgschema.load_ovsschema()
+
+                cfgprofile.phase("write_temp_db")
+                result = cfgrestore.replace_db(data, extschema, schema,
+                                               TEMPORARY_DB_SHOW_STARTUP)
 
                 if result not in [ovs.db.idl.Transaction.SUCCESS, ovs.db.idl.Transaction.UNCHANGED]:
                     print("Transaction result %s" %result)
+                    close_cfgdb(cfg)
                     return False
 
         except ValueError, e:
@@ -91,126 +180,372 @@ def show_config(args):
         print('No saved configuration exists')
         ret = False
 
-    cfg.close()
+    close_cfgdb(cfg)
     return ret
 
 
-def copy_running_startup():
+def read_running_config(with_replica=False):
+    '''
+    Returns the running config, read with ops.dc. If with_replica is set,
+    returns it along with the extended schema and the replica of the
+    running db it was read from, which its restore plan is compiled from
+    (see save_startup_config()). The caller closes the replica with
+    close_running_replica() then.
+    '''
+    import ops.dc
+
+    cfgprofile.phase("schema_parse")
+    extschema = cfgschema.load_extschema()
 
-    # get running config
-    extschema = restparser.parseSchema(settings.get('ext_schema'))
-    ovsschema = settings.get('ovs_schema')
-    ovsremote = settings.get('ovs_remote')
+    replica = None
+    opsidl = None
+    if sessions is None:
+        # A one shot read does not need an idl kept in sync
+        from opsrest.settings import settings
+        import cfgsnapshot
+
+        cfgprofile.phase("read_snapshot")
+        try:
+            replica = cfgsnapshot.read_snapshot(extschema,
+                                                settings.get('ovs_schema'),
+                                                settings.get('ovs_remote'))
+        except error.Error, e:
+            vlog.warn("Snapshot read failed, reading the running config "
+                      "with an idl: %s" % e)
+
+    if replica is None:
+        # initialize idl
+        cfgprofile.phase("idl_sync")
+        opsidl = open_running_idl(extschema)
+        replica = opsidl
+
+    cfgprofile.phase("read_running")
+    running_config = ops.dc.read(extschema, replica)
+
+    if with_replica:
+        return running_config, extschema, replica
+
+    if opsidl is not None:
+        close_running_idl(opsidl)
+    return running_config
+
+
+def close_running_replica(replica):
+    '''
+    Close a replica returned by read_running_config().
+    '''
+    if isinstance(replica, ovs.db.idl.Idl):
+        close_running_idl(replica)
+
+
+def compile_restore_plan(data, extschema, replica, fingerprint):
+    '''
+    Returns the restore plan of the running config data, read from replica
+    (see cfgrestore.compile_plan()), for the schemas with the given
+    fingerprint, or None if it could not be compiled.
+    '''
+    import cfgrestore
+
+    cfgprofile.phase("compile_plan")
+    try:
+        return cfgrestore.compile_plan(data, extschema, replica, fingerprint)
+    except (error.Error, ValueError), e:
+        # The config is still saved, cfgd pushes it without a plan
+        vlog.warn("Unable to compile the restore plan: %s" % e)
+        return None
+
+
+def restore_plan(data, extschema, replica, fingerprint, digest):
+    '''
+    Returns the (name, plan) pair of the restore plan of the running
+    config data with the given digest (see compile_restore_plan()), or
+    None if it could not be compiled.
+    '''
+    plan = compile_restore_plan(data, extschema, replica, fingerprint)
+    if plan is None:
+        return None
+    return cfgdb.plan_name(fingerprint, digest), plan
+
+
+def write_running_config(data):
+    '''
+    Write a saved config (decoded) to the running db.
+    '''
+    import ops.dc
+
+    cfgprofile.phase("schema_parse")
+    extschema = cfgschema.load_extschema()
 
     # initialize idl
-    opsidl = ops.dc.register(extschema, ovsschema, ovsremote)
-    curr_seqno = opsidl.change_seqno
-    while True:
-        opsidl.run()
-        if curr_seqno != opsidl.change_seqno:
-            break
-        poller = ovs.poller.Poller()
-        opsidl.wait(poller)
-        poller.block()
+    cfgprofile.phase("idl_sync")
+    opsidl = open_running_idl(extschema)
+
+    cfgprofile.phase("write_running")
+    if restore_batch_size > 0 or restore_only_changed:
+        import cfgrestore
+        result = cfgrestore.write_batched(data, extschema, opsidl,
+                                          restore_batch_size,
+                                          restore_only_changed)
+    else:
+        txn = ovs.db.idl.Transaction(opsidl)
+        result = ops.dc.write(data, extschema, opsidl, txn)
+        if result == ovs.db.idl.Transaction.INCOMPLETE:
+            result = txn.commit_block()
+    close_running_idl(opsidl)
+
+    if result not in [ovs.db.idl.Transaction.SUCCESS, ovs.db.idl.Transaction.UNCHANGED]:
+        return False
+
+    return True
 
-    running_config = ops.dc.read(extschema, opsidl)
 
-    # base64 encode to save as startup
-    config = base64.b64encode(json.dumps(running_config))
-    cfg = cfgdb.Cfgdb()
-    cfg.config = config
-    cfg.type = "startup"
+def copy_running_startup():
+    running_config, extschema, replica = \
+        read_running_config(with_replica=True)
+
+    try:
+        return save_startup_config(running_config, extschema=extschema,
+                                   replica=replica)
+    finally:
+        close_running_replica(replica)
+
+
+def save_startup_config(data, raw=None, digest=None, date=None,
+                        extschema=None, replica=None):
+    '''
+    Save config data as the startup config (raw and digest are its
+    serialize_config() output and digest, if already known), with date
+    as the date of the row (now by default). The journal and the restore
+    plan of the previous startup config are deleted in the same
+    transaction. If replica, the running db replica data was read from
+    (with extschema), is given, the restore plan of data (see
+    cfgrestore.compile_plan()) is written as the new one in it too.
+
+    Nothing is written if the stored config has the same digest and no
+    journal, unless a date is given; the restore plan is only compiled
+    and written then if the stored one is not for the current schemas.
+
+    Returns False if the config could not be written.
+    '''
+    cfgprofile.phase("encode")
+    if raw is None:
+        raw = cfgdb.serialize_config(data)
+    if digest is None:
+        digest = cfgdb.config_digest(raw)
+    if config_layout == cfgdb.LAYOUT_CHUNKS:
+        # Chunks are written on a separate connection
+        cfg = open_cfgdb(cfgdb.METADATA_COLUMNS)
+    else:
+        cfg = open_cfgdb()
+    cfgprofile.phase("write_startup")
     row, tbl_found = cfg.find_row_by_type("startup")
+    journal = cfg.list_rows(cfgdb.JOURNAL_TYPE)
+    plans = cfg.list_rows(cfgdb.PLAN_TYPE)
+    fingerprint = None
+    if replica is not None:
+        try:
+            fingerprint = cfgschema.schema_fingerprint()
+        except EnvironmentError, e:
+            vlog.warn("Not writing the restore plan: %s" % e)
+
+    if (tbl_found and date is None and not journal and
+            cfgdb.get_config_digest(cfg.read_config(row)) == digest):
+        vlog.info("Startup configuration is unchanged, not saving it")
+        # The schemas may have changed since the plan was written
+        if fingerprint is not None and \
+           [cfgdb.column_value(p.name) for p in plans] != \
+           [cfgdb.plan_name(fingerprint, digest)]:
+            plan = restore_plan(data, extschema, replica, fingerprint,
+                                digest)
+            if plan is not None:
+                cfg.write_plan(*plan)
+        close_cfgdb(cfg)
+        return True
+
+    plan = None
+    if fingerprint is not None:
+        plan = restore_plan(data, extschema, replica, fingerprint, digest)
+    cfg.date = date or cfgdb.current_date()
+    if config_layout == cfgdb.LAYOUT_CHUNKS:
+        status, unused = cfg.write_chunked("startup", None, data,
+                                           deleted_rows=journal + plans,
+                                           plan=plan)
+        close_cfgdb(cfg)
+        return status == ovs.db.idl.Transaction.SUCCESS
+
+    # encode (compressed) to save as startup
+    cfg.config = cfgdb.encode_config(raw=raw, digest=digest)
+    cfg.type = "startup"
+    cfg.name = None
     if tbl_found:
-        cfg.update_row(row)
+        unused, status = cfg.update_row(row, journal + plans, plan)
     else:
-        cfg.insert_row()
+        unused, status = cfg.insert_row(journal + plans, plan)
 
-    cfg.close()
-    return True
+    close_cfgdb(cfg)
+    return status in [ovs.db.idl.Transaction.SUCCESS,
+                      ovs.db.idl.Transaction.UNCHANGED]
 
 
-def copy_startup_running():
-    cfg = cfgdb.Cfgdb()
+def copy_saved_running(cfgtype, name=None):
+    '''
+    Copy the saved config of the given type (and name) to the running
+    config.
+    '''
+    cfgprofile.phase("read_%s" % cfgtype)
+    cfg = open_cfgdb(cfgdb.METADATA_COLUMNS)
 
-    #OPS TODO: To get confg type from user as args
-    row, tbl_found = cfg.find_row_by_type("startup")
+    row = cfg.find_row(cfgtype, name)
 
-    if tbl_found:
+    if row is not None:
         try:
-            data = json.loads(base64.b64decode(row.config))
+            cfgprofile.phase("decode")
+            data = dict(cfg.iter_config(row))
         except ValueError, e:
             print("Invalid json from configdb. Exception: %s\n" % e)
-            cfg.close()
+            close_cfgdb(cfg)
             return False
     else:
-        print('No saved configuration exists')
-        cfg.close()
+        if name is None:
+            print('No saved configuration exists')
+        else:
+            print('No %s named "%s" exists' % (cfgtype, name))
+        close_cfgdb(cfg)
         return False
 
-    extschema = restparser.parseSchema(settings.get('ext_schema'))
-    ovsschema = settings.get('ovs_schema')
-    ovsremote = settings.get('ovs_remote')
+    # Using a checkpoint refreshes it for the lru eviction policy
+    if (cfgtype == cfgdb.CHECKPOINT_TYPE and
+            checkpoint_eviction == cfgdb.EVICT_LRU):
+        cfg.touch_row(row)
 
-    # initialize idl
-    opsidl = ops.dc.register(extschema, ovsschema, ovsremote)
-    curr_seqno = opsidl.change_seqno
-    while True:
-        opsidl.run()
-        if curr_seqno != opsidl.change_seqno:
-            break
-        poller = ovs.poller.Poller()
-        opsidl.wait(poller)
-        poller.block()
+    # Drop the configdb replica (and the raw blob) before syncing the
+    # running db
+    row = None
+    close_cfgdb(cfg)
 
-    txn = ovs.db.idl.Transaction(opsidl)
-    result = ops.dc.write(data, extschema, opsidl, txn)
-    if result == ovs.db.idl.Transaction.INCOMPLETE:
-        result = txn.commit_block()
+    return write_running_config(data)
 
-    if result not in [ovs.db.idl.Transaction.SUCCESS, ovs.db.idl.Transaction.UNCHANGED]:
+
+def copy_startup_running():
+    #OPS TODO: To get confg type from user as args
+    return copy_saved_running("startup")
+
+
+def copy_running_checkpoint(name):
+    running_config = read_running_config()
+
+    cfgprofile.phase("write_checkpoint")
+    if config_layout == cfgdb.LAYOUT_CHUNKS:
+        # Chunks are written on a separate connection
+        cfg = open_cfgdb(cfgdb.METADATA_COLUMNS)
+        status, evicted = cfg.save_checkpoint(name, checkpoint_max_count,
+                                              checkpoint_max_bytes,
+                                              data=running_config)
+        close_cfgdb(cfg)
+        if status == "Invalid" and checkpoint_max_bytes > 0:
+            print("Checkpoint is more than the %d bytes allowed"
+                  % checkpoint_max_bytes)
+            return False
+        return checkpoint_saved(status, evicted)
+
+    cfg = open_cfgdb()
+    cfg.config = cfgdb.encode_config(running_config)
+
+    if (checkpoint_max_bytes > 0 and
+            len(cfg.config) > checkpoint_max_bytes):
+        print("Checkpoint is %d bytes, more than the %d bytes allowed"
+              % (len(cfg.config), checkpoint_max_bytes))
+        close_cfgdb(cfg)
         return False
 
+    status, evicted = cfg.save_checkpoint(name, checkpoint_max_count,
+                                          checkpoint_max_bytes)
+    close_cfgdb(cfg)
+
+    return checkpoint_saved(status, evicted)
+
+
+def checkpoint_saved(status, evicted):
+    if status not in [ovs.db.idl.Transaction.SUCCESS, ovs.db.idl.Transaction.UNCHANGED]:
+        print("Save checkpoint status : %s" % status)
+        return False
+
+    for evicted_name in evicted:
+        print("Evicted checkpoint %s" % evicted_name)
+
     return True
 
 
 def copy_config(args):
     ret = True
-    if (args[0] == "running-config" and args[1] == "startup-config"):
+    if (len(args) == 2 and args[0] == "running-config" and
+            args[1] == "startup-config"):
         ret = copy_running_startup()
-    elif (args[0] == "startup-config" and args[1] == "running-config"):
+    elif (len(args) == 2 and args[0] == "startup-config" and
+            args[1] == "running-config"):
         ret = copy_startup_running()
+    elif (len(args) == 3 and args[0] == "running-config" and
+            args[1] == "checkpoint"):
+        ret = copy_running_checkpoint(args[2])
+    elif (len(args) == 3 and args[0] == "checkpoint" and
+            args[2] == "running-config"):
+        ret = copy_saved_running(cfgdb.CHECKPOINT_TYPE, args[1])
     else:
         print("Unknow config (use --help for help)")
         ret = False
     return ret
 
 
+def list_config(args):
+    if (args[0] != "checkpoints"):
+        print("Unknown config \"%s\" (Use --help for help)" % args[0])
+        return False
+
+    cfg = open_cfgdb(cfgdb.METADATA_COLUMNS)
+
+    rows = cfg.list_rows(cfgdb.CHECKPOINT_TYPE)
+    if rows:
+        print("%-32s %s" % ("Checkpoint", "Date"))
+        for row in rows:
+            print("%-32s %s" % (cfgdb.column_value(row.name),
+                                cfgdb.column_value(row.date) or ""))
+    else:
+        print("No checkpoints exist")
+
+    close_cfgdb(cfg)
+    return True
+
+
 def delete_config(args):
     if (args[0] != "startup-config"):
         print("Unknown config \"%s\" (Use --help for help)" % args[0])
         return False
 
-    cfg = cfgdb.Cfgdb()
+    cfg = open_cfgdb(cfgdb.METADATA_COLUMNS)
 
     #OPS TODO: To get confg type from user from user as args
     status, tbl_found = cfg.delete_row_by_type("startup")
 
     if tbl_found:
+        cfg.delete_journal()
+        cfg.delete_plan()
         print("Delete statup row status : %s" % status)
     else:
         print('No saved configuration exists')
-        cfg.close()
+        close_cfgdb(cfg)
         return False
 
-    cfg.close()
+    close_cfgdb(cfg)
     return True
 
 
 def usage(name):
     print (
         "%s: Configuration Persistance Utility \n\
-        usage: %s [--help] COMMAND ARG...\n\n\
+        usage: %s [--help] [--local] [--batch-size=ROWS] [--diff]\n\
+               [--max-checkpoints=N] [--max-checkpoint-bytes=BYTES]\n\
+               [--eviction=oldest|lru] [--layout=blob|chunks]\n\
+               [--profile-dir=DIR] COMMAND ARG...\n\n\
         The following commands are supported: \n\n\
         show startup-config cli\n\
             Shows the contentes of startup configuration in CLI format\n\n\
@@ -219,37 +554,112 @@ def usage(name):
         copy running-config startup-config \n\
             Copy running config to startup config \n\n\
         copy start-config running-config \n\
-            Copy startup config to running config)\n\n\
+            Copy startup config to running config)\n\
+            With --batch-size, write at most ROWS rows per transaction\n\
+            With --diff, only write what differs from the running config\n\n\
+        copy running-config checkpoint NAME\n\
+            Save the running config as checkpoint NAME, evicting other\n\
+            checkpoints (oldest, or least recently used with --eviction=lru)\n\
+            to keep at most --max-checkpoints checkpoints and\n\
+            --max-checkpoint-bytes bytes of config (0 = no limit)\n\n\
+        copy checkpoint NAME running-config\n\
+            Copy checkpoint NAME to running config\n\
+            (--batch-size and --diff apply as above)\n\n\
+        list checkpoints\n\
+            List the saved checkpoints\n\n\
         delete startup-config \n\
-            Delete the startup configuration row in configdb\n\n"
+            Delete the startup configuration row in configdb\n\n\
+        --layout=chunks saves configs as per-table chunks shared\n\
+        between the saved configs instead of one blob per config.\n\n\
+        Commands are forwarded to the resident cfgdbutil server\n\
+        (ops_cfgdbd) when it is running, unless --local is given.\n\n\
+        --profile-dir (or $CFGD_PROFILE_DIR) writes cProfile and memory\n\
+        profiles of each stage of the command to DIR.\n\n"
         % (name, name))
 
 
-def main():
-    argv = sys.argv
-    program_name = argv[0]
+#Command Dictionary with command name as key and key value as list
+#with functions and corresponding argument length
+commands = {"show":   (show_config, 2),
+            "copy":   (copy_config, (2, 3)),
+            "list":   (list_config, 1),
+            "delete": (delete_config, 1)}
+
+
+def run_command(program_name, argv):
+    '''
+    Parse the options and run the command in argv.
+    Returns the exit status of the command.
+    '''
+    global restore_batch_size
+    global restore_only_changed
+    global checkpoint_max_count
+    global checkpoint_max_bytes
+    global checkpoint_eviction
+    global config_layout
+    global profile_dir
+
+    restore_batch_size = 0
+    restore_only_changed = False
+    checkpoint_max_count, checkpoint_max_bytes = cfgdb.checkpoint_limits()
+    checkpoint_eviction = cfgdb.checkpoint_eviction
+    config_layout = cfgdb.config_layout
+    profile_dir = cfgprofile.profile_dir
 
     try:
-        options, args = getopt.gnu_getopt(argv[1:], 'h', ['help'])
+        options, args = getopt.gnu_getopt(argv, 'h',
+                                          ['help', 'local', 'batch-size=',
+                                           'diff', 'max-checkpoints=',
+                                           'max-checkpoint-bytes=',
+                                           'eviction=', 'layout=',
+                                           'profile-dir='])
     except getopt.GetoptError, geo:
         print("%s: %s\n" % (program_name, geo.msg))
-        sys.exit(2)
+        return 2
 
     for key, value in options:
         if key in ['-h', '--help']:
             usage(program_name)
-            sys.exit(0)
+            return 0
+        elif key == '--batch-size':
+            try:
+                restore_batch_size = int(value)
+            except ValueError:
+                print("%s: invalid batch size \"%s\"\n"
+                      % (program_name, value))
+                return 2
+        elif key == '--diff':
+            restore_only_changed = True
+        elif key in ['--max-checkpoints', '--max-checkpoint-bytes']:
+            try:
+                limit = int(value)
+            except ValueError:
+                print("%s: invalid %s \"%s\"\n"
+                      % (program_name, key, value))
+                return 2
+            if key == '--max-checkpoints':
+                checkpoint_max_count = limit
+            else:
+                checkpoint_max_bytes = limit
+        elif key == '--eviction':
+            if value not in cfgdb.EVICTION_POLICIES:
+                print("%s: unknown eviction policy \"%s\"\n"
+                      % (program_name, value))
+                return 2
+            checkpoint_eviction = value
+        elif key == '--layout':
+            if value not in cfgdb.CONFIG_LAYOUTS:
+                print("%s: unknown layout \"%s\"\n"
+                      % (program_name, value))
+                return 2
+            config_layout = value
+        elif key == '--profile-dir':
+            profile_dir = value
 
     if not args:
         print("%s: missing command argument (use --help for help)\n"
               % program_name)
-        sys.exit(2)
-
-    #Command Dictionary with command name as key and key value as list
-    #with functions and corresponding argument length
-    commands = {"show":   (show_config, 2),
-                "copy":   (copy_config, 2),
-                "delete": (delete_config, 1)}
+        return 2
 
     command_name = args[0]
     args = args[1:]
@@ -257,26 +667,93 @@ def main():
     if not command_name in commands:
         print("%s: unknown command \'%s\' (use --help for help)\n"
               % (program_name, command_name))
-        sys.exit(2)
+        return 2
 
     func, n_args = commands[command_name]
     if type(n_args) == tuple:
         if len(args) < n_args[0]:
             print("%s: \"%s\" requires at least %d arguments but "
                   "only %d provided (use --help for help)\n"
-                  % (program_name, command_name, n_args, len(args)))
-            sys.exit(2)
+                  % (program_name, command_name, n_args[0], len(args)))
+            return 2
+        if len(n_args) > 1 and len(args) > n_args[1]:
+            print("%s: \"%s\" takes at most %d arguments but "
+                  "%d provided (use --help for help)\n"
+                  % (program_name, command_name, n_args[1], len(args)))
+            return 2
     elif type(n_args) == int:
         if len(args) != n_args:
             print("%s: \"%s\" requires %d arguments but %d provided "
                   "(use --help for help)\n"
                   % (program_name, command_name, n_args, len(args)))
-            sys.exit(2)
+            return 2
     else:
         assert False, ("Invalid argument length %s %s" % (func, n_args))
 
-    if func(args) is False:
-        sys.exit(2)
+    cfgprofile.start("cfgdbutil-%s" % command_name, profile_dir,
+                     command_name)
+    try:
+        ret = func(args)
+    finally:
+        cfgprofile.stop()
+
+    if ret is False:
+        return 2
+
+    return 0
+
+
+def forward_command(argv):
+    '''
+    Forward a command to the resident cfgdbutil server, if one is running.
+    Returns the exit status of the command, or None if it has to be run
+    locally.
+    '''
+    if not argv or not os.path.exists(SERVER_CTL):
+        return None
+
+    # Profiles are taken of the commands run locally
+    if cfgprofile.profile_dir:
+        return None
+
+    for arg in argv:
+        if arg in ['-h', '--help', '--local']:
+            return None
+        if arg.startswith('--profile-dir'):
+            return None
+
+    words = [arg for arg in argv if not arg.startswith('-')]
+    if not words or words[0] not in commands:
+        return None
+
+    err, client = ovs.unixctl.client.UnixctlClient.create(SERVER_CTL)
+    if err:
+        return None
+
+    err, result, err_msg = client.transact("cfgdbutil/%s" % words[0], argv)
+    client.close()
+    if err:
+        vlog.warn("cfgdbutil server unavailable, running locally")
+        return None
+
+    if err_msg is not None:
+        sys.stdout.write(err_msg)
+        return 2
+
+    sys.stdout.write(result)
+    return 0
+
+
+def main():
+    argv = sys.argv
+    program_name = argv[0]
+
+    status = forward_command(argv[1:])
+    if status is None:
+        status = run_command(program_name, argv[1:])
+
+    if status:
+        sys.exit(status)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,181 @@
+# (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# CPU and memory profiling of cfgd and cfgdbutil runs, enabled by their
+# --profile-dir option or $CFGD_PROFILE_DIR.
+#
+# A run is profiled per thread and split in phases (the cfgd dispatcher
+# steps, the cfgdbutil command stages). Each phase is written to the
+# profile directory as:
+#
+#   <name>-<pid>-<time>-<NN>-<phase>.prof   cProfile stats of the phase
+#                                           (pstats.Stats() takes several
+#                                           of them to merge phases)
+#   <name>-<pid>-<time>-memory.txt          per phase: wall time, RSS
+#                                           before and after, peak RSS and
+#                                           the object types whose live
+#                                           count grew the most
+#
+# The object counts stand in for allocation sites, which python 2 does
+# not trace. They only cover the objects the garbage collector tracks
+# (containers that may hold other containers) and are taken between
+# phases, outside the cProfile stats.
+
+import os
+import gc
+import time
+import thread
+import resource
+
+import ovs.vlog
+
+vlog = ovs.vlog.Vlog("cfgprofile")
+
+# Where to write the profiles (None = no profiling unless asked for)
+profile_dir = os.environ.get("CFGD_PROFILE_DIR") or None
+
+# Object types listed per phase in the memory report
+TOP_TYPES = 25
+
+# Active profilers, by thread
+_profilers = {}
+
+
+def _rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, ValueError, IndexError):
+        return 0
+    return pages * resource.getpagesize() // 1024
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _type_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        cls = type(obj)
+        name = "%s.%s" % (cls.__module__, cls.__name__)
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+class Profiler(object):
+    '''
+    cProfile and memory profile of one thread, split in phases.
+    '''
+    def __init__(self, name, directory):
+        self.prefix = os.path.join(directory, "%s-%d-%s" % (
+            name, os.getpid(), time.strftime("%Y%m%d%H%M%S")))
+        self.n_phases = 0
+        self.report = None
+        self._phase = None
+        self._start = None
+        self._rss = None
+        self._counts = None
+        self._profile = None
+
+    def start(self, phase="start"):
+        self.report = open("%s-memory.txt" % self.prefix, "w")
+        self._begin(phase)
+
+    def _begin(self, phase):
+        # Not imported up front, cfgdbutil loads this module on every run
+        import cProfile
+
+        self._phase = phase
+        self._counts = _type_counts()
+        self._rss = _rss_kb()
+        self._start = time.time()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def _end(self):
+        self._profile.disable()
+        wall = time.time() - self._start
+        rss = _rss_kb()
+
+        self.n_phases += 1
+        self._profile.dump_stats("%s-%02d-%s.prof" % (
+            self.prefix, self.n_phases, self._phase))
+        self._profile = None
+
+        counts = _type_counts()
+        growth = [(count - self._counts.get(name, 0), name)
+                  for name, count in counts.iteritems()]
+        growth.sort(reverse=True)
+
+        self.report.write("phase %02d %s: %.3f sec, rss %d -> %d kB, "
+                          "peak %d kB\n" % (self.n_phases, self._phase,
+                                            wall, self._rss, rss,
+                                            _peak_rss_kb()))
+        for delta, name in growth[:TOP_TYPES]:
+            if delta <= 0:
+                break
+            self.report.write("    %+10d %10d %s\n"
+                              % (delta, counts[name], name))
+        self.report.flush()
+        self._counts = None
+
+    def phase(self, phase):
+        self._end()
+        self._begin(phase)
+
+    def stop(self):
+        self._end()
+        self.report.close()
+
+
+def start(name, directory=None, phase="start"):
+    '''
+    Start profiling the calling thread, as name, if a profile directory
+    is given or set in $CFGD_PROFILE_DIR. Returns the Profiler, or None.
+    '''
+    if directory is None:
+        directory = profile_dir
+    if not directory:
+        return None
+
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        profiler = Profiler(name, directory)
+        profiler.start(phase)
+    except (IOError, OSError), e:
+        vlog.warn("Unable to profile %s in %s: %s" % (name, directory, e))
+        return None
+
+    _profilers[thread.get_ident()] = profiler
+    return profiler
+
+
+def phase(name):
+    '''
+    Start a new phase of the calling thread's profile, if it has one.
+    '''
+    profiler = _profilers.get(thread.get_ident())
+    if profiler is not None:
+        profiler.phase(name)
+
+
+def stop():
+    '''
+    Stop profiling the calling thread and write its last phase.
+    '''
+    profiler = _profilers.pop(thread.get_ident(), None)
+    if profiler is not None:
+        profiler.stop()
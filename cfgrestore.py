@@ -0,0 +1,1311 @@
+# (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Batched restore of a saved configuration into the running db.
+#
+# The saved config is the json document produced by ops.dc.read():
+#   - top level keys are the tables that are not children of another
+#     table. A table limited to one row (System) holds that row directly,
+#     any other table holds a dict of index -> row.
+#   - a row holds its configuration columns by name.
+#   - a reference column with a "child" relation holds the child rows as
+#     a dict of index (or map key) -> row.
+#   - children that point back to their parent are held in a dict named
+#     after the child table.
+#   - any other reference column holds the index (or list/dict of
+#     indexes) of the referenced row(s).
+#
+# Rather than one transaction for the whole config, the restore is done
+# in three phases of transactions of at most batch_size rows:
+#   1. rows are inserted or updated with their plain columns, parents
+#      before children. A new row of a non root table is added to the
+#      column of the row that keeps it alive (its "anchor") in the same
+#      transaction so it is not garbage collected, and is inserted with
+#      its references that can not be empty (to its parent, say), after
+#      the rows they point to.
+#   2. once every row exists, reference columns are set to their final
+#      value. Rows no longer referenced are garbage collected by the db.
+#   3. rows of the root tables the saved config has rows of, that are
+#      neither saved nor referred to by the saved config, are deleted.
+#      Tables the saved config has no row of at all are left alone.
+# The next batch is prepared while the previous one is being committed.
+#
+# In only_changed mode the saved rows are diffed against the running db
+# first; rows and columns that already match are not written at all.
+#
+# A db that only has to hold the saved config (the scratch db "show
+# startup-config cli" renders from) is rather filled by replace_db(): the
+# rows are flattened against the schema alone (SchemaReplica) and written
+# in a single transaction, referring to each other by named-uuid, with no
+# idl at all.
+#
+# write_direct() restores into the running db the same way, without an
+# idl: the config columns of the db are read with one transaction
+# (cfgsnapshot.read_snapshot()) to match the saved rows against, and the
+# inserts and updates are sent in a second one. That transaction only
+# goes through if the rows of the config tables are still the ones read,
+# otherwise it is built again from a new read.
+#
+# A restore plan (compile_plan()) is that transaction worked out ahead of
+# time, when the config is saved: the rows to write in json, referring to
+# each other by name, each with the index values it is looked up by. It
+# is run by execute_plan() with no schema and no RestorePlan at all: the
+# rows it looks up are read with one transaction, the ones found are
+# updated and the others inserted.
+
+import urllib
+import uuid
+
+import ovs.db.data
+import ovs.db.error
+import ovs.db.idl
+import ovs.db.types
+import ovs.poller
+import ovs.timeval
+import ovs.vlog
+
+import cfgdb
+
+vlog = ovs.vlog.Vlog("cfgrestore")
+
+# Default maximum number of rows written per transaction
+DEFAULT_BATCH_SIZE = 500
+
+# Max time to wait for the idl to see the rows inserted by a batch
+REPLICA_WAIT_MSEC = 10000
+
+# Times write_direct() reads the db again when it changed under it
+DIRECT_ATTEMPTS = 3
+
+# extschema (opslib.restparser) reference relations
+RELATION_CHILD = "child"
+RELATION_PARENT = "parent"
+
+SUCCESS_STATUS = [ovs.db.idl.Transaction.SUCCESS,
+                  ovs.db.idl.Transaction.UNCHANGED]
+
+
+def _row_to_uuid(value):
+    if isinstance(value, ovs.db.idl.Row):
+        return value.uuid
+    return value
+
+
+def _ref_rows(value):
+    '''
+    Returns the (key, Row) pairs held by a reference column value as
+    returned by the idl. key is None unless the column is a map.
+    '''
+    if isinstance(value, dict):
+        return value.items()
+    elif isinstance(value, list):
+        return [(None, row) for row in value]
+    elif value is None:
+        return []
+    return [(None, value)]
+
+
+def _coerce_atom(base, value):
+    '''
+    Saved configs may hold numbers and booleans as strings; convert them
+    to what the column type expects.
+    '''
+    if isinstance(value, basestring):
+        if base.type == ovs.db.types.IntegerType:
+            return int(value)
+        elif base.type == ovs.db.types.RealType:
+            return float(value)
+        elif base.type == ovs.db.types.BooleanType:
+            return value.lower() == "true"
+    return value
+
+
+def _coerce(type_, value):
+    if isinstance(value, dict):
+        return dict((_coerce_atom(type_.key, k),
+                     _coerce_atom(type_.value, v))
+                    for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [_coerce_atom(type_.key, v) for v in value]
+    return _coerce_atom(type_.key, value)
+
+
+def _index_string(values):
+    '''
+    Index of a row as used for keys in the saved config: the value of a
+    single index column, or the url quoted values joined by '/'.
+    '''
+    if len(values) == 1:
+        return unicode(values[0])
+    return "/".join(urllib.quote(unicode(v).encode('utf-8'), safe='')
+                    for v in values)
+
+
+def _named_uuids(json, named):
+    '''
+    Replace the placeholder uuids (keys of named) of a datum in json form
+    by named-uuids.
+    '''
+    if isinstance(json, list):
+        if len(json) == 2 and json[0] == "uuid" and json[1] in named:
+            return ["named-uuid", named[json[1]]]
+        return [_named_uuids(item, named) for item in json]
+    return json
+
+
+class SchemaReplica(object):
+    '''
+    Stand-in for the replica of an idl on an empty db, built from the db
+    schema (ovs.db.schema.DbSchema) alone, so a RestorePlan can flatten a
+    saved config without connecting to the db.
+    '''
+    def __init__(self, schema):
+        self.name = schema.name
+        self.tables = schema.tables
+        for table in self.tables.itervalues():
+            table.rows = {}
+
+
+class SavedRow(object):
+    '''
+    One row of the saved config, flattened out of the nested document.
+    '''
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        # plain (non reference) columns
+        self.columns = {}
+        # reference column -> saved value (index, list or dict of indexes)
+        self.references = {}
+        # child column -> list of (map key or None, SavedRow)
+        self.children = {}
+        # back pointer column -> parent SavedRow
+        self.parents = {}
+        # (SavedRow, column, map key) keeping a new non root row alive
+        self.anchor = None
+        # matching row in the running db (ovs.db.idl.Row), if any
+        self.row = None
+        # provisional row while it is being inserted
+        self.new_row = None
+        # running db row referred to by the saved config but not saved
+        self.external = False
+        # plain columns to write, once computed
+        self.plain = None
+
+
+class RestorePlan(object):
+    '''
+    Flattened saved config matched against the running db replica of an
+    ops.dc idl, split in batches of rows to write.
+    '''
+    def __init__(self, extschema, idl, only_changed=False):
+        self.extschema = extschema
+        self.idl = idl
+        self.only_changed = only_changed
+        self.rows = []
+        self.by_index = {}
+        # rows of the running db to delete (ovs.db.idl.Row)
+        self.deleted = []
+        self._back_refs = {}
+        self._running = {}
+        self._written = set()
+
+    ###################  Flattening the saved config ###############
+    def load(self, data):
+        for table_name, value in data.iteritems():
+            if table_name not in self.idl.tables:
+                vlog.warn("Skipping unknown table %s" % table_name)
+                continue
+
+            table = self.idl.tables[table_name]
+            if table.max_rows == 1:
+                existing = None
+                for row in table.rows.itervalues():
+                    existing = row
+                    break
+                self._add_row(table_name, None, value, existing)
+            else:
+                existing = self._index_rows(table_name,
+                                            table.rows.itervalues())
+                for index, row_data in value.iteritems():
+                    self._add_row(table_name, index, row_data,
+                                  existing.get(unicode(index)))
+
+        self._set_anchors()
+        self.deleted = self._deleted_rows(data)
+
+    def delete_tables(self, data):
+        '''
+        Returns the names of the root tables whose rows missing from the
+        saved config data are deleted: the tables it has rows of.
+        '''
+        names = set(table_name for table_name in data
+                    if table_name in self.idl.tables)
+        names.update(saved.table for saved in self.rows)
+        return sorted(table_name for table_name in names
+                      if self.idl.tables[table_name].is_root and
+                      self.idl.tables[table_name].max_rows != 1)
+
+    def _deleted_rows(self, data):
+        '''
+        Returns the rows of the delete_tables() neither matched by a saved
+        row nor referred to by one.
+        '''
+        kept = set(saved.row.uuid for saved in self.by_index.itervalues()
+                   if saved.row is not None)
+        kept.update(saved.row.uuid for saved in self.rows
+                    if saved.row is not None)
+
+        deleted = []
+        for table_name in self.delete_tables(data):
+            rows = self.idl.tables[table_name].rows
+            deleted.extend(row for row_uuid, row in sorted(rows.iteritems())
+                           if row_uuid not in kept)
+        return self._delete_order(deleted)
+
+    def _delete_order(self, rows):
+        '''
+        Returns rows in an order where a row comes before the rows it
+        refers to, which can only be deleted once nothing refers to them
+        (rows referring to each other come last).
+        '''
+        by_uuid = dict((row.uuid, row) for row in rows)
+        targets = {}
+        referrers = {}
+        for row in rows:
+            row_targets = set()
+            for column in row._table.columns.itervalues():
+                ref_base = column.type.value or column.type.key
+                if ref_base.is_ref():
+                    row_targets.update(
+                        ref.uuid for unused, ref
+                        in _ref_rows(getattr(row, column.name))
+                        if ref.uuid in by_uuid and ref.uuid != row.uuid)
+            targets[row.uuid] = row_targets
+            for target in row_targets:
+                referrers[target] = referrers.get(target, 0) + 1
+
+        ordered = [row for row in rows if not referrers.get(row.uuid)]
+        pos = 0
+        while pos < len(ordered):
+            for target in targets[ordered[pos].uuid]:
+                referrers[target] -= 1
+                if not referrers[target]:
+                    ordered.append(by_uuid[target])
+            pos += 1
+
+        ordered.extend(row for row in rows if referrers.get(row.uuid))
+        return ordered
+
+    def _index_columns(self, table_name):
+        ext_table = self.extschema.ovs_tables.get(table_name)
+        if ext_table is not None and ext_table.indexes and \
+           ext_table.indexes != ["uuid"]:
+            return ext_table.indexes
+
+        table = self.idl.tables[table_name]
+        if table.indexes:
+            return [column.name for column in table.indexes[0]]
+
+        return None
+
+    def _row_index(self, table_name, row):
+        columns = self._index_columns(table_name)
+        if columns is None:
+            return None
+
+        values = []
+        for column in columns:
+            value = getattr(row, column)
+            if isinstance(value, list):
+                value = value[0] if value else ""
+            values.append(value)
+
+        return _index_string(values)
+
+    def _index_rows(self, table_name, rows):
+        '''
+        Returns index -> Row for rows of table_name.
+        '''
+        indexed = {}
+        for row in rows:
+            index = self._row_index(table_name, row)
+            if index is not None:
+                indexed[index] = row
+        return indexed
+
+    def _existing_back_refs(self, table_name, column, parent):
+        if parent is None:
+            return {}
+
+        key = (table_name, column)
+        if key not in self._back_refs:
+            by_parent = {}
+            for row in self.idl.tables[table_name].rows.itervalues():
+                for unused, ref in _ref_rows(getattr(row, column)):
+                    by_parent.setdefault(ref.uuid, []).append(row)
+            self._back_refs[key] = by_parent
+
+        rows = self._back_refs[key].get(parent.uuid, [])
+        return self._index_rows(table_name, rows)
+
+    def _add_row(self, table_name, index, data, existing):
+        saved = SavedRow(table_name, index)
+        saved.row = existing
+        self.rows.append(saved)
+        if index is not None:
+            self.by_index[(table_name, unicode(index))] = saved
+
+        table = self.idl.tables[table_name]
+        ext_table = self.extschema.ovs_tables.get(table_name)
+        references = ext_table.references if ext_table is not None else {}
+
+        for column_name, value in data.iteritems():
+            column = table.columns.get(column_name)
+            if column is None:
+                if column_name in self.idl.tables:
+                    self._add_back_ref_children(saved, column_name, value)
+                else:
+                    vlog.warn("Skipping unknown column %s:%s"
+                              % (table_name, column_name))
+                continue
+
+            if not column.type.key.is_ref() and \
+               not (column.type.value and column.type.value.is_ref()):
+                saved.columns[column_name] = value
+                continue
+
+            reference = references.get(column_name)
+            relation = getattr(reference, "relation", None)
+            if relation == RELATION_CHILD:
+                self._add_children(saved, column_name, column, value)
+            elif relation != RELATION_PARENT:
+                saved.references[column_name] = value
+
+        return saved
+
+    def _add_children(self, saved, column_name, column, value):
+        is_map = column.type.is_map()
+        ref_base = column.type.value if is_map else column.type.key
+        child_table = ref_base.ref_table_name
+
+        existing = {}
+        if saved.row is not None:
+            current = _ref_rows(getattr(saved.row, column_name))
+            if is_map:
+                existing = dict((unicode(k), row) for k, row in current)
+            else:
+                existing = self._index_rows(child_table,
+                                            [row for unused, row in current])
+
+        children = saved.children.setdefault(column_name, [])
+        for key, child_data in value.iteritems():
+            child = self._add_row(child_table, key, child_data,
+                                  existing.get(unicode(key)))
+            if not self.idl.tables[child_table].is_root:
+                child.anchor = (saved, column_name, key if is_map else None)
+            children.append((key if is_map else None, child))
+
+    def _add_back_ref_children(self, saved, child_table, value):
+        table = self.idl.tables[child_table]
+        parent_column = None
+        for column in table.columns.itervalues():
+            if column.type.key.ref_table_name == saved.table:
+                parent_column = column.name
+                break
+
+        if parent_column is None:
+            vlog.warn("No column of %s refers to %s"
+                      % (child_table, saved.table))
+            return
+
+        existing = self._existing_back_refs(child_table, parent_column,
+                                            saved.row)
+        for index, child_data in value.iteritems():
+            child = self._add_row(child_table, index, child_data,
+                                  existing.get(unicode(index)))
+            child.parents[parent_column] = saved
+
+    def _resolve(self, table_name, index):
+        '''
+        Returns the SavedRow for index, falling back on a row of the
+        running db that is not part of the saved config.
+        '''
+        key = (table_name, unicode(index))
+        if key in self.by_index:
+            return self.by_index[key]
+
+        if table_name not in self._running:
+            self._running[table_name] = self._index_rows(
+                table_name, self.idl.tables[table_name].rows.itervalues())
+
+        row = self._running[table_name].get(unicode(index))
+        if row is None:
+            return None
+
+        saved = SavedRow(table_name, index)
+        saved.row = row
+        saved.external = True
+        self.by_index[key] = saved
+        return saved
+
+    def _is_written(self, saved):
+        return saved.external or id(saved) in self._written
+
+    def _saved_refs(self, saved, column_name):
+        '''
+        Returns the (map key or None, SavedRow) pairs a saved reference
+        column points to. Unknown indexes are logged and dropped.
+        '''
+        column = self.idl.tables[saved.table].columns[column_name]
+        is_map = column.type.is_map()
+        ref_table = (column.type.value if is_map
+                     else column.type.key).ref_table_name
+
+        value = saved.references[column_name]
+        if is_map:
+            items = value.items()
+        elif isinstance(value, list):
+            items = [(None, index) for index in value]
+        else:
+            items = [(None, value)]
+
+        refs = []
+        for key, index in items:
+            target = self._resolve(ref_table, index)
+            if target is None:
+                vlog.warn("%s:%s refers to unknown %s %s"
+                          % (saved.table, column_name, ref_table, index))
+            else:
+                refs.append((key, target))
+        return refs
+
+    def _set_anchors(self):
+        '''
+        A new row of a non root table that is not a child of another row
+        is kept alive by the first row referring to it.
+        '''
+        for saved in self.rows:
+            for column_name in saved.references:
+                for key, target in self._saved_refs(saved, column_name):
+                    if target.anchor is None and target.row is None and \
+                       not self.idl.tables[target.table].is_root and \
+                       target is not saved:
+                        target.anchor = (saved, column_name, key)
+
+    ###################  Batching ###############
+    def _required_refs(self, saved):
+        '''
+        Returns the SavedRows the reference columns of saved that can not
+        be empty (n_min of 1) point to.
+        '''
+        table = self.idl.tables[saved.table]
+        targets = [parent for column_name, parent in saved.parents.iteritems()
+                   if table.columns[column_name].type.n_min]
+        for column_name in saved.references:
+            if table.columns[column_name].type.n_min:
+                targets.extend(target for unused, target
+                               in self._saved_refs(saved, column_name))
+        return targets
+
+    def _dependencies(self, saved):
+        '''
+        Returns the new rows that have to be inserted before saved: its
+        anchor and the targets of its required references.
+        '''
+        if saved.row is not None:
+            return []
+
+        dependencies = [target for target in self._required_refs(saved)
+                        if target.row is None and target is not saved]
+        if saved.anchor is not None:
+            dependencies.append(saved.anchor[0])
+        return dependencies
+
+    def _ordered_rows(self):
+        '''
+        Returns the rows in an order where the rows a new row depends on
+        (see _dependencies()) come before it. Rows that can not be kept
+        alive, or depend on rows that are dropped, are dropped.
+        '''
+        blocked = {}
+        dependents = {}
+        ordered = []
+        for saved in self.rows:
+            if saved.row is None and saved.anchor is None and \
+               not self.idl.tables[saved.table].is_root:
+                vlog.warn("Nothing refers to %s %s, skipping it"
+                          % (saved.table, saved.index))
+                continue
+
+            dependencies = set(id(dep) for dep in self._dependencies(saved))
+            if not dependencies:
+                ordered.append(saved)
+                continue
+            blocked[id(saved)] = [saved, len(dependencies)]
+            for dep in dependencies:
+                dependents.setdefault(dep, []).append(saved)
+
+        pos = 0
+        while pos < len(ordered):
+            for saved in dependents.pop(id(ordered[pos]), []):
+                entry = blocked[id(saved)]
+                entry[1] -= 1
+                if not entry[1]:
+                    del blocked[id(saved)]
+                    ordered.append(saved)
+            pos += 1
+
+        for saved, unused in blocked.itervalues():
+            vlog.warn("Unable to anchor %s %s, skipping it"
+                      % (saved.table, saved.index))
+
+        return ordered
+
+    def batches(self, batch_size):
+        '''
+        Yields (phase, rows) with at most batch_size rows each: first the
+        rows to insert or update, then the rows with references to set,
+        then the running db rows to delete. In only_changed mode rows
+        already matching the running db are left out.
+        '''
+        ordered = self._ordered_rows()
+        self._written = set(id(saved) for saved in ordered)
+
+        rows = ordered
+        if self.only_changed:
+            rows = []
+            for saved in ordered:
+                saved.plain = self._plain_values(saved)
+                if saved.row is None or saved.plain:
+                    rows.append(saved)
+
+        for pos in xrange(0, len(rows), batch_size):
+            yield "rows", rows[pos:pos + batch_size]
+
+        rows = [saved for saved in ordered
+                if saved.row is not None or saved.references or
+                saved.children or saved.parents]
+        if self.only_changed:
+            rows = [saved for saved in rows
+                    if self._reference_values(saved)]
+
+        for pos in xrange(0, len(rows), batch_size):
+            yield "references", rows[pos:pos + batch_size]
+
+        for pos in xrange(0, len(self.deleted), batch_size):
+            yield "deletes", self.deleted[pos:pos + batch_size]
+
+    ###################  Building transactions ###############
+    def prepare(self, phase, rows):
+        '''
+        Convert the saved values of a batch into what the idl expects.
+        This does not touch the idl so it can run while the previous
+        batch is being committed.
+        '''
+        prepared = []
+        for saved in rows:
+            values = None
+            if phase == "rows":
+                values = saved.plain
+                if values is None:
+                    values = self._plain_values(saved)
+            prepared.append((saved, values))
+        return phase, prepared
+
+    def _differs(self, row, column, value):
+        try:
+            new = ovs.db.data.Datum.from_python(column.type, value,
+                                                _row_to_uuid)
+            old = ovs.db.data.Datum.from_python(column.type,
+                                                getattr(row, column.name),
+                                                _row_to_uuid)
+        except ovs.db.error.Error:
+            return True
+        return not new == old
+
+    def _changed(self, saved, values):
+        '''
+        In only_changed mode, drop the values that already match the row
+        in the running db.
+        '''
+        if not self.only_changed or saved.row is None or \
+           saved.new_row is not None:
+            return values
+
+        table = self.idl.tables[saved.table]
+        return dict((column_name, value)
+                    for column_name, value in values.iteritems()
+                    if self._differs(saved.row, table.columns[column_name],
+                                     value))
+
+    def _plain_values(self, saved):
+        '''
+        Returns column -> value of the plain columns to write for saved.
+        Config columns missing from the saved row of an existing row go
+        back to their default.
+        '''
+        table = self.idl.tables[saved.table]
+        values = {}
+        for column_name, value in saved.columns.iteritems():
+            values[column_name] = _coerce(table.columns[column_name].type,
+                                          value)
+
+        ext_table = self.extschema.ovs_tables.get(saved.table)
+        if saved.row is not None and ext_table is not None:
+            for column_name in ext_table.config:
+                column = table.columns.get(column_name)
+                if column is None or column_name in values or \
+                   column.type.key.is_ref() or column.type.n_min != 0:
+                    continue
+                values[column_name] = {} if column.type.is_map() else []
+
+        return self._changed(saved, values)
+
+    def _ref_value(self, type_, refs):
+        '''
+        Value of a reference column from (map key or None, Row) pairs.
+        '''
+        if type_.is_map():
+            return dict((_coerce_atom(type_.key, k), row) for k, row in refs)
+        return [row for unused, row in refs]
+
+    def _reference_values(self, saved):
+        '''
+        Returns column -> value of the reference columns to write for
+        saved. References missing from the saved row of an existing row
+        are cleared; rows they kept alive get garbage collected.
+        '''
+        table = self.idl.tables[saved.table]
+        values = {}
+
+        for column_name, children in saved.children.iteritems():
+            refs = [(key, self._current_row(child))
+                    for key, child in children
+                    if self._is_written(child)]
+            values[column_name] = self._ref_value(
+                table.columns[column_name].type, refs)
+
+        for column_name in saved.references:
+            refs = [(key, self._current_row(target))
+                    for key, target in self._saved_refs(saved, column_name)
+                    if self._is_written(target)]
+            values[column_name] = self._ref_value(
+                table.columns[column_name].type, refs)
+
+        for column_name, parent in saved.parents.iteritems():
+            if self._is_written(parent):
+                values[column_name] = self._current_row(parent)
+
+        ext_table = self.extschema.ovs_tables.get(saved.table)
+        if saved.row is not None and ext_table is not None:
+            for column_name, reference in ext_table.references.iteritems():
+                column = table.columns.get(column_name)
+                if column is None or column.type.n_min != 0 or \
+                   getattr(reference, "relation", None) == \
+                   RELATION_PARENT or column_name in values:
+                    continue
+                values[column_name] = {} if column.type.is_map() else []
+
+        return self._changed(saved, values)
+
+    def _current_row(self, saved):
+        if saved.new_row is not None:
+            return saved.new_row
+        return saved.row
+
+    def _required_values(self, saved):
+        '''
+        Returns column -> value of the reference columns of a new row
+        that can not be empty, which it has to be inserted with.
+        '''
+        table = self.idl.tables[saved.table]
+        return dict((column_name, value) for column_name, value
+                    in self._reference_values(saved).iteritems()
+                    if table.columns[column_name].type.n_min)
+
+    def apply(self, txn, prepared):
+        phase, prepared = prepared
+        pending_anchors = {}
+
+        if phase == "deletes":
+            for row, unused in prepared:
+                row.delete()
+            return
+
+        for saved, values in prepared:
+            table = self.idl.tables[saved.table]
+            if phase == "rows":
+                if saved.row is None:
+                    saved.new_row = txn.insert(table)
+                    if saved.anchor is not None:
+                        anchor, column_name, key = saved.anchor
+                        self._add_to_anchor(pending_anchors, anchor,
+                                            column_name, key, saved.new_row)
+                    values = dict(values)
+                    values.update(self._required_values(saved))
+            else:
+                values = self._reference_values(saved)
+
+            row = self._current_row(saved)
+            for column_name, value in values.iteritems():
+                setattr(row, column_name, value)
+
+        for (anchor, column_name), value in pending_anchors.itervalues():
+            setattr(self._current_row(anchor), column_name, value)
+
+    def _row_json(self, saved, named):
+        '''
+        Returns the json of the columns to write for saved, references to
+        the rows in named (uuid string -> name) as named-uuids.
+        '''
+        table = self.idl.tables[saved.table]
+        values = self._plain_values(saved)
+        values.update(self._reference_values(saved))
+
+        row = {}
+        for column_name, value in values.iteritems():
+            try:
+                datum = ovs.db.data.Datum.from_python(
+                    table.columns[column_name].type, value, _row_to_uuid)
+            except ovs.db.error.Error, e:
+                vlog.warn("Skipping invalid %s:%s: %s"
+                          % (saved.table, column_name, e))
+                continue
+            row[column_name] = _named_uuids(datum.to_json(), named)
+        return row
+
+    def _name_rows(self, rows):
+        '''
+        Returns uuid string -> name for rows, giving the rows to insert a
+        placeholder uuid.
+        '''
+        named = {}
+        for saved in rows:
+            if saved.row is None:
+                saved.new_row = uuid.uuid4()
+                named[str(saved.new_row)] = "row%d" % len(named)
+            else:
+                named[str(saved.row.uuid)] = "row%d" % len(named)
+        return named
+
+    def transact_operations(self):
+        '''
+        Returns the operations writing every saved row with all its
+        columns in a single transaction: new rows are inserted, referring
+        to each other by named-uuid, rows matched in the replica are
+        updated by uuid and the deleted rows are deleted by uuid. In
+        only_changed mode the columns (and rows) that already match the
+        replica are left out.
+        '''
+        ordered = self._ordered_rows()
+        self._written = set(id(saved) for saved in ordered)
+
+        # Placeholder uuids stand for the new rows until the values are
+        # converted to json
+        named = self._name_rows([saved for saved in ordered
+                                 if saved.row is None])
+
+        operations = []
+        for saved in ordered:
+            row = self._row_json(saved, named)
+            if saved.row is None:
+                operations.append({"op": "insert",
+                                   "table": saved.table,
+                                   "row": row,
+                                   "uuid-name": named[str(saved.new_row)]})
+            elif row:
+                operations.append({"op": "update",
+                                   "table": saved.table,
+                                   "where": [["_uuid", "==",
+                                              ["uuid", str(saved.row.uuid)]]],
+                                   "row": row})
+
+        for row in self.deleted:
+            operations.append({"op": "delete",
+                               "table": row._table.name,
+                               "where": [["_uuid", "==",
+                                          ["uuid", str(row.uuid)]]]})
+
+        return operations
+
+    def _match(self, saved, named):
+        '''
+        Returns the conditions (on its index columns) saved is looked up
+        by in the db it is restored to: [] for the only row of its table,
+        None if it is always inserted.
+        '''
+        if saved.row is None:
+            return None
+
+        table = self.idl.tables[saved.table]
+        if table.max_rows == 1:
+            return []
+
+        columns = self._index_columns(saved.table)
+        if columns is None:
+            return None
+
+        match = []
+        for column_name in columns:
+            column = table.columns[column_name]
+            datum = ovs.db.data.Datum.from_python(
+                column.type, getattr(saved.row, column_name), _row_to_uuid)
+            match.append([column_name, "==",
+                          _named_uuids(datum.to_json(), named)])
+        return match
+
+    def plan_rows(self):
+        '''
+        Returns the rows of a restore plan (see compile_plan()) of a
+        saved config read from the replica, as dicts of:
+          - table, name: the row is referred to as ["named-uuid", name]
+          - match: how to look the row up (see _match())
+          - row: the json of its columns, None for a row that is referred
+            to but not saved, and has to be found.
+        Rows come in the order they are looked up in: the rows that are
+        not saved, then parents before children.
+        '''
+        ordered = self._ordered_rows()
+        self._written = set(id(saved) for saved in ordered)
+        external = [saved for key, saved in sorted(self.by_index.iteritems())
+                    if saved.external]
+
+        rows = external + ordered
+        named = self._name_rows(rows)
+
+        # A lookup matching several saved rows would be ambiguous, they
+        # are inserted (old rows of non root tables get garbage collected)
+        matches = [self._match(saved, named) for saved in rows]
+        keys = {}
+        for saved, match in zip(rows, matches):
+            if match:
+                key = (saved.table, repr(match))
+                keys[key] = keys.get(key, 0) + 1
+
+        plan_rows = []
+        for saved, match in zip(rows, matches):
+            if match and keys[(saved.table, repr(match))] > 1:
+                match = None
+            current = saved.row if saved.row is not None else saved.new_row
+            plan_rows.append({"table": saved.table,
+                              "name": named[str(_row_to_uuid(current))],
+                              "match": match,
+                              "row": (None if saved.external
+                                      else self._row_json(saved, named))})
+        return plan_rows
+
+    def _add_to_anchor(self, pending, anchor, column_name, key, row):
+        pending_key = (id(anchor), column_name)
+        if pending_key not in pending:
+            anchor_row = self._current_row(anchor)
+            value = {} if key is not None else []
+            if anchor.new_row is None:
+                current = getattr(anchor_row, column_name)
+                value = (dict(current) if key is not None
+                         else [r for unused, r in _ref_rows(current)])
+            pending[pending_key] = ((anchor, column_name), value)
+
+        value = pending[pending_key][1]
+        if key is not None:
+            column = self.idl.tables[anchor.table].columns[column_name]
+            value[_coerce_atom(column.type.key, key)] = row
+        else:
+            value.append(row)
+
+    def committed(self, txn, prepared):
+        '''
+        Record the uuids assigned to the rows inserted by a committed
+        batch. Returns the (table, uuid) pairs the idl has to catch up on.
+        '''
+        phase, prepared = prepared
+        if phase == "deletes":
+            return []
+
+        inserted = []
+        for saved, unused in prepared:
+            if saved.new_row is not None:
+                real_uuid = txn.get_insert_uuid(saved.new_row.uuid)
+                saved.new_row = None
+                if real_uuid is not None:
+                    inserted.append((saved, real_uuid))
+        return inserted
+
+
+def _wait_for_rows(idl, inserted):
+    '''
+    Run the idl until it sees the rows inserted by the last batch, so the
+    next batch can refer to them.
+    '''
+    deadline = ovs.timeval.msec() + REPLICA_WAIT_MSEC
+    while True:
+        idl.run()
+        missing = [(saved, real_uuid) for saved, real_uuid in inserted
+                   if real_uuid not in idl.tables[saved.table].rows]
+        for saved, real_uuid in inserted:
+            saved.row = idl.tables[saved.table].rows.get(real_uuid)
+        if not missing:
+            return True
+        if ovs.timeval.msec() >= deadline:
+            vlog.err("Timed out waiting for %d inserted rows" % len(missing))
+            return False
+        inserted = missing
+        poller = ovs.poller.Poller()
+        idl.wait(poller)
+        poller.timer_wait_until(deadline)
+        poller.block()
+
+
+def _prepare_next(plan, batches):
+    batch = next(batches, None)
+    if batch is None:
+        return None
+    return plan.prepare(*batch)
+
+
+def _write_single(plan, idl):
+    '''
+    Write every phase of plan in one transaction: the new rows are
+    referred to by their provisional rows, so nothing has to be read back
+    between the phases.
+    '''
+    txn = ovs.db.idl.Transaction(idl)
+    batch_size = max(1, len(plan.rows), len(plan.deleted))
+    for batch in plan.batches(batch_size):
+        plan.apply(txn, plan.prepare(*batch))
+
+    status = txn.commit_block()
+    if status not in SUCCESS_STATUS:
+        vlog.err("Restore failed: %s"
+                 % ovs.db.idl.Transaction.status_to_string(status))
+    return status
+
+
+def write_batched(data, extschema, idl, batch_size=DEFAULT_BATCH_SIZE,
+                  only_changed=False):
+    '''
+    Write a saved config to the running db through an ops.dc idl (synced
+    with the running db) in transactions of at most batch_size rows
+    (0 for a single transaction).
+
+    With only_changed, the saved config is diffed against the running db
+    and only the rows and columns that differ are written (and the rows
+    it does not hold deleted), so restoring a nearly identical config
+    costs in proportion to the changes.
+
+    Returns SUCCESS if anything was written, UNCHANGED if not, or the
+    status of the first transaction that failed.
+    '''
+    plan = RestorePlan(extschema, idl, only_changed)
+    plan.load(data)
+
+    if batch_size <= 0:
+        return _write_single(plan, idl)
+
+    changed = False
+    batches = plan.batches(batch_size)
+    current = _prepare_next(plan, batches)
+
+    while current is not None:
+        txn = ovs.db.idl.Transaction(idl)
+        plan.apply(txn, current)
+        status = txn.commit()
+
+        # Prepare the next batch while this one is being committed
+        upcoming = _prepare_next(plan, batches)
+
+        if status == ovs.db.idl.Transaction.INCOMPLETE:
+            status = txn.commit_block()
+
+        if status not in SUCCESS_STATUS:
+            vlog.err("Restore batch failed: %s"
+                     % ovs.db.idl.Transaction.status_to_string(status))
+            return status
+
+        changed = changed or status == ovs.db.idl.Transaction.SUCCESS
+        if not _wait_for_rows(idl, plan.committed(txn, current)):
+            return ovs.db.idl.Transaction.ERROR
+
+        current = upcoming
+
+    if changed:
+        return ovs.db.idl.Transaction.SUCCESS
+    return ovs.db.idl.Transaction.UNCHANGED
+
+
+def replace_db(data, extschema, schema, remote):
+    '''
+    Replace the whole content of the db at remote (described by schema,
+    an ovs.db.schema.DbSchema) by a saved config, in a single transaction
+    built in process from the saved config and the schemas, without an
+    idl.
+
+    Returns SUCCESS or ERROR.
+    '''
+    plan = RestorePlan(extschema, SchemaReplica(schema))
+    plan.load(data)
+
+    # Rows of non root tables go away with the root rows referring to them
+    operations = [{"op": "delete", "table": table_name, "where": []}
+                  for table_name, table in sorted(schema.tables.iteritems())
+                  if table.is_root]
+    operations.extend(plan.transact_operations())
+
+    try:
+        cfgdb.transact(remote, schema.name, operations)
+    except ovs.db.error.Error, e:
+        vlog.err("Unable to write the config to %s: %s" % (remote, e))
+        return ovs.db.idl.Transaction.ERROR
+
+    return ovs.db.idl.Transaction.SUCCESS
+
+
+def _unchanged_operations(tables):
+    '''
+    Returns the operations failing the transaction if the rows of tables
+    (table name -> (names of the columns read, rows read in json, with
+    their _uuid and those columns)) changed since they were read: rows
+    added or deleted, or a column read that has another value.
+    '''
+    return [{"op": "wait",
+             "table": table_name,
+             "timeout": 0,
+             "where": [],
+             "columns": ["_uuid"] + list(column_names),
+             "until": "==",
+             "rows": rows}
+            for table_name, (column_names, rows)
+            in sorted(tables.iteritems())]
+
+
+def _replica_rows(replica):
+    '''
+    The rows of a SchemaReplica in the form _unchanged_operations() takes.
+    '''
+    tables = {}
+    for table_name, table in replica.tables.iteritems():
+        column_names = sorted(table.columns)
+        rows = []
+        for row in table.rows.itervalues():
+            row_json = {"_uuid": ["uuid", str(row.uuid)]}
+            for column_name in column_names:
+                row_json[column_name] = row._data[column_name].to_json()
+            rows.append(row_json)
+        tables[table_name] = (column_names, rows)
+    return tables
+
+
+def _timed_out(e):
+    results = e.json if isinstance(e.json, list) else []
+    return any(isinstance(result, dict) and
+               result.get("error") == "timed out" for result in results)
+
+
+def write_direct(data, extschema, ovsschema, remote, only_changed=False):
+    '''
+    Write a saved config to the db at remote (ovsschema is the path of
+    its schema, or the schema in json, see cfgsnapshot.read_snapshot())
+    in a single transaction of operations built in process, without an
+    idl (see the comment at the top of this module).
+
+    Returns SUCCESS, UNCHANGED or ERROR.
+    '''
+    import cfgsnapshot
+
+    for attempt in xrange(DIRECT_ATTEMPTS):
+        try:
+            replica = cfgsnapshot.read_snapshot(extschema, ovsschema, remote)
+        except ovs.db.error.Error, e:
+            vlog.err("Unable to read the config of %s: %s" % (remote, e))
+            return ovs.db.idl.Transaction.ERROR
+
+        read = _replica_rows(replica)
+        plan = RestorePlan(extschema, replica, only_changed)
+        plan.load(data)
+        operations = plan.transact_operations()
+        if not operations:
+            return ovs.db.idl.Transaction.UNCHANGED
+
+        try:
+            cfgdb.transact(remote, replica.name,
+                           _unchanged_operations(read) + operations)
+        except ovs.db.error.Error, e:
+            if _timed_out(e):
+                vlog.info("%s changed while writing the config, "
+                          "trying again" % remote)
+                continue
+            vlog.err("Unable to write the config to %s: %s" % (remote, e))
+            return ovs.db.idl.Transaction.ERROR
+
+        return ovs.db.idl.Transaction.SUCCESS
+
+    vlog.err("%s kept changing, config not written" % remote)
+    return ovs.db.idl.Transaction.ERROR
+
+
+def compile_plan(data, extschema, replica, fingerprint):
+    '''
+    Returns the restore plan of a saved config, read from replica (an idl
+    or a cfgsnapshot replica of the running db): a json document holding
+    cfgdb.PLAN_VERSION, the fingerprint of the schemas it was compiled with
+    (see cfgschema.schema_fingerprint()), its rows (see
+    RestorePlan.plan_rows()) and the tables whose other rows are deleted
+    (see RestorePlan.delete_tables()).
+    '''
+    plan = RestorePlan(extschema, replica)
+    plan.load(data)
+
+    return {"version": cfgdb.PLAN_VERSION,
+            "schema": fingerprint,
+            "rows": plan.plan_rows(),
+            "delete": plan.delete_tables(data)}
+
+
+def _resolve_names(json, names):
+    '''
+    Replace the named-uuids of the rows found in the db (keys of names) by
+    their uuids, in a datum or a row in json form.
+    '''
+    if isinstance(json, list):
+        if len(json) == 2 and json[0] == "named-uuid" and json[1] in names:
+            return ["uuid", names[json[1]]]
+        return [_resolve_names(item, names) for item in json]
+    if isinstance(json, dict):
+        return dict((key, _resolve_names(value, names))
+                    for key, value in json.iteritems())
+    return json
+
+
+def _datum_key(json):
+    '''
+    Returns a form of a datum in json form that is the same for equal
+    datums, however the db server orders its atoms: set and map atoms are
+    sorted and a set of one atom is that atom.
+    '''
+    if isinstance(json, list) and len(json) == 2:
+        if json[0] == "set":
+            atoms = sorted(_datum_key(atom) for atom in json[1])
+            if len(atoms) == 1:
+                return atoms[0]
+            return ("set", tuple(atoms))
+        if json[0] == "map":
+            return ("map", tuple(sorted((_datum_key(key), _datum_key(value))
+                                        for key, value in json[1])))
+        return tuple(json)
+    return json
+
+
+def _plan_operations(plan, db_name, remote):
+    '''
+    Returns the operations running a restore plan on the db at remote
+    (see execute_plan()), or None if a row it refers to is not there.
+    '''
+    columns = dict((table_name, set()) for table_name in plan["delete"])
+    for row in plan["rows"]:
+        table_columns = columns.setdefault(row["table"], set())
+        for column_name, unused, unused in row["match"] or []:
+            table_columns.add(column_name)
+
+    table_names = sorted(columns)
+    results = cfgdb.transact(remote, db_name, [
+        {"op": "select", "table": table_name, "where": [],
+         "columns": ["_uuid"] + sorted(columns[table_name])}
+        for table_name in table_names])
+    db_rows = dict(zip(table_names,
+                       [result["rows"] for result in results]))
+
+    # Rows found, name -> uuid
+    names = {}
+    for row in plan["rows"]:
+        match = row["match"]
+        if match is not None:
+            match = [(column_name, _datum_key(value)) for column_name,
+                     unused, value in _resolve_names(match, names)]
+            for db_row in db_rows[row["table"]]:
+                if all(column_name in db_row and
+                       _datum_key(db_row[column_name]) == value
+                       for column_name, value in match):
+                    names[row["name"]] = db_row["_uuid"][1]
+                    break
+        if row["row"] is None and row["name"] not in names:
+            vlog.warn("%s row %s of the restore plan is not in the db"
+                      % (row["table"], row["name"]))
+            return None
+
+    read = dict((table_name, (sorted(columns[table_name]),
+                              db_rows[table_name]))
+                for table_name in table_names)
+    operations = _unchanged_operations(read)
+    for row in plan["rows"]:
+        if row["row"] is None:
+            continue
+        values = _resolve_names(row["row"], names)
+        if row["name"] in names:
+            operations.append({"op": "update",
+                               "table": row["table"],
+                               "where": [["_uuid", "==",
+                                          ["uuid", names[row["name"]]]]],
+                               "row": values})
+        else:
+            operations.append({"op": "insert",
+                               "table": row["table"],
+                               "row": values,
+                               "uuid-name": row["name"]})
+
+    # The rows of the plan tables that were not found are not saved
+    found = set(names.itervalues())
+    for table_name in plan["delete"]:
+        for db_row in db_rows[table_name]:
+            if db_row["_uuid"][1] not in found:
+                operations.append({"op": "delete",
+                                   "table": table_name,
+                                   "where": [["_uuid", "==",
+                                              db_row["_uuid"]]]})
+    return operations
+
+
+def execute_plan(plan, db_name, remote):
+    '''
+    Run a restore plan (see compile_plan()) on db_name at remote: the rows
+    it looks up are read with one transaction, then the rows found are
+    updated, the others inserted and the rows of its delete tables that
+    were not found deleted in a second one. The caller checks the plan
+    matches the schemas.
+
+    Returns SUCCESS, or ERROR if the plan could not be run (nothing was
+    written then).
+    '''
+    if plan.get("version") != cfgdb.PLAN_VERSION:
+        vlog.warn("Unknown restore plan version %s" % plan.get("version"))
+        return ovs.db.idl.Transaction.ERROR
+
+    for attempt in xrange(DIRECT_ATTEMPTS):
+        try:
+            operations = _plan_operations(plan, db_name, remote)
+            if operations is None:
+                return ovs.db.idl.Transaction.ERROR
+            cfgdb.transact(remote, db_name, operations)
+        except ovs.db.error.Error, e:
+            if _timed_out(e):
+                vlog.info("%s changed while running the restore plan, "
+                          "trying again" % remote)
+                continue
+            vlog.err("Unable to run the restore plan on %s: %s"
+                     % (remote, e))
+            return ovs.db.idl.Transaction.ERROR
+
+        return ovs.db.idl.Transaction.SUCCESS
+
+    vlog.err("%s kept changing, restore plan not run" % remote)
+    return ovs.db.idl.Transaction.ERROR
@@ -0,0 +1,196 @@
+# (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+
+import ovs.vlog
+
+vlog = ovs.vlog.Vlog("cfgschema")
+
+# OPS_TODO: Need to pull this from the build env
+cache_dir = os.environ.get("CFGD_SCHEMA_CACHE_DIR",
+                           "/var/local/openvswitch/cache")
+
+# Bump when the layout of the cache file changes
+CACHE_VERSION = 1
+
+# Parsed schemas already loaded by this process, keyed like the disk cache
+_loaded = {}
+
+
+def _schema_key(path):
+    '''
+    Build the cache key for a schema file: its real path, size, mtime and
+    a hash of its content. Any change to the file changes the key.
+    '''
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+
+    return (CACHE_VERSION, path, st.st_size, int(st.st_mtime), digest)
+
+
+def _cache_file(path):
+    name = hashlib.sha1(os.path.realpath(path)).hexdigest()
+    return os.path.join(cache_dir, "extschema-%s.pickle" % name)
+
+
+def _read_cache(cache_path, key):
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, extschema = pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+    except Exception, e:
+        vlog.warn("Ignoring unreadable schema cache %s: %s" % (cache_path, e))
+        return None
+
+    if cached_key != key:
+        return None
+
+    return extschema
+
+
+def _write_cache(cache_path, key, extschema):
+    '''
+    Write the cache atomically so a concurrent reader (cfgd and cfgdbutil
+    can run at the same time) never sees a partial file.
+    '''
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".extschema")
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((key, extschema), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except Exception, e:
+        vlog.warn("Unable to write schema cache %s: %s" % (cache_path, e))
+
+
+def load_extschema(path=None):
+    '''
+    Return the parsed extended schema for path (settings ext_schema by
+    default), using the on-disk cache when it is still valid and parsing
+    and refreshing the cache otherwise.
+
+    opsrest and the schema parser are only imported when they are needed,
+    so a warm cache costs no more than unpickling the schema.
+    '''
+    if path is None:
+        from opsrest.settings import settings
+        path = settings.get('ext_schema')
+
+    key = _schema_key(path)
+    if key in _loaded:
+        return _loaded[key]
+
+    cache_path = _cache_file(path)
+    extschema = _read_cache(cache_path, key)
+    if extschema is None:
+        from opslib import restparser
+        extschema = restparser.parseSchema(path)
+        _write_cache(cache_path, key, extschema)
+
+    _loaded[key] = extschema
+    return extschema
+
+
+def load_ovsschema_json(path=None):
+    '''
+    Return the ovs db schema at path (settings ovs_schema by default) in
+    json, which ovs.db.idl.SchemaHelper and load_ovsschema() take too.
+    '''
+    import ovs.json
+
+    if path is None:
+        from opsrest.settings import settings
+        path = settings.get('ovs_schema')
+
+    return ovs.json.from_file(path)
+
+
+def load_ovsschema(path=None, schema_json=None):
+    '''
+    Return the ovs db schema (ovs.db.schema.DbSchema) at path (settings
+    ovs_schema by default), or of schema_json if given.
+    '''
+    import ovs.db.schema
+
+    if schema_json is None:
+        schema_json = load_ovsschema_json(path)
+
+    return ovs.db.schema.DbSchema.from_json(schema_json)
+
+
+def schema_fingerprint(ovsschema=None, ext_schema=None):
+    '''
+    Returns an id of the content of the ovs schema and of the extended
+    schema at the given paths (settings ovs_schema and ext_schema by
+    default), which anything built from both schemas is only valid for.
+    '''
+    if ovsschema is None or ext_schema is None:
+        from opsrest.settings import settings
+        ovsschema = ovsschema or settings.get('ovs_schema')
+        ext_schema = ext_schema or settings.get('ext_schema')
+
+    digests = [_schema_key(path)[-1] for path in [ovsschema, ext_schema]]
+    return hashlib.sha1(":".join(digests)).hexdigest()
+
+
+def config_columns(extschema):
+    '''
+    Returns the columns saving and restoring configs use, as a dict of
+    table name to column names: for each table of the extended schema,
+    its configuration columns, its references and its index columns
+    (the keys references are resolved with). Status and statistics
+    columns are left out.
+    '''
+    columns = {}
+    for table_name, table in extschema.ovs_tables.iteritems():
+        names = set(table.config) | set(table.references)
+        # Columns whose category depends on the value of another one
+        names.update(getattr(table, "dynamic", {}))
+        names.update(column for column in table.indexes if column != "uuid")
+        if names:
+            columns[table_name] = sorted(names)
+
+    return columns
+
+
+def register_config_columns(schema_helper, extschema):
+    '''
+    Register the config_columns() of extschema with schema_helper.
+    '''
+    for table_name, names in config_columns(extschema).iteritems():
+        schema_helper.register_columns(table_name, names)
+
+
+def register_config_idl(extschema, ovsschema, remote, system_columns=None):
+    '''
+    Like ops.dc.register(), returns an idl for the db at remote, but
+    only replicating the config_columns() of extschema (and the
+    system_columns of the System table, if given).
+    '''
+    import ovs.db.idl
+
+    schema_helper = ovs.db.idl.SchemaHelper(location=ovsschema)
+    register_config_columns(schema_helper, extschema)
+    if system_columns:
+        schema_helper.register_columns("System", system_columns)
+
+    return ovs.db.idl.Idl(remote, schema_helper)
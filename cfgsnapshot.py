@@ -0,0 +1,94 @@
+# (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# One shot read of the running config, without an idl.
+#
+# An idl opened only to save the config once monitors every config
+# column, keeps a replica it tracks changes in, and has to be run until
+# its first update arrives. Here the config_columns() of every table are
+# rather read with a single transaction of "select" operations, which
+# also makes the read a consistent snapshot of the db.
+#
+# The rows of the reply are turned into ovs.db.idl.Row objects of a
+# SchemaReplica, one table at a time (dropping the json of each table
+# once it is converted), so ops.dc.read() builds the saved config from
+# them exactly as it would from an idl replica.
+
+import ovs.db.data
+import ovs.db.idl
+import ovs.ovsuuid
+import ovs.vlog
+
+import cfgdb
+import cfgrestore
+import cfgschema
+
+vlog = ovs.vlog.Vlog("cfgsnapshot")
+
+
+def select_operations(columns):
+    '''
+    The "select" operations reading columns (a dict of table name to
+    column names) of every row, in table name order.
+    '''
+    return [{"op": "select", "table": table_name, "where": [],
+             "columns": ["_uuid"] + list(names)}
+            for table_name, names in sorted(columns.iteritems())]
+
+
+def _row(replica, table, uuid, row_json):
+    '''
+    The ovs.db.idl.Row of a selected row, as an idl would replicate it.
+    '''
+    data = {}
+    for name, column in table.columns.iteritems():
+        datum_json = row_json.get(name)
+        if datum_json is None:
+            data[name] = ovs.db.data.Datum.default(column.type)
+        else:
+            data[name] = ovs.db.data.Datum.from_json(column.type, datum_json)
+
+    return ovs.db.idl.Row(replica, table, uuid, data)
+
+
+def read_snapshot(extschema, ovsschema, remote):
+    '''
+    Returns a SchemaReplica of the config_columns() of extschema in the
+    db at remote (ovsschema is the path of its schema, or the schema in
+    json when it is already loaded), read with one transaction.
+
+    Raises ovs.db.error.Error if the transaction fails.
+    '''
+    if isinstance(ovsschema, dict):
+        schema_helper = ovs.db.idl.SchemaHelper(schema_json=ovsschema)
+    else:
+        schema_helper = ovs.db.idl.SchemaHelper(location=ovsschema)
+    cfgschema.register_config_columns(schema_helper, extschema)
+    schema = schema_helper.get_idl_schema()
+    replica = cfgrestore.SchemaReplica(schema)
+
+    columns = cfgschema.config_columns(extschema)
+    table_names = sorted(columns)
+    results = cfgdb.transact(remote, schema.name, select_operations(columns))
+
+    for i, table_name in enumerate(table_names):
+        table = replica.tables[table_name]
+        rows = results[i].pop("rows")
+        results[i] = None
+        while rows:
+            row_json = rows.pop()
+            uuid = ovs.ovsuuid.from_json(row_json.pop("_uuid"))
+            table.rows[uuid] = _row(replica, table, uuid, row_json)
+
+    return replica
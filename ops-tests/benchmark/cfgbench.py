@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# (C) Copyright 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Scale benchmarks for saving, restoring and showing configurations.
+
+For each config size a synthetic config (interfaces and their ports,
+VLANs, ACL entries and BGP neighbors) is written to private ovsdb-server
+instances in a scratch directory, then each operation is run in a fresh
+worker process that reports its wall time, CPU time and peak RSS:
+
+    copy_running_startup   cfgdbutil copy running-config startup-config
+    copy_startup_running   cfgdbutil copy startup-config running-config
+    show_config_json       cfgdbutil show startup-config json
+    show_config_cli        cfgdbutil show startup-config cli
+    boot_push              the ops_cfgd boot push of the startup config
+    boot_push_direct       the same, with ops_cfgd --direct
+
+No switch is needed, only the ovsdb-server and ovsdb-tool binaries (from
+OVS_BINDIR or the PATH) and the vswitch, configdb and extended schemas.
+
+usage: cfgbench.py [--sizes=10,100,1000,10000,100000] [--ops=OP,...]
+                   [--output=FILE]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+
+PKGDATADIR = os.environ.get("OVS_PKGDATADIR", "/usr/share/openvswitch")
+OVS_SCHEMA = "%s/vswitch.ovsschema" % PKGDATADIR
+CFGDB_SCHEMA = "%s/configdb.ovsschema" % PKGDATADIR
+
+OPERATIONS = ["copy_running_startup", "copy_startup_running",
+              "show_config_json", "show_config_cli", "boot_push",
+              "boot_push_direct"]
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+
+# Entries per ACL, VLAN ids available
+ACES_PER_ACL = 1000
+MAX_VLANS = 4093
+
+# Max time for one worker (seconds)
+WORKER_TIMEOUT = 3600
+
+RESULT_TAG = "CFGBENCH "
+
+
+#####################  Synthetic configs ######################
+
+def _neighbor_ip(i):
+    return "10.%d.%d.%d" % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+def generate_config(rows):
+    '''
+    Returns a synthetic config of about rows rows, in the format of
+    ops.dc.read(), spread over interfaces (with their ports), VLANs, ACL
+    entries and BGP neighbors. VLANs are capped by the VLAN id range, ACL
+    entries take what is left.
+    '''
+    share = max(1, rows // 4)
+
+    interfaces = {}
+    ports = {}
+    for i in xrange(1, max(1, share // 2) + 1):
+        name = str(i)
+        interfaces[name] = {"name": name,
+                            "user_config": {"admin": "up"}}
+        ports[name] = {"name": name,
+                       "admin": "up",
+                       "interfaces": [name]}
+
+    vlans = {}
+    for vid in xrange(2, min(share, MAX_VLANS) + 2):
+        vlans[str(vid)] = {"id": vid,
+                           "name": "VLAN%d" % vid,
+                           "admin": "up"}
+
+    neighbors = {}
+    for i in xrange(1, share + 1):
+        neighbors[_neighbor_ip(i)] = {"remote_as": 65001 + i % 1000,
+                                      "description": "peer %d" % i}
+
+    n_aces = max(share, rows - 2 * len(ports) - len(vlans) - len(neighbors))
+    acls = {}
+    for first in xrange(0, n_aces, ACES_PER_ACL):
+        name = "acl%d" % (first // ACES_PER_ACL)
+        aces = {}
+        for seq in xrange(first, min(n_aces, first + ACES_PER_ACL)):
+            aces[str((seq - first + 1) * 10)] = {
+                "action": "permit",
+                "protocol": 6,
+                "src_ip": "10.0.0.0/255.0.0.0",
+                "dst_ip": "any",
+                "dst_l4_port_min": seq % 65535 + 1,
+                "dst_l4_port_max": seq % 65535 + 1}
+        acls["%s/ipv4" % name] = {"name": name,
+                                  "list_type": "ipv4",
+                                  "cfg_aces": aces}
+
+    port_names = sorted(ports)
+    return {
+        "System": {
+            "hostname": "bench",
+            "bridges": {
+                "bridge_normal": {"name": "bridge_normal",
+                                  "vlans": vlans,
+                                  "ports": port_names}},
+            "vrfs": {
+                "vrf_default": {"name": "vrf_default",
+                                "ports": port_names,
+                                "bgp_routers": {
+                                    "65000": {"router_id": "1.1.1.1",
+                                              "bgp_neighbors": neighbors}}}}},
+        "Interface": interfaces,
+        "Port": ports,
+        "ACL": acls}
+
+
+def count_rows(config):
+    '''
+    Number of rows of a config from generate_config().
+    '''
+    system = config["System"]
+    bridge = system["bridges"]["bridge_normal"]
+    vrf = system["vrfs"]["vrf_default"]
+    routers = vrf["bgp_routers"]
+
+    rows = 3 + len(routers)
+    rows += len(config["Interface"]) + len(config["Port"])
+    rows += len(bridge["vlans"])
+    rows += sum(len(router["bgp_neighbors"])
+                for router in routers.itervalues())
+    rows += sum(1 + len(acl["cfg_aces"])
+                for acl in config["ACL"].itervalues())
+    return rows
+
+
+#####################  Db servers ######################
+
+def _binary(name):
+    for directory in [os.environ.get("OVS_BINDIR")] + \
+            os.environ.get("PATH", "").split(os.pathsep):
+        if directory:
+            path = os.path.join(directory, name)
+            if os.access(path, os.X_OK):
+                return path
+    return None
+
+
+def missing_requirements():
+    '''
+    Returns what is missing to run the benchmarks (empty if nothing).
+    '''
+    missing = [name for name in ["ovsdb-server", "ovsdb-tool"]
+               if _binary(name) is None]
+    missing += [path for path in [OVS_SCHEMA, CFGDB_SCHEMA]
+                if not os.path.exists(path)]
+    return missing
+
+
+class DbServers(object):
+    '''
+    Private ovsdb-server instances in workdir: one serving the running
+    db and the configdb (as on the switch) and one serving the temporary
+    db "show startup-config cli" writes to.
+    '''
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.remote = "unix:%s/db.sock" % workdir
+        self.temp_remote = "unix:%s/temp.sock" % workdir
+        self._ctls = []
+
+    def _start(self, name, dbs):
+        dbfiles = []
+        for dbname, schema in dbs:
+            dbfile = os.path.join(self.workdir, dbname)
+            subprocess.check_call([_binary("ovsdb-tool"), "create",
+                                   dbfile, schema])
+            dbfiles.append(dbfile)
+
+        ctl = os.path.join(self.workdir, "%s.ctl" % name)
+        subprocess.check_call([_binary("ovsdb-server"),
+                               "--remote=punix:%s/%s.sock"
+                               % (self.workdir, name),
+                               "--unixctl=%s" % ctl,
+                               "--pidfile=%s/%s.pid" % (self.workdir, name),
+                               "--detach", "--no-chdir"] + dbfiles)
+        self._ctls.append(ctl)
+
+    def start(self):
+        self._start("db", [("ovsdb.db", OVS_SCHEMA),
+                           ("config.db", CFGDB_SCHEMA)])
+        self._start("temp", [("temp.db", OVS_SCHEMA)])
+
+    def stop(self):
+        appctl = _binary("ovs-appctl")
+        for ctl in self._ctls:
+            if appctl is not None:
+                subprocess.call([appctl, "-t", ctl, "exit"])
+            else:
+                with open(ctl.replace(".ctl", ".pid")) as f:
+                    os.kill(int(f.read()), 15)
+        self._ctls = []
+
+
+#####################  Workers ######################
+
+def _configure(workdir):
+    '''
+    Point cfgdb, cfgdbutil and ops_cfgd at the private db servers.
+    '''
+    import cfgdb
+    import cfgdbutil
+    import ops_cfgd
+    from opsrest.settings import settings
+
+    remote = "unix:%s/db.sock" % workdir
+    settings['ovs_remote'] = remote
+    settings['ovs_schema'] = OVS_SCHEMA
+    cfgdb.def_db = remote
+    cfgdb.cfgdb_schema = CFGDB_SCHEMA
+    cfgdbutil.TEMPORARY_DB_SHOW_STARTUP = "unix:%s/temp.sock" % workdir
+    ops_cfgd.def_db = remote
+    ops_cfgd.cfgdb_schema = CFGDB_SCHEMA
+
+
+def _boot_push(workdir, direct=False):
+    import ops_cfgd
+
+    ops_cfgd.restore_direct = direct
+    ops_cfgd.sessions = ops_cfgd.BootSessions(ops_cfgd.def_db)
+    ops_cfgd.check_for_startup_config()
+    if ops_cfgd.saved_config is None:
+        return False
+    ops_cfgd.open_running_db()
+    ops_cfgd.prefetch_config()
+    # Done by the main loop while cfgd waits for the h/w
+    ops_cfgd.wait_for_idl_change(ops_cfgd.idl)
+    result = ops_cfgd.push_config_to_db()
+    ops_cfgd.sessions.close()
+    return result
+
+
+def _run_operation(operation, workdir, rows):
+    import cfgdbutil
+
+    if operation == "setup":
+        return cfgdbutil.write_running_config(generate_config(rows))
+    elif operation == "copy_running_startup":
+        return cfgdbutil.copy_running_startup()
+    elif operation == "copy_startup_running":
+        return cfgdbutil.copy_startup_running()
+    elif operation == "show_config_json":
+        return cfgdbutil.show_config(["startup-config", "json"])
+    elif operation == "show_config_cli":
+        return cfgdbutil.show_config(["startup-config", "cli"])
+    elif operation == "boot_push":
+        return _boot_push(workdir)
+    elif operation == "boot_push_direct":
+        return _boot_push(workdir, direct=True)
+
+    raise ValueError("Unknown operation %s" % operation)
+
+
+def worker(operation, workdir, rows):
+    '''
+    Run one operation and print its measurements. Runs in its own
+    process so the peak RSS is the operation's.
+    '''
+    sys.path.insert(0, REPO_DIR)
+    _configure(workdir)
+
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Show commands print the whole config, keep it out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start_times = os.times()
+        start = time.time()
+        ok = _run_operation(operation, workdir, rows)
+        wall = time.time() - start
+        end_times = os.times()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    result = {"operation": operation,
+              "rows": rows,
+              "ok": ok is not False,
+              "wall_sec": wall,
+              "cpu_sec": (end_times[0] - start_times[0] +
+                          end_times[1] - start_times[1]),
+              "base_rss_kb": base_rss,
+              "peak_rss_kb": usage.ru_maxrss}
+    print(RESULT_TAG + json.dumps(result))
+
+
+def _spawn_worker(operation, workdir, rows):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                             "--worker=%s" % operation,
+                             "--workdir=%s" % workdir,
+                             "--rows=%d" % rows],
+                            stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+
+    for line in output.splitlines():
+        if line.startswith(RESULT_TAG):
+            return json.loads(line[len(RESULT_TAG):])
+
+    return {"operation": operation, "rows": rows, "ok": False,
+            "error": "worker exited with %d" % proc.returncode}
+
+
+#####################  Runs ######################
+
+def run_size(rows, operations=OPERATIONS, workdir=None):
+    '''
+    Benchmark the operations on a fresh pair of db servers holding a
+    synthetic config of rows rows. Returns operation -> measurements.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix="cfgbench.", dir=workdir)
+    servers = DbServers(tmpdir)
+    servers.start()
+
+    results = {}
+    try:
+        setup = _spawn_worker("setup", tmpdir, rows)
+        if not setup["ok"]:
+            raise RuntimeError("Unable to write the %d rows config" % rows)
+
+        # The show and restore operations need a startup config
+        ops = list(operations)
+        if "copy_running_startup" not in ops:
+            _spawn_worker("copy_running_startup", tmpdir, rows)
+
+        for operation in ops:
+            results[operation] = _spawn_worker(operation, tmpdir, rows)
+    finally:
+        servers.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return results
+
+
+def print_results(results):
+    print("%-22s %8s %10s %10s %12s %4s"
+          % ("operation", "rows", "wall (s)", "cpu (s)", "peak RSS (MB)",
+             "ok"))
+    for rows in sorted(results):
+        for operation in OPERATIONS:
+            result = results[rows].get(operation)
+            if result is None:
+                continue
+            if "wall_sec" not in result:
+                print("%-22s %8d %s" % (operation, rows, result["error"]))
+                continue
+            print("%-22s %8d %10.3f %10.3f %12.1f %4s"
+                  % (operation, rows, result["wall_sec"], result["cpu_sec"],
+                     result["peak_rss_kb"] / 1024.0, result["ok"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Scale benchmarks for config save, restore and show")
+    parser.add_argument("--sizes", default=",".join(
+        str(size) for size in DEFAULT_SIZES),
+        help="comma separated config sizes, in rows")
+    parser.add_argument("--ops", default=",".join(OPERATIONS),
+                        help="comma separated operations to run")
+    parser.add_argument("--output", help="write the results as json here")
+    parser.add_argument("--workdir", help="scratch directory")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.workdir, args.rows)
+        return
+
+    missing = missing_requirements()
+    if missing:
+        sys.exit("Missing: %s" % ", ".join(missing))
+
+    operations = args.ops.split(",")
+    for operation in operations:
+        if operation not in OPERATIONS:
+            sys.exit("Unknown operation %s" % operation)
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        results[size] = run_size(size, operations, args.workdir)
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
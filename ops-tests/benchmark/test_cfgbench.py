@@ -0,0 +1,46 @@
+# Copyright (C) 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import os
+
+import pytest
+
+import cfgbench
+
+# Sizes run here, CFGD_BENCH_SIZES=10,100,...,100000 for the full scale
+SIZES = [int(size) for size in
+         os.environ.get("CFGD_BENCH_SIZES", "10,1000").split(",")]
+
+
+def test_generate_config():
+    for rows in [10, 1000, 100000]:
+        config = cfgbench.generate_config(rows)
+        count = cfgbench.count_rows(config)
+
+        assert rows <= count <= rows + rows // 1000 + 10
+
+
+@pytest.mark.skipif(cfgbench.missing_requirements() != [],
+                    reason="needs ovsdb-server and the ovsdb schemas")
+@pytest.mark.parametrize("rows", SIZES)
+def test_cfgbench(rows):
+    results = cfgbench.run_size(rows)
+    cfgbench.print_results({rows: results})
+
+    for operation in cfgbench.OPERATIONS:
+        result = results[operation]
+
+        assert result["ok"], result
+        assert result["peak_rss_kb"] >= result["base_rss_kb"]
@@ -0,0 +1,504 @@
+# Copyright (C) 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# In-memory ovsdb server for the unit tests, so the idl sessions and the
+# raw transactions of cfgdb and cfgrestore run without an ovsdb-server.
+#
+# It serves its schemas on a unix socket from a thread and implements
+# what the python idl and cfgdb.transact() use: get_schema, echo,
+# monitor (with update notifications) and transact with the insert,
+# select, update, mutate (insert and delete), delete, wait, assert and
+# comment operations. Commits check the column constraints and the strong
+# references, and delete the non root rows nothing references any more,
+# like ovsdb-server.
+
+import json
+import os
+import sys
+import threading
+import uuid
+
+# The modules under test live at the top of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+import ovs.db.data
+import ovs.db.error
+import ovs.db.schema
+import ovs.db.types
+import ovs.jsonrpc
+import ovs.ovsuuid
+import ovs.poller
+import ovs.stream
+
+# Schema of the config db the cfgdb sessions use
+CONFIGDB_SCHEMA = {
+    "name": "configdb",
+    "version": "1.0.0",
+    "tables": {
+        "config": {
+            "isRoot": True,
+            "columns": {
+                "type": {"type": "string"},
+                "name": {"type": {"key": "string", "min": 0, "max": 1}},
+                "writer": {"type": {"key": "string", "min": 0, "max": 1}},
+                "date": {"type": {"key": "string", "min": 0, "max": 1}},
+                "hardware": {"type": {"key": "string", "min": 0, "max": 1}},
+                "config": {"type": {"key": "string", "min": 0, "max": 1}}}}}}
+
+
+def write_schema(directory, schema_json):
+    '''
+    Writes schema_json to <directory>/<db name>.ovsschema and returns its
+    path, for the sessions that load their schema from a file.
+    '''
+    path = os.path.join(str(directory), "%s.ovsschema" % schema_json["name"])
+    with open(path, "w") as f:
+        json.dump(schema_json, f)
+    return path
+
+
+class TransactionError(Exception):
+    def __init__(self, error, details=""):
+        Exception.__init__(self, error)
+        self.error = error
+        self.details = details
+
+
+def _refs(datum):
+    '''
+    The uuids a datum references, if its column is a strong reference.
+    '''
+    uuids = []
+    if datum.type.key.is_strong_ref():
+        uuids.extend(key.value for key in datum.values)
+    if datum.type.value is not None and datum.type.value.is_strong_ref():
+        uuids.extend(value.value for value in datum.values.itervalues())
+    return uuids
+
+
+# Default value of an atom, by type
+_DEFAULT_ATOMS = {"integer": 0, "real": 0.0, "boolean": False, "string": "",
+                  "uuid": ["uuid", "00000000-0000-0000-0000-000000000000"]}
+
+
+def _default(column_type):
+    '''
+    The default Datum of a column type.
+    '''
+    if column_type.n_min == 0:
+        return ovs.db.data.Datum.from_json(column_type, ["set", []])
+
+    key = _DEFAULT_ATOMS[column_type.key.type.to_string()]
+    if column_type.is_map():
+        value = _DEFAULT_ATOMS[column_type.value.type.to_string()]
+        return ovs.db.data.Datum.from_json(column_type, ["map", [[key, value]]])
+    return ovs.db.data.Datum.from_json(column_type, key)
+
+
+class _Symtab(dict):
+    '''
+    Named-uuids of a transaction. ovs.ovsuuid.from_json() only resolves
+    named-uuids with a symtab that is not empty, while ovsdb-server
+    accepts a reference to a row inserted later in the transaction.
+    '''
+    def __nonzero__(self):
+        return True
+
+
+class FakeOvsdb(object):
+    '''
+    In-memory ovsdb server for the schemas (json) in schemas, listening
+    on the unix socket at path. The tables are dicts of row uuid to a
+    dict of column name to Datum, in self.dbs[db name][table name].
+    '''
+    def __init__(self, path, schemas):
+        self.path = path
+        self.remote = "unix:%s" % path
+        self.schemas = {}
+        self.dbs = {}
+        for schema_json in schemas:
+            schema = ovs.db.schema.DbSchema.from_json(schema_json)
+            self.schemas[schema.name] = (schema, schema_json)
+            self.dbs[schema.name] = dict((name, {})
+                                         for name in schema.tables)
+
+        # Transactions committed with write operations
+        self.n_writes = 0
+        # Hold the updates of a client until it sends its next request
+        # (ovsdb-server only guarantees they come before the reply)
+        self.defer_updates = False
+        # Fail the transactions with any of these operations
+        self.failing_ops = set()
+        self._deferred = {}
+        self._monitors = []
+        self._connections = []
+        self._lock = threading.Lock()
+        self._exiting = False
+
+        error, self._listener = ovs.stream.PassiveStream.open(
+            "punix:%s" % path)
+        assert not error, os.strerror(error)
+
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._exiting = True
+        self._thread.join()
+        for conn in self._connections:
+            conn.close()
+        self._listener.close()
+
+    #------------------ direct access, for the tests ----------------
+    def rows(self, db_name, table_name):
+        '''
+        Returns the rows of a table as a list of dicts of column name to
+        json value (with "_uuid").
+        '''
+        with self._lock:
+            schema = self.schemas[db_name][0]
+            table = self.dbs[db_name][table_name]
+            return [self._row_json(schema.tables[table_name], row_uuid, row)
+                    for row_uuid, row in table.iteritems()]
+
+    def transact(self, db_name, operations):
+        '''
+        Runs operations as a transaction, as if a client sent it.
+        Returns the results.
+        '''
+        with self._lock:
+            return self._transact(db_name, operations)
+
+    #------------------ server loop ----------------
+    def _serve(self):
+        while not self._exiting:
+            error, stream = self._listener.accept()
+            if not error:
+                self._connections.append(ovs.jsonrpc.Connection(stream))
+
+            for conn in list(self._connections):
+                conn.run()
+                while not conn.get_status():
+                    error, msg = conn.recv()
+                    if error:
+                        break
+                    with self._lock:
+                        try:
+                            self._handle(conn, msg)
+                        except Exception, e:
+                            # Fail the client rather than leave it waiting
+                            conn.send(ovs.jsonrpc.Message.create_error(
+                                "fakeovsdb: %r" % e, msg.id))
+                    conn.run()
+                if conn.get_status():
+                    self._connections.remove(conn)
+                    self._monitors = [monitor for monitor in self._monitors
+                                      if monitor[0] is not conn]
+                    self._deferred.pop(conn, None)
+                    conn.close()
+
+            poller = ovs.poller.Poller()
+            self._listener.wait(poller)
+            for conn in self._connections:
+                conn.wait(poller)
+                conn.recv_wait(poller)
+            poller.timer_wait(50)
+            poller.block()
+
+    def _handle(self, conn, msg):
+        if msg.type != ovs.jsonrpc.Message.T_REQUEST:
+            return
+
+        for update in self._deferred.pop(conn, []):
+            conn.send(update)
+
+        method = msg.method
+        params = msg.params
+        if method == "echo":
+            reply = ovs.jsonrpc.Message.create_reply(params, msg.id)
+        elif method == "list_dbs":
+            reply = ovs.jsonrpc.Message.create_reply(sorted(self.dbs),
+                                                     msg.id)
+        elif method == "get_schema" and params[0] in self.schemas:
+            reply = ovs.jsonrpc.Message.create_reply(
+                self.schemas[params[0]][1], msg.id)
+        elif method == "monitor" and params[0] in self.dbs:
+            db_name, monitor_id, requests = params
+            columns = {}
+            for table_name, request in requests.iteritems():
+                if isinstance(request, list):
+                    request = request[0]
+                columns[table_name] = request.get("columns")
+            self._monitors.append((conn, db_name, monitor_id, columns))
+            reply = ovs.jsonrpc.Message.create_reply(
+                self._table_updates(db_name, columns, {}), msg.id)
+        elif method == "lock":
+            # No other client takes the locks of the tests
+            reply = ovs.jsonrpc.Message.create_reply({"locked": True},
+                                                     msg.id)
+        elif method == "unlock":
+            reply = ovs.jsonrpc.Message.create_reply({}, msg.id)
+        elif method == "transact" and params[0] in self.dbs:
+            results = self._transact(params[0], params[1:])
+            reply = ovs.jsonrpc.Message.create_reply(results, msg.id)
+        else:
+            reply = ovs.jsonrpc.Message.create_error("unknown method",
+                                                     msg.id)
+        conn.send(reply)
+
+    #------------------ transactions ----------------
+    def _transact(self, db_name, operations):
+        schema = self.schemas[db_name][0]
+        old = self.dbs[db_name]
+        new = dict((name, dict((row_uuid, dict(row))
+                               for row_uuid, row in table.iteritems()))
+                   for name, table in old.iteritems())
+        symtab = _Symtab()
+
+        results = []
+        if any(op["op"] in self.failing_ops for op in operations):
+            return [{"error": "not allowed",
+                     "details": "failure injected by the test"}]
+        try:
+            for op in operations:
+                results.append(self._operation(schema, new, symtab, op))
+            self._commit(schema, new)
+        except TransactionError, e:
+            results.append({"error": e.error, "details": e.details})
+            return results
+        except ovs.db.error.Error, e:
+            results.append({"error": "syntax error", "details": str(e)})
+            return results
+
+        if any(op["op"] in ["insert", "update", "mutate", "delete"]
+               for op in operations):
+            self.n_writes += 1
+        self.dbs[db_name] = new
+        for conn, monitor_db, monitor_id, columns in self._monitors:
+            if monitor_db != db_name:
+                continue
+            updates = self._table_updates(db_name, columns, old)
+            if not updates:
+                continue
+            update = ovs.jsonrpc.Message.create_notify(
+                "update", [monitor_id, updates])
+            if self.defer_updates:
+                self._deferred.setdefault(conn, []).append(update)
+            else:
+                conn.send(update)
+        return results
+
+    def _operation(self, schema, db, symtab, op):
+        name = op["op"]
+        if name in ["comment", "assert"]:
+            return {}
+
+        table_name = op["table"]
+        if table_name not in schema.tables:
+            raise TransactionError("unknown table", table_name)
+        table = schema.tables[table_name]
+        rows = db[table_name]
+
+        if name == "insert":
+            if "uuid-name" in op:
+                row_uuid = symtab.setdefault(op["uuid-name"], uuid.uuid4())
+            else:
+                row_uuid = uuid.uuid4()
+            row = dict((column_name, _default(column.type))
+                       for column_name, column in table.columns.iteritems())
+            row.update(self._parse_row(table, op["row"], symtab))
+            rows[row_uuid] = row
+            return {"uuid": ["uuid", str(row_uuid)]}
+
+        matches = [(row_uuid, row) for row_uuid, row in rows.iteritems()
+                   if self._match(table, row_uuid, row, op.get("where", []),
+                                  symtab)]
+
+        if name == "select":
+            columns = op.get("columns")
+            return {"rows": [self._row_json(table, row_uuid, row, columns)
+                             for row_uuid, row in matches]}
+        elif name == "update":
+            values = self._parse_row(table, op["row"], symtab)
+            for row_uuid, row in matches:
+                row.update(values)
+            return {"count": len(matches)}
+        elif name == "mutate":
+            for row_uuid, row in matches:
+                for column_name, mutator, value in op["mutations"]:
+                    if mutator not in ["insert", "delete"]:
+                        raise TransactionError("not supported", mutator)
+                    column_type = table.columns[column_name].type
+                    # The argument may have any number of elements
+                    mutation = ovs.db.data.Datum.from_json(
+                        ovs.db.types.Type(column_type.key, column_type.value,
+                                          0, sys.maxint), value, symtab)
+                    values = dict(row[column_name].values)
+                    for key, atom in mutation.values.iteritems():
+                        if mutator == "insert":
+                            values.setdefault(key, atom)
+                        else:
+                            values.pop(key, None)
+                    row[column_name] = ovs.db.data.Datum(column_type, values)
+            return {"count": len(matches)}
+        elif name == "delete":
+            for row_uuid, row in matches:
+                del rows[row_uuid]
+            return {"count": len(matches)}
+        elif name == "wait":
+            # Compared in json, which _uuid has too
+            columns = op["columns"]
+            actual = [self._row_json(table, row_uuid, row, columns)
+                      for row_uuid, row in matches]
+            expected = []
+            for row_json in op["rows"]:
+                row_json = dict(row_json)
+                if "_uuid" in row_json:
+                    row_uuid = ovs.ovsuuid.from_json(row_json.pop("_uuid"),
+                                                     symtab)
+                else:
+                    row_uuid = None
+                row = self._parse_row(table, row_json, symtab)
+                expected.append(self._row_json(table, row_uuid, row,
+                                               op["columns"]))
+            equal = len(actual) == len(expected)
+            for row in expected:
+                if row in actual:
+                    actual.remove(row)
+                else:
+                    equal = False
+            if equal != (op["until"] == "=="):
+                raise TransactionError("timed out")
+            return {}
+
+        raise TransactionError("not supported", name)
+
+    def _parse_row(self, table, row_json, symtab):
+        row = {}
+        for column_name, value in row_json.iteritems():
+            if column_name not in table.columns:
+                raise TransactionError("unknown column", column_name)
+            row[column_name] = ovs.db.data.Datum.from_json(
+                table.columns[column_name].type, value, symtab)
+        return row
+
+    def _match(self, table, row_uuid, row, where, symtab):
+        for column_name, function, value in where:
+            if column_name == "_uuid":
+                actual = row_uuid
+                expected = ovs.ovsuuid.from_json(value, symtab)
+                if function == "==" and actual != expected:
+                    return False
+                if function == "!=" and actual == expected:
+                    return False
+                continue
+
+            actual = row[column_name].values
+            expected = ovs.db.data.Datum.from_json(
+                table.columns[column_name].type, value, symtab).values
+            included = all(key in actual and actual[key] == expected[key]
+                           for key in expected)
+            if function == "==" and actual != expected:
+                return False
+            if function == "!=" and actual == expected:
+                return False
+            if function == "includes" and not included:
+                return False
+            if function == "excludes" and included and expected:
+                return False
+        return True
+
+    def _commit(self, schema, db):
+        # Garbage collect the non root rows nobody references
+        while True:
+            referenced = set()
+            for table in db.itervalues():
+                for row in table.itervalues():
+                    for datum in row.itervalues():
+                        referenced.update(_refs(datum))
+            garbage = [(table_name, row_uuid)
+                       for table_name, table in db.iteritems()
+                       if not schema.tables[table_name].is_root
+                       for row_uuid in table if row_uuid not in referenced]
+            if not garbage:
+                break
+            for table_name, row_uuid in garbage:
+                del db[table_name][row_uuid]
+
+        existing = set(row_uuid for table in db.itervalues()
+                       for row_uuid in table)
+        for table_name, table in db.iteritems():
+            for row_uuid, row in table.iteritems():
+                for column_name, datum in row.iteritems():
+                    column_type = datum.type
+                    if not (column_type.n_min <= len(datum.values) <=
+                            column_type.n_max):
+                        raise TransactionError(
+                            "constraint violation",
+                            "%s %s %s" % (table_name, row_uuid, column_name))
+                    for ref in _refs(datum):
+                        if ref not in existing:
+                            raise TransactionError(
+                                "referential integrity violation",
+                                "%s %s %s" % (table_name, row_uuid,
+                                              column_name))
+
+    #------------------ json ----------------
+    def _row_json(self, table, row_uuid, row, columns=None):
+        if columns is None:
+            columns = ["_uuid"] + sorted(row)
+        row_json = {}
+        for column_name in columns:
+            if column_name == "_uuid":
+                row_json[column_name] = ["uuid", str(row_uuid)]
+            else:
+                row_json[column_name] = row[column_name].to_json()
+        return row_json
+
+    def _table_updates(self, db_name, columns, old):
+        schema = self.schemas[db_name][0]
+        new = self.dbs[db_name]
+        updates = {}
+        for table_name, table_columns in columns.iteritems():
+            table = schema.tables[table_name]
+            if table_columns is None:
+                table_columns = sorted(table.columns)
+            old_rows = old.get(table_name, {})
+            new_rows = new[table_name]
+
+            table_updates = {}
+            for row_uuid in set(old_rows) | set(new_rows):
+                old_row = old_rows.get(row_uuid)
+                new_row = new_rows.get(row_uuid)
+                update = {}
+                if new_row is not None:
+                    update["new"] = self._row_json(table, row_uuid, new_row,
+                                                   table_columns)
+                if old_row is not None:
+                    changed = [column for column in table_columns
+                               if new_row is None or
+                               old_row[column] != new_row[column]]
+                    if not changed:
+                        continue
+                    update["old"] = self._row_json(table, row_uuid, old_row,
+                                                   changed)
+                table_updates[str(row_uuid)] = update
+            if table_updates:
+                updates[table_name] = table_updates
+        return updates
@@ -0,0 +1,361 @@
+# Copyright (C) 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import sys
+import types
+
+import pytest
+
+import fakeovsdb
+
+import ovs.db.idl
+import ovs.poller
+import ovs.timeval
+
+import cfgautosave
+import cfgdb
+import cfgdbutil
+import cfgschema
+
+RUNNING_SCHEMA = {
+    "name": "OpenSwitch",
+    "version": "1.0.0",
+    "tables": {
+        "System": {
+            "isRoot": True,
+            "maxRows": 1,
+            "columns": {
+                "cur_cfg": {"type": "integer"},
+                "hostname": {"type": {"key": "string", "min": 0, "max": 1}},
+                "vlans": {"type": {"key": {"type": "uuid",
+                                           "refTable": "VLAN"},
+                                   "min": 0, "max": "unlimited"}}}},
+        "VLAN": {
+            "isRoot": True,
+            "columns": {
+                "id": {"type": "integer"},
+                "name": {"type": {"key": "string", "min": 0, "max": 1}},
+                "oper_state": {"type": {"key": "string",
+                                        "min": 0, "max": 1}}}}}}
+
+
+class ExtTable(object):
+    def __init__(self, config, references):
+        self.config = dict((column, None) for column in config)
+        self.references = dict((column, None) for column in references)
+
+
+class ExtSchema(object):
+    ovs_tables = {"System": ExtTable(["hostname"], ["vlans"]),
+                  "VLAN": ExtTable(["id", "name"], [])}
+
+
+def read_running(extschema, opsidl):
+    '''
+    Stands in for ops.dc.read() on RUNNING_SCHEMA.
+    '''
+    data = {}
+    for row in opsidl.tables["System"].rows.itervalues():
+        data["System"] = {"hostname": cfgdb.column_value(row.hostname),
+                          "vlans": dict((str(vlan.id),
+                                         {"name": cfgdb.column_value(
+                                             vlan.name)})
+                                        for vlan in row.vlans)}
+    return data
+
+
+@pytest.fixture
+def dbs(tmpdir, monkeypatch):
+    server = fakeovsdb.FakeOvsdb(str(tmpdir.join("db.sock")),
+                                 [fakeovsdb.CONFIGDB_SCHEMA, RUNNING_SCHEMA])
+    monkeypatch.setattr(cfgdb, "def_db", server.remote)
+    monkeypatch.setattr(cfgdb, "cfgdb_schema", fakeovsdb.write_schema(
+        tmpdir, fakeovsdb.CONFIGDB_SCHEMA))
+    monkeypatch.setattr(cfgdbutil, "compile_restore_plan",
+                        lambda data, extschema, replica, fingerprint: None)
+    monkeypatch.setattr(cfgschema, "schema_fingerprint", lambda: "schemas")
+
+    ops = types.ModuleType("ops")
+    ops.dc = types.ModuleType("ops.dc")
+    ops.dc.read = read_running
+    monkeypatch.setitem(sys.modules, "ops", ops)
+    monkeypatch.setitem(sys.modules, "ops.dc", ops.dc)
+
+    # Enough rows for a journal row to be small next to the config
+    vlans = [{"op": "insert", "table": "VLAN", "uuid-name": "vlan%d" % i,
+              "row": {"id": i, "name": "VLAN%d" % i}} for i in range(1, 41)]
+    server.transact("OpenSwitch", vlans + [
+        {"op": "insert", "table": "System",
+         "row": {"cur_cfg": 0, "hostname": "switch",
+                 "vlans": ["set", [["named-uuid", op["uuid-name"]]
+                                   for op in vlans]]}}])
+
+    schema_helper = ovs.db.idl.SchemaHelper(location=fakeovsdb.write_schema(
+        tmpdir, RUNNING_SCHEMA))
+    schema_helper.register_all()
+    opsidl = ovs.db.idl.Idl(server.remote, schema_helper)
+    sync(opsidl)
+
+    yield server, opsidl
+    opsidl.close()
+    server.close()
+
+
+def sync(opsidl):
+    '''
+    Run the idl until it sees the db changes made so far.
+    '''
+    seqno = opsidl.change_seqno
+    deadline = ovs.timeval.msec() + 2000
+    while opsidl.change_seqno == seqno and ovs.timeval.msec() < deadline:
+        opsidl.run()
+        poller = ovs.poller.Poller()
+        opsidl.wait(poller)
+        poller.timer_wait_until(deadline)
+        poller.block()
+
+
+def update_system(server, opsidl, row):
+    server.transact("OpenSwitch", [
+        {"op": "update", "table": "System", "where": [], "row": row}])
+    sync(opsidl)
+
+
+def add_vlan(server, opsidl, row, attach=True):
+    operations = [{"op": "insert", "table": "VLAN", "row": row,
+                   "uuid-name": "vlan"}]
+    if attach:
+        operations.append({"op": "mutate", "table": "System", "where": [],
+                           "mutations": [["vlans", "insert",
+                                          ["named-uuid", "vlan"]]]})
+    server.transact("OpenSwitch", operations)
+    sync(opsidl)
+
+
+def running_config(opsidl, hostname):
+    data = read_running(None, opsidl)
+    data["System"]["hostname"] = hostname
+    return data
+
+
+def startup_config():
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    row = cfg.find_row("startup")
+    data = dict(cfg.iter_config(row)) if row is not None else None
+    journal = [cfgdb.column_value(row.name)
+               for row in cfg.list_rows(cfgdb.JOURNAL_TYPE)]
+    cfg.close()
+    return data, journal
+
+
+def test_start_loads_the_startup_config(dbs):
+    server, opsidl = dbs
+    saved = running_config(opsidl, "saved")
+    cfgdbutil.save_startup_config(saved)
+    n_writes = server.n_writes
+
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl, 0, 8)
+    autosave.start()
+    autosave.run()
+
+    # The running db (not pushed yet) does not overwrite the startup config
+    assert autosave.data == saved
+    assert autosave.dirty_msec is None
+    assert server.n_writes == n_writes
+    assert startup_config() == (saved, [])
+
+
+def test_save_waits_for_the_push(dbs):
+    server, opsidl = dbs
+    saved = running_config(opsidl, "saved")
+    cfgdbutil.save_startup_config(saved)
+
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl, 0, 8)
+    autosave.start()
+
+    # cfgd pushing the startup config
+    update_system(server, opsidl, {"hostname": "saved"})
+    assert autosave.dirty_msec is not None
+    autosave.run()
+    assert autosave.dirty_msec is not None
+    assert startup_config() == (saved, [])
+
+    update_system(server, opsidl, {"cur_cfg": 1})
+    autosave.run()
+    assert autosave.dirty_msec is None
+    assert startup_config() == (saved, [])
+
+    # A change made once the push is done goes to the journal
+    update_system(server, opsidl, {"hostname": "changed"})
+    autosave.run()
+    changed = running_config(opsidl, "changed")
+    assert startup_config() == (changed, ["00000001"])
+
+    # A restart picks up the journal
+    autosave.close()
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl, 0, 8)
+    autosave.start()
+    assert (autosave.data, autosave.seq) == (changed, 1)
+    autosave.close()
+
+
+def test_status_changes_are_ignored(dbs):
+    server, opsidl = dbs
+    update_system(server, opsidl, {"cur_cfg": 1})
+
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl, 0, 8)
+    autosave.start()
+
+    # Status only rows and columns
+    add_vlan(server, opsidl, {"oper_state": "up"}, attach=False)
+    assert autosave.dirty_msec is None
+    server.transact("OpenSwitch", [
+        {"op": "update", "table": "VLAN", "where": [],
+         "row": {"oper_state": "down"}}])
+    sync(opsidl)
+    assert autosave.dirty_msec is None
+    server.transact("OpenSwitch", [
+        {"op": "delete", "table": "VLAN", "where": [["id", "==", 0]]}])
+    sync(opsidl)
+    assert autosave.dirty_msec is None
+
+    add_vlan(server, opsidl, {"id": 100, "name": "VLAN100"}, attach=False)
+    assert autosave.dirty_msec is not None
+
+    # Nothing was saved, the running config is saved whole
+    autosave.run()
+    assert startup_config() == (read_running(None, opsidl), [])
+    autosave.close()
+
+
+def test_journal_compaction(dbs):
+    server, opsidl = dbs
+    update_system(server, opsidl, {"cur_cfg": 1})
+    cfgdbutil.save_startup_config(read_running(None, opsidl))
+
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl, 0, 2)
+    autosave.start()
+
+    update_system(server, opsidl, {"hostname": "one"})
+    autosave.run()
+    assert startup_config()[1] == ["00000001"]
+
+    # compact_rows reached
+    update_system(server, opsidl, {"hostname": "two"})
+    autosave.run()
+    assert startup_config() == (read_running(None, opsidl), [])
+    assert autosave.seq == 0
+    autosave.close()
+
+
+def test_failed_compaction_keeps_the_journal(dbs):
+    server, opsidl = dbs
+    update_system(server, opsidl, {"cur_cfg": 1})
+    cfgdbutil.save_startup_config(read_running(None, opsidl))
+
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl, 0, 2)
+    autosave.start()
+    base = autosave.base
+
+    # The compaction deletes the journal rows, the appends do not
+    server.failing_ops.add("delete")
+    update_system(server, opsidl, {"hostname": "one"})
+    autosave.run()
+    update_system(server, opsidl, {"hostname": "two"})
+    autosave.run()
+    assert startup_config() == (read_running(None, opsidl),
+                                ["00000001", "00000002"])
+    assert (autosave.base, autosave.seq) == (base, 2)
+
+    # The next save compacts the journal
+    server.failing_ops.clear()
+    update_system(server, opsidl, {"hostname": "three"})
+    autosave.run()
+    assert startup_config() == (read_running(None, opsidl), [])
+    assert autosave.seq == 0
+    autosave.close()
+
+
+def test_startup_saved_elsewhere_compacts(dbs):
+    server, opsidl = dbs
+    update_system(server, opsidl, {"cur_cfg": 1})
+    cfgdbutil.save_startup_config(read_running(None, opsidl))
+
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl, 0, 8)
+    autosave.start()
+
+    # Saved by "copy running-config startup-config" in the meantime: the
+    # date check of append_journal() fails and the config is saved whole
+    cfgdbutil.save_startup_config({"System": {"hostname": "other"}})
+    update_system(server, opsidl, {"hostname": "changed"})
+    autosave.run()
+
+    assert startup_config() == (read_running(None, opsidl), [])
+    assert autosave.base == cfgdb.config_digest(
+        cfgdb.serialize_config(read_running(None, opsidl)))
+    autosave.close()
+
+
+def test_restore_plan_saved_with_the_config(dbs, monkeypatch):
+    server, opsidl = dbs
+    compiled = []
+
+    def compile_restore_plan(data, extschema, replica, fingerprint):
+        compiled.append(fingerprint)
+        return {"schema": fingerprint}
+
+    monkeypatch.setattr(cfgdbutil, "compile_restore_plan",
+                        compile_restore_plan)
+    data = read_running(None, opsidl)
+    digest = cfgdb.config_digest(cfgdb.serialize_config(data))
+
+    def plan_names():
+        cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+        names = [cfgdb.column_value(row.name)
+                 for row in cfg.list_rows(cfgdb.PLAN_TYPE)]
+        cfg.close()
+        return names
+
+    # The plan is written in the transaction saving the config
+    n_writes = server.n_writes
+    assert cfgdbutil.save_startup_config(data, extschema=ExtSchema(),
+                                         replica=opsidl)
+    assert server.n_writes == n_writes + 1
+    assert compiled == ["schemas"]
+    assert plan_names() == [cfgdb.plan_name("schemas", digest)]
+
+    # Not compiled again for an unchanged config
+    assert cfgdbutil.save_startup_config(data, extschema=ExtSchema(),
+                                         replica=opsidl)
+    assert server.n_writes == n_writes + 1
+    assert compiled == ["schemas"]
+
+    # Unless the schemas changed
+    monkeypatch.setattr(cfgschema, "schema_fingerprint", lambda: "other")
+    assert cfgdbutil.save_startup_config(data, extschema=ExtSchema(),
+                                         replica=opsidl)
+    assert compiled == ["schemas", "other"]
+    assert plan_names() == [cfgdb.plan_name("other", digest)]
+
+
+def test_autosave_settings_from_environment(dbs, monkeypatch):
+    server, opsidl = dbs
+    monkeypatch.setenv("CFGD_AUTOSAVE_INTERVAL_MSEC", "100")
+    monkeypatch.setenv("CFGD_AUTOSAVE_COMPACT_ROWS", "many")
+
+    autosave = cfgautosave.Autosave(ExtSchema(), opsidl)
+    assert autosave.interval_msec == 100
+    assert autosave.compact_rows == cfgautosave.AUTOSAVE_COMPACT_ROWS
+    autosave.close()
@@ -0,0 +1,502 @@
+# Copyright (C) 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import base64
+import json
+import zlib
+
+import pytest
+
+import fakeovsdb
+
+import ovs.poller
+import ovs.timeval
+
+import cfgdb
+
+
+def sample_config(hostname="switch"):
+    return {"System": {"hostname": hostname,
+                       "bridges": {"bridge_normal": {"vlans": {
+                           "1": {"id": 1, "name": "DEFAULT_VLAN_1"}}}}},
+            "Interface": {"1": {"name": "1", "admin": "up"}}}
+
+
+@pytest.fixture
+def configdb(tmpdir, monkeypatch):
+    server = fakeovsdb.FakeOvsdb(str(tmpdir.join("db.sock")),
+                                 [fakeovsdb.CONFIGDB_SCHEMA])
+    monkeypatch.setattr(cfgdb, "def_db", server.remote)
+    monkeypatch.setattr(cfgdb, "cfgdb_schema", fakeovsdb.write_schema(
+        tmpdir, fakeovsdb.CONFIGDB_SCHEMA))
+    yield server
+    server.close()
+
+
+def save_checkpoint(name, data, max_count=None, max_bytes=None):
+    cfg = cfgdb.Cfgdb()
+    cfg.config = cfgdb.encode_config(data)
+    status, evicted = cfg.save_checkpoint(name, max_count, max_bytes)
+    cfg.close()
+
+    assert status == "success"
+    return evicted
+
+
+def checkpoint_names(cfg):
+    return [cfgdb.column_value(row.name)
+            for row in cfg.list_rows(cfgdb.CHECKPOINT_TYPE)]
+
+
+def test_encode_decode_config():
+    data = sample_config()
+    raw = cfgdb.serialize_config(data)
+    config = cfgdb.encode_config(data)
+
+    assert config.startswith("opscfg2:zlib:%s:" % cfgdb.config_digest(raw))
+    assert cfgdb.get_config_digest(config) == cfgdb.config_digest(raw)
+    assert cfgdb.decode_config(config) == data
+    assert cfgdb.encode_config(raw=raw) == config
+
+    # A real config compresses well below its legacy encoding
+    vlans = sample_config()
+    vlans["VLAN"] = dict((str(i), {"id": i, "name": "VLAN%d" % i})
+                         for i in range(1, 101))
+    assert len(cfgdb.encode_config(vlans)) * 4 < \
+        len(base64.b64encode(json.dumps(vlans)))
+
+    # Legacy base64 json rows and version 1 rows are still read
+    legacy = base64.b64encode(json.dumps(data))
+    assert cfgdb.decode_config(legacy) == data
+    assert cfgdb.get_config_digest(legacy) is None
+    version1 = "opscfg1:zlib:" + base64.b64encode(zlib.compress(raw))
+    assert cfgdb.decode_config(version1) == data
+    assert cfgdb.get_config_digest(version1) is None
+
+
+@pytest.mark.parametrize("config", [
+    "opscfg9:zlib:digest:eJyrrgUAAXUA+Q==",
+    "opscfg2:lzma:digest:eJyrrgUAAXUA+Q==",
+    "opscfg2:zlib",
+    "opscfg2:zlib:digest:" + base64.b64encode("not zlib"),
+    "opscfg2:zlib:digest:not base64"])
+def test_decode_config_errors(config):
+    with pytest.raises(ValueError):
+        cfgdb.decode_config(config)
+
+
+@pytest.mark.parametrize("chunk_size", [4, 7, 64, cfgdb.CONFIG_DECODE_CHUNK])
+def test_iter_config_tables(chunk_size):
+    # Strings with the characters the splitter looks at, escapes included
+    data = sample_config('a "quoted", {braced} [name]\\')
+    data["Port"] = {"1": {"name": "1", "tags": [1, 2, [3]],
+                          "other": {"}": ",", "\\\"": u"\u00e9"}}}
+    data["Empty"] = {}
+
+    for config in [cfgdb.encode_config(data),
+                   base64.b64encode(json.dumps(data, indent=2))]:
+        tables = list(cfgdb.iter_config_tables(config, chunk_size))
+        assert dict(tables) == data
+        assert len(tables) == len(data)
+    # Tables come in the sorted order of the encoded json
+    assert [table for table, value in cfgdb.iter_config_tables(
+        cfgdb.encode_config(data), chunk_size)] == sorted(data)
+
+
+@pytest.mark.parametrize("text", [
+    '["System"]', '"System"', '{"System": {}', '{"System": {}}}',
+    '{"System": {}} {}', '{"System": {]}'])
+def test_iter_config_tables_errors(text):
+    with pytest.raises(ValueError):
+        list(cfgdb.iter_config_tables(base64.b64encode(text), 4))
+
+
+def test_checkpoint_save_list_restore(configdb):
+    save_checkpoint("b", sample_config("b"))
+    save_checkpoint("a", sample_config("a"))
+
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    assert checkpoint_names(cfg) == ["a", "b"]
+
+    row = cfg.find_row(cfgdb.CHECKPOINT_TYPE, "a")
+    assert dict(cfg.iter_config(row)) == sample_config("a")
+    cfg.close()
+
+    # Saving under an existing name replaces the checkpoint
+    save_checkpoint("a", sample_config("c"))
+
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    assert checkpoint_names(cfg) == ["a", "b"]
+    row = cfg.find_row(cfgdb.CHECKPOINT_TYPE, "a")
+    assert dict(cfg.iter_config(row)) == sample_config("c")
+    cfg.close()
+
+
+def test_checkpoint_eviction_by_count(configdb):
+    for name in ["a", "b", "c"]:
+        assert save_checkpoint(name, sample_config(name), max_count=3) == []
+
+    assert save_checkpoint("d", sample_config("d"), max_count=3) == ["a"]
+    assert save_checkpoint("e", sample_config("e"), max_count=2) == \
+        ["b", "c"]
+
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    assert checkpoint_names(cfg) == ["d", "e"]
+    cfg.close()
+
+
+def test_checkpoint_eviction_by_bytes(configdb):
+    size = len(cfgdb.encode_config(sample_config("a")))
+
+    save_checkpoint("a", sample_config("a"), max_bytes=size * 2)
+    save_checkpoint("b", sample_config("b"), max_bytes=size * 2)
+    assert save_checkpoint("c", sample_config("c"),
+                           max_bytes=size * 2) == ["a"]
+
+    # A checkpoint larger than the limit is not saved
+    cfg = cfgdb.Cfgdb()
+    cfg.config = cfgdb.encode_config(sample_config("d"))
+    status, evicted = cfg.save_checkpoint("d", None, size // 2)
+    assert (status, evicted) == ("Invalid", [])
+    assert checkpoint_names(cfg) == ["b", "c"]
+    cfg.close()
+
+
+def test_checkpoint_lru_eviction(configdb):
+    save_checkpoint("a", sample_config("a"))
+    save_checkpoint("b", sample_config("b"))
+
+    # Restoring "a" refreshes it, "b" becomes the least recently used
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    assert cfg.touch_row(cfg.find_row(cfgdb.CHECKPOINT_TYPE, "a")) == \
+        "success"
+    cfg.close()
+
+    assert save_checkpoint("c", sample_config("c"), max_count=2) == ["b"]
+
+
+def test_checkpoint_chunked_layout(configdb):
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    for name in ["a", "b"]:
+        status, evicted = cfg.save_checkpoint(name, 1, 0,
+                                              data=sample_config(name))
+        assert status == "success"
+    assert evicted == ["a"]
+    assert checkpoint_names(cfg) == ["b"]
+
+    row = cfg.find_row(cfgdb.CHECKPOINT_TYPE, "b")
+    assert dict(cfg.iter_config(row)) == sample_config("b")
+
+    # Only the chunks of "b" are left
+    chunks = cfgdb.config_chunk_hashes(cfg.read_config(row))
+    assert sorted(cfgdb.column_value(chunk.name)
+                  for chunk in cfg.list_rows(cfgdb.CHUNK_TYPE)) == \
+        sorted(chunks)
+    cfg.close()
+
+
+def test_checkpoint_chunked_eviction_by_bytes(configdb, monkeypatch):
+    config, chunks = cfgdb.split_config(sample_config("a"))
+    size = len(config) + sum(len(chunk) for chunk in chunks.itervalues())
+    selects = []
+
+    def select_configs(remote, db_name, rows):
+        selects.append(len(rows))
+        return read_configs(remote, db_name, rows)
+
+    read_configs = cfgdb.select_configs
+    monkeypatch.setattr(cfgdb, "select_configs", select_configs)
+
+    # The chunks count, shared ones included, for each checkpoint
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    for name in ["a", "b"]:
+        assert cfg.save_checkpoint(name, None, size * 2,
+                                   data=sample_config(name)) == \
+            ("success", [])
+    del selects[:]
+    assert cfg.save_checkpoint("c", None, size * 2,
+                               data=sample_config("c")) == \
+        ("success", ["a"])
+    assert checkpoint_names(cfg) == ["b", "c"]
+    # "a" and "b" with their 3 chunks, in one transaction
+    assert selects == [5]
+
+    # A checkpoint larger than the limit is not saved
+    assert cfg.save_checkpoint("d", None, size // 2,
+                               data=sample_config("d")) == ("Invalid", [])
+    assert checkpoint_names(cfg) == ["b", "c"]
+    cfg.close()
+
+
+def test_sync_idl(configdb):
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    assert checkpoint_names(cfg) == []
+
+    # Saved by another client while the session is idle
+    configdb.defer_updates = True
+    configdb.transact("configdb", [
+        {"op": "insert", "table": cfgdb.CONFIG_TABLE,
+         "row": {"type": cfgdb.CHECKPOINT_TYPE, "name": "other"}}])
+    cfg.idl.run()
+    assert checkpoint_names(cfg) == []
+    assert cfgdb.sync_idl(cfg.idl)
+    assert checkpoint_names(cfg) == ["other"]
+    assert cfg.idl.lock_name is None
+    cfg.close()
+
+
+def test_indexed_idl(configdb):
+    def transact(*operations):
+        configdb.transact("configdb", list(operations))
+        assert cfgdb.sync_idl(cfg.idl)
+
+    def names(cfgtype):
+        return [cfgdb.column_value(row.name) for row in cfg.list_rows(cfgtype)]
+
+    def insert(cfgtype, name=None):
+        row = {"type": cfgtype}
+        if name is not None:
+            row["name"] = name
+        return {"op": "insert", "table": cfgdb.CONFIG_TABLE, "row": row}
+
+    def where(name):
+        return [["type", "==", cfgdb.CHECKPOINT_TYPE], ["name", "==", name]]
+
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    transact(insert("startup"), insert(cfgdb.CHECKPOINT_TYPE, "b"),
+             insert(cfgdb.CHECKPOINT_TYPE, "a"),
+             insert(cfgdb.JOURNAL_TYPE, "00000001"))
+    assert cfg.find_row_by_type("startup")[1]
+    assert cfgdb.column_value(
+        cfg.find_row(cfgdb.CHECKPOINT_TYPE, "a").name) == "a"
+    assert cfg.find_row(cfgdb.CHECKPOINT_TYPE) is not None
+    assert cfg.find_row(cfgdb.CHECKPOINT_TYPE, "c") is None
+    assert cfg.find_row("missing") is None
+    assert names(cfgdb.CHECKPOINT_TYPE) == ["a", "b"]
+    assert len(cfg.list_rows()) == 4
+
+    # Renamed, retyped and deleted rows move in the index
+    transact({"op": "update", "table": cfgdb.CONFIG_TABLE,
+              "where": where("a"), "row": {"name": "c"}},
+             {"op": "update", "table": cfgdb.CONFIG_TABLE,
+              "where": where("b"), "row": {"type": cfgdb.JOURNAL_TYPE}})
+    assert cfg.find_row(cfgdb.CHECKPOINT_TYPE, "a") is None
+    assert names(cfgdb.CHECKPOINT_TYPE) == ["c"]
+    assert names(cfgdb.JOURNAL_TYPE) == ["00000001", "b"]
+    transact({"op": "delete", "table": cfgdb.CONFIG_TABLE,
+              "where": where("c")})
+    assert cfg.find_row(cfgdb.CHECKPOINT_TYPE) is None
+    assert names(cfgdb.CHECKPOINT_TYPE) == []
+
+    # The index is rebuilt from the new replica after a reconnection
+    rows = cfg.idl.tables[cfgdb.CONFIG_TABLE].rows
+    cfg.idl.force_reconnect()
+    configdb.transact("configdb", [insert(cfgdb.CHECKPOINT_TYPE, "d")])
+    deadline = ovs.timeval.msec() + cfgdb.UPDATE_WAIT_MSEC
+    while cfg.idl.tables[cfgdb.CONFIG_TABLE].rows is rows or \
+            not cfg.idl.tables[cfgdb.CONFIG_TABLE].rows:
+        assert ovs.timeval.msec() < deadline
+        cfg.idl.run()
+        poller = ovs.poller.Poller()
+        cfg.idl.wait(poller)
+        poller.timer_wait_until(deadline)
+        poller.block()
+    assert names(cfgdb.CHECKPOINT_TYPE) == ["d"]
+    assert cfg.find_row(cfgdb.CHECKPOINT_TYPE, "d") is not None
+    assert len(cfg.list_rows()) == 4
+    cfg.close()
+
+
+def test_checkpoint_limits_from_environment(monkeypatch):
+    monkeypatch.setattr(cfgdb, "checkpoint_max_count", None)
+    monkeypatch.setattr(cfgdb, "checkpoint_max_bytes", None)
+    monkeypatch.setenv("CFGD_CHECKPOINT_MAX_COUNT", "4")
+    monkeypatch.setenv("CFGD_CHECKPOINT_MAX_BYTES", "1k")
+
+    assert cfgdb.checkpoint_limits() == \
+        (4, cfgdb.DEFAULT_CHECKPOINT_MAX_BYTES)
+
+
+def test_diff_apply_config_round_trip():
+    old = sample_config()
+    new = sample_config("other")
+    vlans = new["System"]["bridges"]["bridge_normal"]["vlans"]
+    # Nested children added, changed and deleted, top level tables too
+    vlans["2"] = {"id": 2, "name": "VLAN2", "ports": ["1", "2"]}
+    vlans["1"]["name"] = "VLAN1"
+    del new["Interface"]
+    new["Port"] = {"1": {"name": "1", "vlan_tag": 2}}
+
+    changes = cfgdb.diff_config(old, new)
+    assert ["delete", ["Interface"]] in changes
+    assert ["set", ["System", "hostname"], "other"] in changes
+    assert ["set", ["System", "bridges", "bridge_normal", "vlans", "1",
+                    "name"], "VLAN1"] in changes
+
+    data = sample_config()
+    cfgdb.apply_config_changes(data, changes)
+    assert data == new
+
+    # And back
+    cfgdb.apply_config_changes(data, cfgdb.diff_config(new, old))
+    assert data == old
+
+    assert cfgdb.diff_config(old, sample_config()) == []
+
+
+def test_diff_apply_config_nested_delete():
+    old = sample_config()
+    new = sample_config()
+    del new["System"]["bridges"]["bridge_normal"]["vlans"]["1"]
+    new["System"]["bridges"]["bridge_normal"]["ports"] = []
+
+    changes = cfgdb.diff_config(old, new)
+    assert sorted(changes) == [
+        ["delete", ["System", "bridges", "bridge_normal", "vlans", "1"]],
+        ["set", ["System", "bridges", "bridge_normal", "ports"], []]]
+
+    data = sample_config()
+    cfgdb.apply_config_changes(data, changes)
+    assert data == new
+
+    # Deleting what is already gone, or setting under a missing parent
+    cfgdb.apply_config_changes(data, [["delete", ["VRF", "vrf_default"]],
+                                      ["set", ["VRF", "red", "name"], "red"]])
+    assert data["VRF"] == {"red": {"name": "red"}}
+
+
+def test_journal_changes_stale_base():
+    config = cfgdb.encode_config(sample_config())
+    base = cfgdb.get_config_digest(config)
+    stale = cfgdb.get_config_digest(cfgdb.encode_config(sample_config("x")))
+
+    journal = [
+        cfgdb.encode_config({"base": base, "seq": 2,
+                             "changes": [["set", ["A"], 2]]}),
+        cfgdb.encode_config({"base": stale, "seq": 3,
+                             "changes": [["set", ["A"], 3]]}),
+        cfgdb.encode_config({"base": base, "seq": 1,
+                             "changes": [["set", ["A"], 1],
+                                         ["set", ["B"], 1]]})]
+
+    assert cfgdb.journal_changes(config, journal) == \
+        [["set", ["A"], 1], ["set", ["B"], 1], ["set", ["A"], 2]]
+    assert [entry["seq"] for entry, size in
+            cfgdb.journal_entries(config, journal)] == [1, 2]
+
+    # Only the stale rows left
+    assert cfgdb.journal_changes(config, journal[1:2]) == []
+    # A config without digest has no journal
+    assert cfgdb.journal_changes(
+        cfgdb.encode_config(sample_config(), digest=""), journal) == []
+
+
+def test_append_journal_date_mismatch(configdb):
+    cfg = cfgdb.Cfgdb()
+    cfg.config = cfgdb.encode_config(sample_config())
+    cfg.date = cfgdb.current_date()
+    cfg.insert_row()
+    base = cfgdb.get_config_digest(cfg.config)
+
+    changes = [["set", ["System", "hostname"], "other"]]
+    assert cfg.append_journal(base, cfg.date, 1, changes) > 0
+    # The startup row has been saved since
+    assert cfg.append_journal(base, "2000-01-01T00:00:00.000000Z", 2,
+                              changes) is None
+    assert cfg.append_journal(base, None, 2, changes) is None
+
+    cfg.idl.run()
+    assert [cfgdb.column_value(row.name)
+            for row in cfg.list_rows(cfgdb.JOURNAL_TYPE)] == ["00000001"]
+    row = cfg.find_row("startup")
+    expected = sample_config("other")
+    assert dict(cfg.iter_config(row)) == expected
+    cfg.close()
+
+
+def chunk_rows(cfg):
+    return dict((cfgdb.column_value(chunk.name), cfgdb.chunk_owners(chunk))
+                for chunk in cfg.list_rows(cfgdb.CHUNK_TYPE))
+
+
+def test_chunk_owners(configdb):
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    for name, hostname in [("a", "a"), ("b", "b")]:
+        status, evicted = cfg.save_checkpoint(name, None, 0,
+                                              data=sample_config(hostname))
+        assert status == "success"
+
+    # The Interface chunk is shared, the System chunks are not
+    a = cfgdb.config_chunk_hashes(cfg.read_config(
+        cfg.find_row(cfgdb.CHECKPOINT_TYPE, "a")))
+    b = cfgdb.config_chunk_hashes(cfg.read_config(
+        cfg.find_row(cfgdb.CHECKPOINT_TYPE, "b")))
+    shared = set(a) & set(b)
+    assert len(shared) == 1
+    owners = chunk_rows(cfg)
+    for chunk_hash in a:
+        assert ("checkpoint", "a") in owners[chunk_hash]
+    for chunk_hash in shared:
+        assert owners[chunk_hash] == set([("checkpoint", "a"),
+                                          ("checkpoint", "b")])
+
+    # Deleting "a" keeps the shared chunk, owned by "b" only
+    assert cfg.delete_row_by_type(cfgdb.CHECKPOINT_TYPE, "a") == \
+        ("success", True)
+    assert chunk_rows(cfg) == dict((chunk_hash, set([("checkpoint", "b")]))
+                                   for chunk_hash in b)
+
+    # Overwriting "b" with a blob deletes its chunks
+    cfg.close()
+    cfg = cfgdb.Cfgdb()
+    row = cfg.find_row(cfgdb.CHECKPOINT_TYPE, "b")
+    cfg.config = cfgdb.encode_config(sample_config("b"))
+    cfg.type, cfg.name = cfgdb.CHECKPOINT_TYPE, "b"
+    row, status = cfg.update_row(row)
+    assert status == "success"
+    assert chunk_rows(cfg) == {}
+    cfg.close()
+
+
+def test_legacy_chunk_owners(configdb):
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    for name in ["a", "b"]:
+        status, evicted = cfg.save_checkpoint(name, None, 0,
+                                              data=sample_config(name))
+        assert status == "success"
+    hashes = sorted(chunk_rows(cfg))
+    cfg.close()
+
+    # Chunks saved before their owners were listed
+    configdb.transact("configdb", [
+        {"op": "update", "table": cfgdb.CONFIG_TABLE,
+         "where": [["type", "==", cfgdb.CHUNK_TYPE]],
+         "row": {"writer": ["set", []]}}])
+
+    cfg = cfgdb.Cfgdb(columns=cfgdb.METADATA_COLUMNS)
+    assert set(chunk_rows(cfg).values()) == set([None])
+    status, evicted = cfg.save_checkpoint("c", None, 0,
+                                          data=sample_config("c"))
+    assert status == "success"
+
+    # The owners are read from the saved configs and written back
+    owners = chunk_rows(cfg)
+    assert None not in owners.values()
+    for name in ["a", "b", "c"]:
+        row = cfg.find_row(cfgdb.CHECKPOINT_TYPE, name)
+        for chunk_hash in cfgdb.config_chunk_hashes(cfg.read_config(row)):
+            assert ("checkpoint", name) in owners[chunk_hash]
+    assert set(hashes) <= set(owners)
+    cfg.close()
@@ -0,0 +1,101 @@
+# Copyright (C) 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import json
+
+TOPOLOGY = """
+#
+# +-------+
+# |  sw1  |
+# +-------+
+#
+
+# Nodes
+[type=openswitch name="Switch 1"] sw1
+"""
+
+# Cold starts measured per command; the best of RUNS is reported
+RUNS = 3
+
+# Modules only the commands touching the running db should load
+HEAVY_MODULES = ["ops.dc", "opsrest.settings", "opslib.restparser"]
+
+# (command argv, whether it is allowed to load HEAVY_MODULES)
+COMMANDS = [
+    (["copy", "running-config", "startup-config"], True),
+    (["show", "startup-config", "json"], False),
+    (["copy", "startup-config", "running-config"], True),
+    (["delete", "startup-config"], False),
+]
+
+# Run in a fresh interpreter: time the import of the entry point and
+# the command, and report which heavy modules got loaded.
+COLD_START_SCRIPT = (
+    "import sys, time, json\n"
+    "t0 = time.time()\n"
+    "import %(module)s\n"
+    "t1 = time.time()\n"
+    "%(run)s\n"
+    "t2 = time.time()\n"
+    "heavy = [m for m in %(heavy)r if m in sys.modules]\n"
+    "sys.stdout.write('\\nCOLDSTART ' + json.dumps("
+    "{'import': t1 - t0, 'total': t2 - t0, 'heavy': heavy}) + '\\n')\n"
+)
+
+
+def cold_start(switch, module, run="pass"):
+    script = COLD_START_SCRIPT % {"module": module, "run": run,
+                                  "heavy": HEAVY_MODULES}
+    script = script.replace("'", "'\"'\"'")
+    output = switch("python -c '%s'" % script, shell='bash')
+
+    for line in output.splitlines():
+        if line.startswith("COLDSTART "):
+            return json.loads(line[len("COLDSTART "):])
+
+    assert False, "No timing reported: %s" % output
+
+
+def best_of(switch, module, run="pass"):
+    results = [cold_start(switch, module, run) for i in range(RUNS)]
+    return min(results, key=lambda result: result["total"])
+
+
+def test_cfgdbutil_import_time(topology, step):
+    sw1 = topology.get('sw1')
+
+    assert sw1 is not None
+
+    step("### Cold start of the cfgdbutil and ops_cfgd entry points ###")
+    for module in ["cfgdbutil", "ops_cfgd"]:
+        result = best_of(sw1, module)
+        step("import %s: %.3f sec" % (module, result["import"]))
+
+        assert result["heavy"] == []
+
+    step("### Cold start of each cfgdbutil command ###")
+    sw1('configure terminal')
+    sw1('lldp holdtime 9')
+    sw1('end')
+
+    for argv, heavy in COMMANDS:
+        run = "cfgdbutil.run_command('cfgdbutil', %r)" % (["--local"] + argv)
+        result = best_of(sw1, "cfgdbutil", run)
+        step("cfgdbutil %s: import %.3f sec, total %.3f sec, loaded %s"
+             % (" ".join(argv), result["import"], result["total"],
+                result["heavy"]))
+
+        if not heavy:
+            assert result["heavy"] == []
@@ -0,0 +1,509 @@
+# Copyright (C) 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import copy
+
+import pytest
+
+import fakeovsdb
+
+import ovs.db.idl
+import ovs.db.schema
+import ovs.poller
+import ovs.timeval
+
+import cfgdb
+import cfgrestore
+import cfgsnapshot
+
+SUCCESS = ovs.db.idl.Transaction.SUCCESS
+UNCHANGED = ovs.db.idl.Transaction.UNCHANGED
+ERROR = ovs.db.idl.Transaction.ERROR
+
+
+def _set(ref_table):
+    return {"type": {"key": {"type": "uuid", "refTable": ref_table},
+                     "min": 0, "max": "unlimited"}}
+
+
+def _optional(key):
+    return {"type": {"key": key, "min": 0, "max": 1}}
+
+
+RUNNING_SCHEMA = {
+    "name": "OpenSwitch",
+    "version": "1.0.0",
+    "tables": {
+        "System": {
+            "isRoot": True,
+            "maxRows": 1,
+            "columns": {"hostname": _optional("string"),
+                        "bridges": _set("Bridge"),
+                        "vrfs": _set("VRF")}},
+        "Bridge": {
+            "indexes": [["name"]],
+            "columns": {"name": {"type": "string"},
+                        "ports": _set("Port"),
+                        "vlans": _set("VLAN")}},
+        "VRF": {
+            "indexes": [["name"]],
+            "columns": {"name": {"type": "string"},
+                        "ports": _set("Port")}},
+        "Port": {
+            "isRoot": True,
+            "indexes": [["name"]],
+            "columns": {"name": {"type": "string"},
+                        "tag": _optional("integer"),
+                        "interfaces": _set("Interface")}},
+        "Interface": {
+            "isRoot": True,
+            "indexes": [["name"]],
+            "columns": {"name": {"type": "string"},
+                        "admin": _optional("string")}},
+        "VLAN": {
+            "indexes": [["id"]],
+            "columns": {"id": {"type": "integer"},
+                        "name": {"type": "string"}}},
+        # Children of VRF pointing back to it, with a reference that can
+        # not be empty
+        "Neighbor": {
+            "isRoot": True,
+            "columns": {"ip": {"type": "string"},
+                        "vrf": {"type": {"key": {"type": "uuid",
+                                                 "refTable": "VRF"}}},
+                        "description": _optional("string")}}}}
+
+
+class Reference(object):
+    def __init__(self, relation):
+        self.relation = relation
+
+
+class ExtTable(object):
+    def __init__(self, indexes, config, references=None):
+        self.indexes = indexes
+        self.config = dict((column, None) for column in config)
+        self.references = dict((column, Reference(relation))
+                               for column, relation
+                               in (references or {}).iteritems())
+
+
+class ExtSchema(object):
+    ovs_tables = {
+        "System": ExtTable(["uuid"], ["hostname"],
+                           {"bridges": "child", "vrfs": "child"}),
+        "Bridge": ExtTable(["name"], ["name"],
+                           {"ports": "reference", "vlans": "child"}),
+        "VRF": ExtTable(["name"], ["name"], {"ports": "reference"}),
+        "Port": ExtTable(["name"], ["name", "tag"],
+                         {"interfaces": "reference"}),
+        "Interface": ExtTable(["name"], ["name", "admin"]),
+        "VLAN": ExtTable(["id"], ["id", "name"]),
+        "Neighbor": ExtTable(["ip"], ["ip", "description"],
+                             {"vrf": "parent"})}
+
+
+SAVED = {
+    "System": {
+        "hostname": "switch",
+        "bridges": {"bridge_normal": {
+            "name": "bridge_normal",
+            "ports": ["1", "2"],
+            "vlans": {"1": {"id": 1, "name": "DEFAULT_VLAN_1"},
+                      "20": {"id": "20", "name": "VLAN20"}}}},
+        "vrfs": {"vrf_default": {
+            "name": "vrf_default",
+            "ports": ["2"],
+            "Neighbor": {"10.0.0.1": {"ip": "10.0.0.1",
+                                      "description": "peer"}}}}},
+    "Port": {"1": {"name": "1", "interfaces": ["1"], "tag": "5"},
+             "2": {"name": "2", "interfaces": ["2"]}},
+    "Interface": {"1": {"name": "1", "admin": "up"},
+                  "2": {"name": "2"}}}
+
+# What the db holds once SAVED is restored, see dump()
+RESTORED = {
+    "System": {"System": {"hostname": "switch",
+                          "bridges": ["Bridge:bridge_normal"],
+                          "vrfs": ["VRF:vrf_default"]}},
+    "Bridge": {"Bridge:bridge_normal": {
+        "name": "bridge_normal", "ports": ["Port:1", "Port:2"],
+        "vlans": ["VLAN:1", "VLAN:20"]}},
+    "VRF": {"VRF:vrf_default": {"name": "vrf_default",
+                                "ports": ["Port:2"]}},
+    "Port": {"Port:1": {"name": "1", "tag": 5,
+                        "interfaces": ["Interface:1"]},
+             "Port:2": {"name": "2", "tag": [],
+                        "interfaces": ["Interface:2"]}},
+    "Interface": {"Interface:1": {"name": "1", "admin": "up"},
+                  "Interface:2": {"name": "2", "admin": []}},
+    "VLAN": {"VLAN:1": {"id": 1, "name": "DEFAULT_VLAN_1"},
+             "VLAN:20": {"id": 20, "name": "VLAN20"}},
+    "Neighbor": {"Neighbor:10.0.0.1": {"ip": "10.0.0.1",
+                                       "vrf": "VRF:vrf_default",
+                                       "description": "peer"}}}
+
+INDEXES = {"Bridge": "name", "VRF": "name", "Port": "name",
+           "Interface": "name", "VLAN": "id", "Neighbor": "ip"}
+
+
+@pytest.fixture
+def running(tmpdir):
+    server = fakeovsdb.FakeOvsdb(str(tmpdir.join("db.sock")),
+                                 [RUNNING_SCHEMA])
+    server.schema_path = fakeovsdb.write_schema(tmpdir, RUNNING_SCHEMA)
+    yield server
+    server.close()
+
+
+def open_idl(server):
+    schema_helper = ovs.db.idl.SchemaHelper(location=server.schema_path)
+    schema_helper.register_all()
+    idl = ovs.db.idl.Idl(server.remote, schema_helper)
+    sync(idl, 0)
+    return idl
+
+
+def sync(idl, seqno):
+    '''
+    Run idl until its change_seqno moves past seqno.
+    '''
+    deadline = ovs.timeval.msec() + 2000
+    while ovs.timeval.msec() < deadline:
+        idl.run()
+        if idl.change_seqno != seqno:
+            break
+        poller = ovs.poller.Poller()
+        idl.wait(poller)
+        poller.timer_wait_until(deadline)
+        poller.block()
+
+
+def dump(server):
+    '''
+    Returns the content of the running db as table -> name -> row, rows
+    and references named after their table and index.
+    '''
+    schema = ovs.db.schema.DbSchema.from_json(RUNNING_SCHEMA)
+    tables = dict((table_name, server.rows("OpenSwitch", table_name))
+                  for table_name in schema.tables)
+    names = {}
+    for table_name, rows in tables.iteritems():
+        for row in rows:
+            index = INDEXES.get(table_name)
+            names[row["_uuid"][1]] = (
+                "%s:%s" % (table_name, row[index]) if index else table_name)
+
+    def value(column, json):
+        if isinstance(json, list) and json[0] == "set":
+            atoms = json[1]
+        else:
+            atoms = [json]
+        atoms = sorted(names[atom[1]] if isinstance(atom, list) else atom
+                       for atom in atoms)
+        if column.type.n_max == 1 and atoms:
+            return atoms[0]
+        return atoms
+
+    dumped = {}
+    for table_name, rows in tables.iteritems():
+        columns = schema.tables[table_name].columns
+        for row in rows:
+            dumped.setdefault(table_name, {})[names[row["_uuid"][1]]] = \
+                dict((column_name, value(columns[column_name], json))
+                     for column_name, json in row.iteritems()
+                     if column_name != "_uuid")
+    return dumped
+
+
+def fill_running(server):
+    '''
+    A running db holding part of SAVED, and rows SAVED does not have.
+    '''
+    server.transact("OpenSwitch", [
+        {"op": "insert", "table": "Interface", "uuid-name": "i1",
+         "row": {"name": "1", "admin": "down"}},
+        {"op": "insert", "table": "Interface", "uuid-name": "i9",
+         "row": {"name": "9"}},
+        {"op": "insert", "table": "Port", "uuid-name": "old",
+         "row": {"name": "old",
+                 "interfaces": ["set", [["named-uuid", "i9"]]]}},
+        {"op": "insert", "table": "VLAN", "uuid-name": "v1",
+         "row": {"id": 1, "name": "OLD"}},
+        {"op": "insert", "table": "Bridge", "uuid-name": "br",
+         "row": {"name": "bridge_normal",
+                 "ports": ["set", [["named-uuid", "old"]]],
+                 "vlans": ["set", [["named-uuid", "v1"]]]}},
+        {"op": "insert", "table": "System",
+         "row": {"hostname": "old",
+                 "bridges": ["set", [["named-uuid", "br"]]]}}])
+
+
+def test_schema_replica_flattens_saved_config():
+    schema = ovs.db.schema.DbSchema.from_json(RUNNING_SCHEMA)
+    plan = cfgrestore.RestorePlan(ExtSchema(),
+                                  cfgrestore.SchemaReplica(schema))
+    plan.load(copy.deepcopy(SAVED))
+
+    assert sorted((saved.table, saved.index) for saved in plan.rows) == [
+        ("Bridge", "bridge_normal"), ("Interface", "1"), ("Interface", "2"),
+        ("Neighbor", "10.0.0.1"), ("Port", "1"), ("Port", "2"),
+        ("System", None), ("VLAN", "1"), ("VLAN", "20"),
+        ("VRF", "vrf_default")]
+    assert plan.deleted == []
+
+    # Rows come after the rows they depend on
+    ordered = [(saved.table, saved.index) for saved in plan._ordered_rows()]
+    for before, after in [(("System", None), ("Bridge", "bridge_normal")),
+                          (("Bridge", "bridge_normal"), ("VLAN", "20")),
+                          (("VRF", "vrf_default"), ("Neighbor", "10.0.0.1"))]:
+        assert ordered.index(before) < ordered.index(after)
+
+    # Everything is inserted, referring to each other by name
+    operations = plan.transact_operations()
+    assert set(op["op"] for op in operations) == set(["insert"])
+    names = dict((op["uuid-name"], op) for op in operations)
+    neighbor = [op for op in operations if op["table"] == "Neighbor"][0]
+    assert neighbor["row"]["vrf"][0] == "named-uuid"
+    assert names[neighbor["row"]["vrf"][1]]["table"] == "VRF"
+
+
+def test_replace_db(running):
+    fill_running(running)
+    schema = ovs.db.schema.DbSchema.from_json(RUNNING_SCHEMA)
+
+    assert cfgrestore.replace_db(copy.deepcopy(SAVED), ExtSchema(), schema,
+                                 running.remote) == SUCCESS
+    assert dump(running) == RESTORED
+
+
+def test_replace_db_reuses_the_schema(running):
+    schema = ovs.db.schema.DbSchema.from_json(RUNNING_SCHEMA)
+    assert cfgrestore.replace_db(copy.deepcopy(SAVED), ExtSchema(), schema,
+                                 running.remote) == SUCCESS
+
+    # The replica starts empty again, and unknown tables are skipped
+    saved = {"System": {"hostname": "other"},
+             "Interface": {"1": {"name": "1", "admin": "up"}},
+             "Unknown": {"1": {"name": "1"}}}
+    replica = cfgrestore.SchemaReplica(schema)
+    assert replica.name == "OpenSwitch"
+    assert all(not table.rows for table in replica.tables.itervalues())
+    assert cfgrestore.replace_db(saved, ExtSchema(), schema,
+                                 running.remote) == SUCCESS
+    assert dump(running) == {
+        "System": {"System": {"hostname": "other", "bridges": [],
+                              "vrfs": []}},
+        "Interface": {"Interface:1": {"name": "1", "admin": "up"}}}
+
+
+def test_replace_db_errors(running, tmpdir):
+    schema = ovs.db.schema.DbSchema.from_json(RUNNING_SCHEMA)
+    assert cfgrestore.replace_db(
+        copy.deepcopy(SAVED), ExtSchema(), schema,
+        "unix:%s" % tmpdir.join("missing.sock")) == ERROR
+
+    # A db without one of the tables fails the whole transaction
+    fill_running(running)
+    dumped = dump(running)
+    other = copy.deepcopy(RUNNING_SCHEMA)
+    other["tables"]["Extra"] = {"isRoot": True,
+                                "columns": {"name": {"type": "string"}}}
+    assert cfgrestore.replace_db(
+        copy.deepcopy(SAVED), ExtSchema(),
+        ovs.db.schema.DbSchema.from_json(other), running.remote) == ERROR
+    assert dump(running) == dumped
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 500])
+def test_write_batched(running, batch_size):
+    fill_running(running)
+    idl = open_idl(running)
+
+    assert cfgrestore.write_batched(copy.deepcopy(SAVED), ExtSchema(), idl,
+                                    batch_size) == SUCCESS
+    # Interface 9 and Port old are not saved
+    assert dump(running) == RESTORED
+    idl.close()
+
+
+def test_write_batched_only_changed(running):
+    fill_running(running)
+    idl = open_idl(running)
+
+    assert cfgrestore.write_batched(copy.deepcopy(SAVED), ExtSchema(), idl,
+                                    2, only_changed=True) == SUCCESS
+    assert dump(running) == RESTORED
+
+    n_writes = running.n_writes
+    assert cfgrestore.write_batched(copy.deepcopy(SAVED), ExtSchema(), idl,
+                                    2, only_changed=True) == UNCHANGED
+    assert running.n_writes == n_writes
+    idl.close()
+
+
+@pytest.mark.parametrize("only_changed", [False, True])
+def test_write_batched_single_transaction(running, only_changed):
+    fill_running(running)
+    idl = open_idl(running)
+
+    n_writes = running.n_writes
+    assert cfgrestore.write_batched(copy.deepcopy(SAVED), ExtSchema(), idl,
+                                    0, only_changed) == SUCCESS
+    assert running.n_writes == n_writes + 1
+    assert dump(running) == RESTORED
+
+    # Only the row the saved config does not have is deleted
+    seqno = idl.change_seqno
+    running.transact("OpenSwitch", [
+        {"op": "insert", "table": "Interface", "row": {"name": "10"}}])
+    sync(idl, seqno)
+    assert cfgrestore.write_batched(copy.deepcopy(SAVED), ExtSchema(), idl,
+                                    0, only_changed) == SUCCESS
+    assert running.n_writes == n_writes + 3
+    assert dump(running) == RESTORED
+    idl.close()
+
+
+def test_write_direct(running):
+    fill_running(running)
+
+    assert cfgrestore.write_direct(copy.deepcopy(SAVED), ExtSchema(),
+                                   running.schema_path,
+                                   running.remote) == SUCCESS
+    assert dump(running) == RESTORED
+
+    n_writes = running.n_writes
+    assert cfgrestore.write_direct(copy.deepcopy(SAVED), ExtSchema(),
+                                   running.schema_path, running.remote,
+                                   only_changed=True) == UNCHANGED
+    assert running.n_writes == n_writes
+
+
+def test_write_direct_rereads_changed_rows(running, monkeypatch):
+    fill_running(running)
+    assert cfgrestore.write_direct(copy.deepcopy(SAVED), ExtSchema(),
+                                   running.schema_path,
+                                   running.remote) == SUCCESS
+    running.transact("OpenSwitch", [
+        {"op": "update", "table": "System", "where": [],
+         "row": {"hostname": "old"}}])
+
+    # A config column of a row changes between the read and the write
+    read_snapshot = cfgsnapshot.read_snapshot
+    changes = [{"op": "update", "table": "Interface",
+                "where": [["name", "==", "1"]], "row": {"admin": "down"}}]
+    reads = []
+
+    def racing_read_snapshot(extschema, ovsschema, remote):
+        replica = read_snapshot(extschema, ovsschema, remote)
+        reads.append(replica)
+        if len(reads) == 1:
+            running.transact("OpenSwitch", changes)
+        return replica
+
+    monkeypatch.setattr(cfgsnapshot, "read_snapshot", racing_read_snapshot)
+    # With the schema already loaded
+    assert cfgrestore.write_direct(copy.deepcopy(SAVED), ExtSchema(),
+                                   copy.deepcopy(RUNNING_SCHEMA),
+                                   running.remote,
+                                   only_changed=True) == SUCCESS
+    assert len(reads) == 2
+    assert dump(running) == RESTORED
+
+
+def test_execute_plan_deletes_unsaved_rows(running):
+    fill_running(running)
+    idl = open_idl(running)
+    assert cfgrestore.write_batched(copy.deepcopy(SAVED), ExtSchema(),
+                                    idl, 500) == SUCCESS
+    plan = cfgrestore.compile_plan(copy.deepcopy(SAVED), ExtSchema(), idl,
+                                   "fingerprint")
+    idl.close()
+    assert plan["delete"] == ["Interface", "Neighbor", "Port"]
+
+    # Rows added since the plan was compiled go away
+    running.transact("OpenSwitch", [
+        {"op": "insert", "table": "Interface", "row": {"name": "10"}}])
+
+    assert cfgrestore.execute_plan(plan, "OpenSwitch",
+                                   running.remote) == SUCCESS
+    assert dump(running) == RESTORED
+
+
+
+def plan_of(rows, delete=()):
+    return {"version": cfgdb.PLAN_VERSION, "schema": "fingerprint",
+            "rows": rows, "delete": list(delete)}
+
+
+def test_plan_operations_match_sets_in_any_order(running):
+    fill_running(running)
+    running.transact("OpenSwitch", [
+        {"op": "insert", "table": "Port",
+         "row": {"name": "lag",
+                 "interfaces": ["set", [
+                     ["uuid", row["_uuid"][1]]
+                     for row in running.rows("OpenSwitch", "Interface")]]}}])
+    ports = dict((row["name"], row["_uuid"][1])
+                 for row in running.rows("OpenSwitch", "Port"))
+
+    interfaces = [{"table": "Interface", "name": "if%s" % name,
+                   "match": [["name", "==", name]], "row": None}
+                  for name in ["1", "9"]]
+    for members in [["if1", "if9"], ["if9", "if1"]]:
+        rows = interfaces + [
+            # Looked up by a set of references, in either order
+            {"table": "Port", "name": "lag",
+             "match": [["interfaces", "==",
+                        ["set", [["named-uuid", member]
+                                 for member in members]]]],
+             "row": {"tag": 7}},
+            # A set of one atom, which the db server sends as the atom
+            {"table": "Port", "name": "old",
+             "match": [["interfaces", "==",
+                        ["set", [["named-uuid", "if9"]]]]],
+             "row": {"tag": 9}}]
+        operations = cfgrestore._plan_operations(plan_of(rows), "OpenSwitch",
+                                                 running.remote)
+        updates = dict((op["where"][0][2][1], op["row"])
+                       for op in operations if op["op"] == "update")
+        assert updates == {ports["lag"]: {"tag": 7},
+                           ports["old"]: {"tag": 9}}
+        assert "insert" not in [op["op"] for op in operations]
+
+
+def test_execute_plan_errors(running):
+    fill_running(running)
+    before = dump(running)
+    n_writes = running.n_writes
+
+    # A row the plan refers to is not there
+    rows = [{"table": "Interface", "name": "if5",
+             "match": [["name", "==", "5"]], "row": None},
+            {"table": "Port", "name": "p5", "match": [["name", "==", "5"]],
+             "row": {"name": "5",
+                     "interfaces": ["set", [["named-uuid", "if5"]]]}}]
+    assert cfgrestore.execute_plan(plan_of(rows), "OpenSwitch",
+                                   running.remote) == ERROR
+
+    # A plan of another version
+    plan = plan_of(rows[1:])
+    plan["version"] = cfgdb.PLAN_VERSION + 1
+    assert cfgrestore.execute_plan(plan, "OpenSwitch",
+                                   running.remote) == ERROR
+
+    assert running.n_writes == n_writes
+    assert dump(running) == before
@@ -0,0 +1,230 @@
+# Copyright (C) 2016 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import sys
+import types
+
+import pytest
+
+import fakeovsdb
+
+import ovs.db.idl
+import ovs.poller
+import ovs.timeval
+
+import cfgdb
+import cfgschema
+import ops_cfgd
+
+RUNNING_SCHEMA = {
+    "name": "OpenSwitch",
+    "version": "1.0.0",
+    "tables": {
+        "System": {
+            "isRoot": True,
+            "maxRows": 1,
+            "columns": {
+                "cur_hw": {"type": "integer"},
+                "cur_cfg": {"type": "integer"},
+                "next_cfg": {"type": "integer"},
+                "hostname": {"type": {"key": "string", "min": 0, "max": 1}},
+                "vlans": {"type": {"key": {"type": "uuid",
+                                           "refTable": "VLAN"},
+                                   "min": 0, "max": "unlimited"}}}},
+        "VLAN": {
+            "isRoot": True,
+            "columns": {
+                "id": {"type": "integer"},
+                "name": {"type": {"key": "string", "min": 0, "max": 1}}}}}}
+
+SAVED = {"System": {"hostname": "switch",
+                    "vlans": {"1": {"id": 1, "name": "VLAN1"},
+                              "2": {"id": 2, "name": "VLAN2"}}}}
+
+
+class ExtTable(object):
+    def __init__(self, config, references):
+        self.indexes = []
+        self.config = dict((column, None) for column in config)
+        self.references = dict((column, None) for column in references)
+
+
+class ExtSchema(object):
+    ovs_tables = {"System": ExtTable(["hostname"], ["vlans"]),
+                  "VLAN": ExtTable(["id", "name"], [])}
+
+
+def write_running(data, extschema, opsidl, txn):
+    '''
+    Stands in for ops.dc.write(), for the hostname only.
+    '''
+    for row in opsidl.tables["System"].rows.itervalues():
+        row.hostname = data["System"]["hostname"]
+    return txn.commit()
+
+
+@pytest.fixture
+def cfgd(tmpdir, monkeypatch):
+    '''
+    A resident cfgd (its boot steps, without the daemon around them) on
+    a db server holding a startup config.
+    '''
+    server = fakeovsdb.FakeOvsdb(str(tmpdir.join("db.sock")),
+                                 [fakeovsdb.CONFIGDB_SCHEMA, RUNNING_SCHEMA])
+    configdb_schema = fakeovsdb.write_schema(tmpdir,
+                                             fakeovsdb.CONFIGDB_SCHEMA)
+    monkeypatch.setattr(cfgdb, "def_db", server.remote)
+    monkeypatch.setattr(cfgdb, "cfgdb_schema", configdb_schema)
+    monkeypatch.setattr(cfgschema, "load_extschema", lambda: ExtSchema())
+    monkeypatch.setattr(cfgschema, "schema_fingerprint",
+                        lambda ovsschema=None, ext_schema=None: "schemas")
+
+    ops = types.ModuleType("ops")
+    ops.dc = types.ModuleType("ops.dc")
+    ops.dc.write = write_running
+    monkeypatch.setitem(sys.modules, "ops", ops)
+    monkeypatch.setitem(sys.modules, "ops.dc", ops.dc)
+
+    for name, value in [
+            ("cfgdb_schema", configdb_schema),
+            ("ovs_schema", fakeovsdb.write_schema(tmpdir, RUNNING_SCHEMA)),
+            ("resident", True), ("exiting", False),
+            ("sessions", ops_cfgd.BootSessions(server.remote)),
+            ("idl", None), ("saved_config", None), ("saved_chunks", None),
+            ("saved_journal", None), ("saved_plan", None),
+            ("startup_data", None), ("startup_fingerprint", None),
+            ("watch_armed", False), ("prefetch_thread", None),
+            ("prefetch_result", {}), ("prefetch_wakeup", None),
+            ("step_start_msec", None), ("boot_stats", {"phases": []}),
+            ("boot_stats_file", None), ("profile_dir", None)]:
+        monkeypatch.setattr(ops_cfgd, name, value)
+
+    cfg = cfgdb.Cfgdb()
+    cfg.config = cfgdb.encode_config({"System": {"hostname": "saved"}})
+    cfg.insert_row()
+    cfg.close()
+
+    yield server
+    ops_cfgd.sessions.close()
+    server.close()
+
+
+def run_cfgd(done):
+    '''
+    Run the main loop of cfgd until done() or cfgd exits.
+    '''
+    deadline = ovs.timeval.msec() + 5000
+    while not ops_cfgd.exiting and not done():
+        assert ovs.timeval.msec() < deadline
+        ops_cfgd.sessions.run()
+        if ops_cfgd.prefetch_wakeup is not None:
+            ops_cfgd.clear_wakeup()
+        if ops_cfgd.dispatcher():
+            continue
+
+        poller = ovs.poller.Poller()
+        ops_cfgd.sessions.wait(poller)
+        if ops_cfgd.prefetch_wakeup is not None:
+            poller.fd_wait(ops_cfgd.prefetch_wakeup[0], ovs.poller.POLLIN)
+        poller.timer_wait(100)
+        poller.block()
+
+
+def watching():
+    return (ops_cfgd.dispatch_list[ops_cfgd.loop_seq_no] ==
+            ops_cfgd.wait_for_reset and ops_cfgd.watch_armed)
+
+
+def system(server):
+    row, = server.rows("OpenSwitch", "System")
+    return row["hostname"], row["cur_cfg"]
+
+
+def reset_running(server):
+    '''
+    What the db looks like once ovsdb-server restarted and the platform
+    daemons are done.
+    '''
+    server.transact("OpenSwitch", [
+        {"op": "delete", "table": "System", "where": []},
+        {"op": "insert", "table": "System",
+         "row": {"cur_hw": 1, "cur_cfg": 0, "next_cfg": 0}}])
+
+
+def test_resident_repush_after_reset(cfgd, monkeypatch):
+    decoded = []
+
+    def iter_config_tables(config, *args, **kwargs):
+        decoded.append(config)
+        return iter_tables(config, *args, **kwargs)
+
+    iter_tables = cfgdb.iter_config_tables
+    monkeypatch.setattr(cfgdb, "iter_config_tables", iter_config_tables)
+    reset_running(cfgd)
+    ops_cfgd.check_for_startup_config()
+    ops_cfgd.open_running_db()
+    ops_cfgd.init_dispatcher()
+    run_cfgd(watching)
+    assert system(cfgd) == ("saved", 1)
+
+    # The kept config is pushed again, without decoding it
+    reset_running(cfgd)
+    run_cfgd(lambda: watching() and system(cfgd)[1] == 1)
+    assert not ops_cfgd.exiting
+    assert ops_cfgd.boot_stats["resets"] == 1
+    assert system(cfgd) == ("saved", 1)
+    assert len(decoded) == 1
+
+
+def test_resident_restart_watches_for_resets(cfgd):
+    # Restarted once the boot is done: nothing is pushed again
+    cfgd.transact("OpenSwitch", [
+        {"op": "insert", "table": "System",
+         "row": {"cur_hw": 1, "cur_cfg": 1, "next_cfg": 1,
+                 "hostname": "changed"}}])
+    ops_cfgd.check_for_startup_config()
+    ops_cfgd.open_running_db()
+    ops_cfgd.init_dispatcher()
+    run_cfgd(watching)
+    assert not ops_cfgd.exiting
+    assert system(cfgd) == ("changed", 1)
+
+    # ovsdb-server restarted: the startup config is pushed again
+    reset_running(cfgd)
+    run_cfgd(lambda: watching() and system(cfgd)[1] == 1)
+    assert not ops_cfgd.exiting
+    assert ops_cfgd.boot_stats["resets"] == 1
+    assert system(cfgd) == ("saved", 1)
+    assert ops_cfgd.startup_data == {"System": {"hostname": "saved"}}
+
+
+def test_prefetch_profile_phases(tmpdir, monkeypatch):
+    monkeypatch.setitem(sys.modules, "ops", types.ModuleType("ops"))
+    monkeypatch.setitem(sys.modules, "ops.dc", types.ModuleType("ops.dc"))
+    monkeypatch.setattr(cfgschema, "load_ovsschema_json",
+                        lambda path=None: RUNNING_SCHEMA)
+    monkeypatch.setattr(cfgschema, "load_extschema", lambda: None)
+    monkeypatch.setattr(ops_cfgd, "profile_dir", str(tmpdir))
+    monkeypatch.setattr(ops_cfgd, "boot_stats", {"phases": []})
+
+    result = {"config": cfgdb.encode_config(SAVED)}
+    ops_cfgd.load_startup_config(result)
+    assert result["data"] == SAVED
+    assert ops_cfgd.boot_stats["rows"] == 3
+
+    # <name>-<pid>-<time>-<NN>-<phase>.prof, in phase order
+    phases = [path.basename[:-len(".prof")].rsplit("-", 1)[1]
+              for path in sorted(tmpdir.listdir("cfgd-prefetch-*.prof"))]
+    assert phases == ["decode", "schema_parse", "decode"]
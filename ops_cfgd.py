@@ -16,13 +16,17 @@
 
 import os
 import sys
-import argparse
 import json
-from time import sleep
-import base64
+import errno
+import fcntl
+import hashlib
+import argparse
+import threading
 
 import ovs.poller
+import ovs.timeval
 import ovs.dirs
+import ovs.json
 from ovs.db import error
 from ovs.db import types
 import ovs.util
@@ -32,33 +36,187 @@ import ovs.unixctl
 import ovs.unixctl.server
 import ovs.vlog
 
-import ops.dc
-from opsrest.settings import settings
-from opslib import restparser
+# ops.dc and cfgrestore are only needed when there is a saved config to
+# push; they are imported by load_startup_config() and
+# push_config_to_db() so boots without one don't pay for them.
+import cfgdb
+import cfgprofile
+import cfgschema
 
 # ovs definitions
+# Idl sessions of the boot (see BootSessions), and its running db session
+sessions = None
 idl = None
+# System columns cfgd reads and writes
+SYSTEM_COLUMNS = ["cur_hw", "cur_cfg", "next_cfg"]
 # OPS_TODO: Need to pull this from the build env
 def_db = 'unix:/var/run/openvswitch/db.sock'
 
 # Configuration file definitions
 saved_config = None
+# Chunks of saved_config, by hash, when it is saved in the chunked layout
+saved_chunks = None
+# Changes of the journal of saved_config (see cfgdb.JOURNAL_TYPE)
+saved_journal = None
+# Restore plan of saved_config (see cfgdb.PLAN_TYPE), if it has one that
+# applies to it and to the schemas
+saved_plan = None
 # OPS_TODO: Need to pull these three from the build env
 cfgdb_schema = "%s/configdb.ovsschema" % os.environ.get("OVS_PKGDATADIR", """/usr/share/openvswitch""")
 ovs_schema = "%s/vswitch.ovsschema" % os.environ.get("OVS_PKGDATADIR", """/usr/share/openvswitch""")
 type_startup_config = "startup"
-#3 sec max retry
-max_miliseconds_to_wait_for_config_data = 30
+# Max time to wait for the configdb replica to arrive (3 sec by default)
+config_wait_msec = 3000
+# Upper bound on how long the main loop blocks without a db or unixctl
+# event before re-running the current dispatcher step (None = no bound)
+poll_timeout_msec = None
+# Max rows per transaction when pushing the startup config (0 = push the
+# whole config in one transaction)
+restore_batch_size = 0
+# Push the startup config with raw db transactions rather than through
+# the running db session (see cfgrestore.write_direct()), so the session
+# does not have to replicate the config tables
+restore_direct = False
+
+# Resident mode: stay up after the boot and push the startup config
+# again when the running db is reset (e.g. ovsdb-server restarted)
+resident = False
+# Decoded startup config kept for re-pushes, and the fingerprint of the
+# saved config it was decoded from (see config_fingerprint())
+startup_data = None
+startup_fingerprint = None
+# Set once the db shows the completed config, so a reset can be told
+# from the replica not having caught up with mark_completion() yet
+watch_armed = False
+
+# Startup config prefetch (decode done in a worker thread while we wait
+# for h/w initialization)
+prefetch_thread = None
+prefetch_result = {}
+# Pipe the prefetch worker writes to once it has loaded the schemas, to
+# wake the main loop up to widen the running db session
+prefetch_wakeup = None
+
+# Boot phase timings, config size and row counts (see record_phase()),
+# reported by the cfgd/boot-stats unixctl command and written to
+# boot_stats_file when cfgd exits
+boot_start_msec = ovs.timeval.msec()
+boot_stats = {"phases": []}
+boot_stats_file = "%s/cfgd-boot-stats.json" % ovs.dirs.RUNDIR
+
+# Where to write cProfile and memory profiles of the boot (see cfgprofile)
+profile_dir = cfgprofile.profile_dir
 
 # Program control
 exiting = False
 loop_seq_no = 0
 dispatch_list = []
+# When the current dispatcher step was first called, and how many times
+step_start_msec = None
+step_passes = 0
 
 # VLOG
 vlog = ovs.vlog.Vlog("cfgd")
 
 
+class BootSessions(object):
+    '''
+    Idl sessions of the boot sequence, to the db server at remote: a
+    configdb session, open while the startup config is read, and a
+    single running db session shared by all the steps. The running db
+    session replicates the System columns cfgd uses and, once the
+    extended schema is loaded when there is a config to push through
+    it, the config columns of the extended schema (see
+    cfgschema.config_columns()). The main loop runs both through run()
+    and wait().
+    '''
+    def __init__(self, remote):
+        self.remote = remote
+        self.configdb = None
+        self.configdb_name = None
+        self.running = None
+        self.extschema = None
+        self._sync_start = None
+
+    def open_configdb(self):
+        '''
+        Returns the configdb session. It only replicates the type and
+        name of the config rows, the config columns that are needed are
+        read with read_configs().
+        '''
+        schema_helper_cfg = ovs.db.idl.SchemaHelper(location=cfgdb_schema)
+        schema_helper_cfg.register_columns(cfgdb.CONFIG_TABLE,
+                                           [cfgdb.TYPE, cfgdb.NAME])
+
+        self.configdb_name = schema_helper_cfg.schema_json["name"]
+        self.configdb = ovs.db.idl.Idl(self.remote, schema_helper_cfg)
+        return self.configdb
+
+    def read_configs(self, rows):
+        '''
+        Returns the config columns of rows of the configdb session, read
+        with one transaction.
+
+        Raises error.Error if they can not be read.
+        '''
+        return cfgdb.select_configs(self.remote, self.configdb_name, rows)
+
+    def close_configdb(self):
+        if self.configdb is not None:
+            self.configdb.close()
+            self.configdb = None
+
+    def open_running(self, extschema=None, replicate=True,
+                     schema_json=None):
+        '''
+        Returns the running db session, replicating the tables of
+        extschema if given and replicate is set. The session is reopened
+        if it was opened without them. schema_json is the ovs schema in
+        json, if already loaded.
+        '''
+        if self.running is not None:
+            if extschema is None or self.extschema is not None:
+                return self.running
+            if not replicate:
+                self.extschema = extschema
+                return self.running
+            self.running.close()
+
+        if schema_json is not None:
+            schema_helper = ovs.db.idl.SchemaHelper(schema_json=schema_json)
+        else:
+            schema_helper = ovs.db.idl.SchemaHelper(location=ovs_schema)
+        schema_helper.register_columns("System", SYSTEM_COLUMNS)
+        if extschema is not None and replicate:
+            cfgschema.register_config_columns(schema_helper, extschema)
+
+        self.running = ovs.db.idl.Idl(self.remote, schema_helper)
+        self.extschema = extschema
+        self._sync_start = ovs.timeval.msec()
+        return self.running
+
+    def run(self):
+        if self.configdb is not None:
+            self.configdb.run()
+        if self.running is not None:
+            self.running.run()
+            if self._sync_start is not None and self.running.change_seqno:
+                record_phase("idl_sync", self._sync_start)
+                self._sync_start = None
+
+    def wait(self, poller):
+        if self.configdb is not None:
+            self.configdb.wait(poller)
+        if self.running is not None:
+            self.running.wait(poller)
+
+    def close(self):
+        self.close_configdb()
+        if self.running is not None:
+            self.running.close()
+            self.running = None
+
+
 #####################  OVS Methods ######################
 
 #------------------ unixctl_exit() ----------------
@@ -69,6 +227,11 @@ def unixctl_exit(conn, unused_argv, unused_aux):
     conn.reply(None)
 
 
+#------------------ unixctl_boot_stats() ----------------
+def unixctl_boot_stats(conn, unused_argv, unused_aux):
+    conn.reply(json.dumps(boot_stats, indent=4, sort_keys=True))
+
+
 #------------------ db_is_cur_cfg_set() ----------------
 def db_is_cur_cfg_set(data):
     '''
@@ -111,20 +274,69 @@ def wait_for_hw_done():
 
     global idl
 
+    widen_running_db()
+
     # Check db to see if cfgd has already run.
     if db_is_cur_cfg_set(idl.tables):
+        if resident:
+            # Restarted after the boot, or the config was marked done by
+            # someone else during a re-push: watch for the next reset
+            vlog.info("cur_cfg already set...watching the db for resets")
+            return goto_step(wait_for_reset)
         vlog.info("cur_cfg already set...cfgd exiting")
         return terminate()
 
     # Check db to see if h/w initialization has completed.
 
-    if db_get_hw_done(idl.tables):
-        return True
-    else:
-        # Delay a little before trying again
-        sleep(0.2)
+    # If not, the main loop blocks until the next db change and we get
+    # called again.
+    return db_get_hw_done(idl.tables)
+
+
+#------------------ wait_for_reset() ----------------
+def wait_for_reset():
+    '''
+    Resident mode: watch the running db once the config is done. If it
+    gets reset (System:cur_cfg back to 0 once the idl has reconnected
+    and resynced), go through the boot sequence again, reusing the
+    decoded startup config unless the saved one changed.
+
+    Returns False while there is nothing to do.
+    '''
+
+    global saved_config
+    global saved_chunks
+    global saved_journal
+    global startup_data
+    global watch_armed
+
+    if db_is_cur_cfg_set(idl.tables):
+        watch_armed = True
+        return False
+
+    # Not synced yet (or disconnected)
+    if not watch_armed or not idl.tables["System"].rows:
         return False
 
+    watch_armed = False
+    boot_stats["resets"] = boot_stats.get("resets", 0) + 1
+    vlog.info("Running db was reset, pushing the startup config again")
+
+    # Only the fingerprint is checked, the saved config is not decoded
+    # again unless it changed (or was pushed with its restore plan)
+    check_for_startup_config()
+    if saved_config is None:
+        startup_data = None
+    elif (startup_data is not None and
+            config_fingerprint(saved_config, saved_journal) ==
+            startup_fingerprint):
+        saved_config = None
+        saved_chunks = None
+        saved_journal = None
+    open_running_db()
+
+    return goto_step(prefetch_config)
+
 
 #------------------ get_config() ----------------
 def get_config(idl_cfg):
@@ -133,31 +345,152 @@ def get_config(idl_cfg):
     looking for a row with type == startup.
 
     If found, set global variable saved_config to the content
-    of the "config" field in that row.
+    of the "config" field in that row (saved_chunks to its
+    chunks, for the chunked layout, saved_journal to the
+    changes of its journal and saved_plan to its restore plan).
+    The config columns of those rows only are read, with one
+    transaction for the startup row and its journal and one
+    for its chunks and restore plan.
     '''
 
     global saved_config
+    global saved_chunks
+    global saved_journal
+    global saved_plan
 
     #Note: You can't tell the difference between the config table not
     #      existing (that is the configdb is not there) or just that there
     #      are no rows in the config table.
-    tbl_found = False
-    for ovs_rec in idl_cfg.tables["config"].rows.itervalues():
-        tbl_found = True
-        if ovs_rec.type:
-            if ovs_rec.type == type_startup_config:
-                if ovs_rec.config:
-                    saved_config = ovs_rec.config
-                else:
-                    vlog.warn("startup config row does not have config column")
-                return
-
-    if not tbl_found:
+    rows = idl_cfg.tables[cfgdb.CONFIG_TABLE].rows.values()
+    if not rows:
         vlog.info("No rows found in the config table")
+        return
+
+    startup = [ovs_rec for ovs_rec in rows
+               if ovs_rec.type == type_startup_config]
+    if not startup:
+        return
+    journal = [ovs_rec for ovs_rec in rows
+               if ovs_rec.type == cfgdb.JOURNAL_TYPE]
+
+    try:
+        configs = sessions.read_configs(startup[:1] + journal)
+        if not configs[0]:
+            vlog.warn("startup config row does not have config column")
+            return
+        config = configs[0]
+        saved_journal = get_config_journal(config, configs[1:])
+
+        chunk_rows = get_config_chunks(idl_cfg, config)
+        plan_row = get_config_plan(idl_cfg, config, saved_journal)
+        extra_rows = (chunk_rows or []) + ([plan_row] if plan_row else [])
+        extra_configs = sessions.read_configs(extra_rows)
+    except error.Error, e:
+        vlog.err("Unable to read the startup config: %s" % e)
+        saved_journal = None
+        return
+
+    saved_config = config
+    if chunk_rows is not None:
+        saved_chunks = dict((cfgdb.column_value(ovs_rec.name), chunk)
+                            for ovs_rec, chunk
+                            in zip(chunk_rows, extra_configs))
+    if plan_row is not None:
+        saved_plan = extra_configs[-1] or None
+
+
+#------------------ get_config_chunks() ----------------
+def get_config_chunks(idl_cfg, config):
+    '''
+    Returns the chunk rows of a config saved in the chunked layout (see
+    cfgdb.split_config()), or None for the other layouts.
+    '''
+    try:
+        hashes = cfgdb.config_chunk_hashes(config)
+    except ValueError:
+        # Reported when the config is decoded
+        return None
+
+    if not hashes:
+        return None
+
+    hashes = set(hashes)
+    return [ovs_rec
+            for ovs_rec in idl_cfg.tables[cfgdb.CONFIG_TABLE].rows.itervalues()
+            if ovs_rec.type == cfgdb.CHUNK_TYPE and
+            cfgdb.column_value(ovs_rec.name) in hashes]
+
+
+#------------------ get_config_journal() ----------------
+def get_config_journal(config, journal):
+    '''
+    Returns the changes of the journal (config columns of the journal
+    rows) of a config (see cfgdb.journal_changes()), or None if it has
+    none.
+    '''
+    journal = [entry for entry in journal if entry]
+    if not journal:
+        return None
+
+    try:
+        return cfgdb.journal_changes(config, journal) or None
+    except ValueError, e:
+        vlog.err("Ignoring the unreadable startup config journal: %s" % e)
+        return None
+
+
+#------------------ get_config_plan() ----------------
+def get_config_plan(idl_cfg, config, journal):
+    '''
+    Returns the row of the restore plan of a config, or None if it has
+    none that applies: the plan has to be for this config and for the
+    current schemas, and the config must not have a journal (not part
+    of the plan).
+    '''
+    if journal:
+        return None
+
+    try:
+        digest = cfgdb.get_config_digest(config)
+    except ValueError:
+        # Reported when the config is decoded
+        return None
+
+    if digest is None:
+        return None
+
+    try:
+        name = cfgdb.plan_name(cfgschema.schema_fingerprint(ovs_schema),
+                               digest)
+    except EnvironmentError, e:
+        vlog.warn("Not using the restore plan: %s" % e)
+        return None
+
+    for ovs_rec in idl_cfg.tables[cfgdb.CONFIG_TABLE].rows.itervalues():
+        if ovs_rec.type == cfgdb.PLAN_TYPE and \
+           cfgdb.column_value(ovs_rec.name) == name:
+            return ovs_rec
+
+    return None
+
+
+#------------------ config_fingerprint() ----------------
+def config_fingerprint(config, journal=None):
+    '''
+    Returns an id of a saved config (the config column) and its journal
+    changes: the digest in its header, or the hash of the column for
+    formats without one, and the hash of the journal.
+    '''
+    fingerprint = cfgdb.get_config_digest(config) or \
+        hashlib.sha256(config).hexdigest()
+    if journal:
+        fingerprint += ":" + hashlib.sha256(
+            cfgdb.serialize_config(journal)).hexdigest()
+    return fingerprint
 
 
 #------------------ check_for_startup_config() ----------------
-def check_for_startup_config(remote):
+def check_for_startup_config():
     '''
     Connect to the db server and specify the configdb database.
     Look for an entry with type=startup
@@ -165,29 +498,358 @@ def check_for_startup_config(remote):
     '''
 
     global saved_config
+    global saved_chunks
+    global saved_journal
+    global saved_plan
 
-    saved_config = None
+    start = ovs.timeval.msec()
 
-    schema_helper_cfg = ovs.db.idl.SchemaHelper(location=cfgdb_schema)
-    schema_helper_cfg.register_table("config")
+    saved_config = None
+    saved_chunks = None
+    saved_journal = None
+    saved_plan = None
 
-    idl_cfg = ovs.db.idl.Idl(remote, schema_helper_cfg)
+    idl_cfg = sessions.open_configdb()
 
-    # Take a pass at the db to get any config data
-    # Note: idl.run() function returns true when seqno changes
-    cnt = max_miliseconds_to_wait_for_config_data
-    while not idl_cfg.run() and cnt > 0:
-        cnt -= 1
-        sleep(.1)
+    # Block until the replica arrives or the deadline expires
+    wait_for_idl_change(idl_cfg, ovs.timeval.msec() + config_wait_msec)
 
     get_config(idl_cfg)
 
-    idl_cfg.close()
+    sessions.close_configdb()
+
+    if saved_config is not None:
+        chunks = saved_chunks or {}
+        boot_stats["config_bytes"] = len(saved_config) + \
+            sum(len(chunk) for chunk in chunks.itervalues())
+        boot_stats["config_chunks"] = len(chunks)
+        boot_stats["journal_changes"] = len(saved_journal or [])
+        boot_stats["restore_plan"] = saved_plan is not None
+    record_phase("startup_config_read", start)
 
     return
 
 
+#------------------ open_running_db() ----------------
+def open_running_db():
+    '''
+    Open the running db session (see BootSessions.open_running()) and
+    make it the idl of the boot steps. It only replicates the System
+    columns: the extended schema is loaded by the prefetch worker, off
+    the boot path, and widen_running_db() adds the config tables then.
+    '''
+
+    global idl
+
+    idl = sessions.open_running()
+
+
+#------------------ widen_running_db() ----------------
+def widen_running_db():
+    '''
+    Once the prefetch worker has loaded the extended schema, have the
+    running db session replicate the config tables the push needs
+    (unless pushing with --direct). A config with a restore plan is
+    pushed without them.
+    '''
+
+    global idl
+
+    extschema = prefetch_result.get("extschema")
+    if extschema is None or sessions.extschema is not None:
+        return
+
+    idl = sessions.open_running(extschema, replicate=not restore_direct,
+                                schema_json=prefetch_result.get("ovsschema"))
+
+
+#------------------ wake_main_loop() ----------------
+def wake_main_loop():
+    '''
+    Wake the main loop up from the prefetch worker (see prefetch_wakeup).
+    '''
+
+    try:
+        os.write(prefetch_wakeup[1], "x")
+    except OSError, e:
+        # Already pending
+        if e.errno != errno.EAGAIN:
+            raise
+
+
+#------------------ clear_wakeup() ----------------
+def clear_wakeup():
+    '''
+    Empty prefetch_wakeup, the main loop is awake.
+    '''
+
+    try:
+        os.read(prefetch_wakeup[0], 512)
+    except OSError, e:
+        # Nothing pending
+        if e.errno != errno.EAGAIN:
+            raise
+
+
 #####################  Utility Methods ######################
+#------------------ record_phase() ----------------
+def record_phase(name, start, **counters):
+    '''
+    Add a boot phase that started at start (ovs.timeval.msec()) and ends
+    now to boot_stats, along with any counters given. Can be called from
+    the prefetch thread.
+    '''
+
+    phase = {"name": name,
+             "start_msec": start - boot_start_msec,
+             "duration_msec": ovs.timeval.msec() - start}
+    phase.update(counters)
+    boot_stats["phases"].append(phase)
+
+
+#------------------ write_boot_stats() ----------------
+def write_boot_stats():
+    '''
+    Write boot_stats, as json, to boot_stats_file (if set).
+    '''
+
+    boot_stats["total_msec"] = ovs.timeval.msec() - boot_start_msec
+
+    if not boot_stats_file:
+        return
+
+    try:
+        with open(boot_stats_file, "w") as f:
+            json.dump(boot_stats, f, indent=4, sort_keys=True)
+    except IOError, e:
+        vlog.warn("Unable to write boot stats to %s: %s"
+                  % (boot_stats_file, e))
+
+
+#------------------ count_config_rows() ----------------
+def count_config_rows(data, idl_obj):
+    '''
+    Returns the number of rows per table in a decoded config (the
+    ops.dc.read() format), children included, using the tables of
+    idl_obj to tell child rows from references.
+    '''
+
+    counts = {}
+
+    def count_row(table_name, row_data):
+        counts[table_name] = counts.get(table_name, 0) + 1
+        table = idl_obj.tables[table_name]
+        for column_name, value in row_data.iteritems():
+            if not isinstance(value, dict):
+                continue
+            if column_name in idl_obj.tables:
+                # Children referring to their parent
+                count_rows(column_name, value)
+                continue
+            column = table.columns.get(column_name)
+            if column is None:
+                continue
+            if column.type.is_map():
+                base = column.type.value
+            else:
+                base = column.type.key
+            if base is not None and base.is_ref():
+                count_rows(base.ref_table_name, value)
+
+    def count_rows(table_name, rows):
+        # References are saved as indexes, children as dicts
+        for row_data in rows.itervalues():
+            if isinstance(row_data, dict):
+                count_row(table_name, row_data)
+
+    for table_name, value in data.iteritems():
+        if table_name not in idl_obj.tables:
+            continue
+        if idl_obj.tables[table_name].max_rows == 1:
+            count_row(table_name, value)
+        else:
+            count_rows(table_name, value)
+
+    return counts
+
+
+#------------------ wait_for_idl_change() ----------------
+def wait_for_idl_change(idl_obj, deadline=None):
+    '''
+    Run the idl until its change seqno moves, blocking on the poller
+    between passes instead of sleeping.
+
+    deadline is an absolute time in msec (ovs.timeval.msec()), or None to
+    wait forever. Returns True if the seqno moved, False on timeout.
+    '''
+
+    curr_seqno = idl_obj.change_seqno
+    while True:
+        idl_obj.run()
+        if curr_seqno != idl_obj.change_seqno:
+            return True
+        if deadline is not None and ovs.timeval.msec() >= deadline:
+            return False
+        poller = ovs.poller.Poller()
+        idl_obj.wait(poller)
+        if deadline is not None:
+            poller.timer_wait_until(deadline)
+        poller.block()
+
+
+#------------------ load_startup_config() ----------------
+def load_startup_config(result):
+    '''
+    Decode the saved config (result["config"], with result["chunks"]
+    for the chunked layout, and apply result["journal"]).
+
+    The decoded config is stored in result["data"] so this can run in a
+    worker thread. On failure result["error"] is set. The raw config is
+    removed from result once decoded. The ops.dc and cfgrestore imports
+    are done here too, off the main thread.
+
+    If there is a restore plan (result["plan"]) only the plan is decoded,
+    the config is decoded by push_config_to_db() if the plan can not be
+    run.
+    '''
+    cfgprofile.start("cfgd-prefetch", profile_dir, "decode")
+    try:
+        decode_startup_config(result)
+    finally:
+        cfgprofile.stop()
+
+
+def decode_startup_config(result):
+    '''
+    Run _load_startup_config(), turning any failure into result["error"]
+    so that push_config_to_db() always finds "data" or "error".
+    '''
+    try:
+        _load_startup_config(result)
+    except Exception, e:
+        vlog.exception("Unable to load the startup config")
+        result["error"] = "Unable to load the startup config: %s" % e
+
+
+def _load_startup_config(result):
+    import ops.dc
+    import cfgrestore
+
+    if "plan" in result:
+        start = ovs.timeval.msec()
+        try:
+            result["plan"] = cfgdb.decode_config(result["plan"])
+            result["db_name"] = ovs.json.from_file(ovs_schema)["name"]
+        except (ValueError, EnvironmentError, KeyError, TypeError), e:
+            vlog.warn("Ignoring the unreadable restore plan: %s" % e)
+            del result["plan"]
+            return
+        finally:
+            record_phase("plan_decode", start)
+
+        boot_stats["rows"] = len([row for row in result["plan"]["rows"]
+                                  if row["row"] is not None])
+        return
+
+    # Loaded here rather than before daemonize(), the main loop widens the
+    # running db session with them (see widen_running_db())
+    cfgprofile.phase("schema_parse")
+    start = ovs.timeval.msec()
+    result["ovsschema"] = cfgschema.load_ovsschema_json(ovs_schema)
+    result["extschema"] = cfgschema.load_extschema()
+    record_phase("schema_parse", start)
+    if prefetch_wakeup is not None:
+        wake_main_loop()
+
+    cfgprofile.phase("decode")
+    # Re-pushes of the resident mode come with the config decoded
+    if "config" in result:
+        start = ovs.timeval.msec()
+        try:
+            # Decode one table at a time so the decoded text is never
+            # held alongside the raw blob and the object tree.
+            result["data"] = dict(cfgdb.iter_config_tables(
+                result["config"], chunks=result.get("chunks")))
+            if result.get("journal"):
+                cfgdb.apply_config_changes(result["data"],
+                                           result["journal"])
+        except ValueError, e:
+            result["error"] = "Invalid json from configdb. Exception: %s" % e
+            return
+        finally:
+            del result["config"]
+            result.pop("chunks", None)
+            result.pop("journal", None)
+            record_phase("decode", start)
+
+    # Only the tables of the schema are looked at, the running db session
+    # may not have them yet. The schema is kept for write_direct() to read
+    # the db with too.
+    schema = cfgrestore.SchemaReplica(cfgschema.load_ovsschema(
+        schema_json=result["ovsschema"]))
+    table_rows = count_config_rows(result["data"], schema)
+    boot_stats["table_rows"] = table_rows
+    boot_stats["rows"] = sum(table_rows.itervalues())
+
+
+#------------------ prefetch_config() ----------------
+def prefetch_config():
+    '''
+    Start decoding the startup config (or its restore plan) in a worker
+    thread so that it overlaps with wait_for_hw_done() (during which the
+    running db session syncs). push_config_to_db() picks up the result.
+    '''
+
+    global saved_config
+    global saved_chunks
+    global saved_journal
+    global saved_plan
+    global prefetch_thread
+    global prefetch_result
+    global prefetch_wakeup
+    global startup_data
+    global startup_fingerprint
+
+    prefetch_thread = None
+    prefetch_result = {}
+
+    if saved_config is not None:
+        if resident:
+            startup_data = None
+            startup_fingerprint = config_fingerprint(saved_config,
+                                                     saved_journal)
+
+        # Hand the raw config over to the worker so it can be freed as
+        # soon as it has been decoded.
+        prefetch_result["config"] = saved_config
+        prefetch_result["chunks"] = saved_chunks
+        prefetch_result["journal"] = saved_journal
+        saved_config = None
+        saved_chunks = None
+        saved_journal = None
+    elif startup_data is not None:
+        prefetch_result["data"] = startup_data
+    else:
+        return True
+
+    if saved_plan is not None:
+        prefetch_result["plan"] = saved_plan
+        saved_plan = None
+
+    if prefetch_wakeup is None:
+        prefetch_wakeup = os.pipe()
+        for fd in prefetch_wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+    prefetch_thread = threading.Thread(target=load_startup_config,
+                                       name="cfgd-prefetch",
+                                       args=(prefetch_result,))
+    prefetch_thread.daemon = True
+    prefetch_thread.start()
+
+    return True
+
+
 #------------------ push_config_to_db() ----------------
 def push_config_to_db():
     '''
@@ -195,45 +857,121 @@ def push_config_to_db():
     push it to the database.
     '''
 
-    global saved_config
+    global startup_data
 
-    if saved_config is None:
+    if prefetch_thread is None:
         vlog.info('No saved configuration exists')
-    else:
-        # TODO: Change this log msg to the actual push code when available
-        vlog.info('Config data found')
-        try:
-            data = json.loads(base64.b64decode(saved_config))
-        except ValueError, e:
-            print("Invalid json from configdb. Exception: %s\n" % e)
-            return
+        return True
+
+    # TODO: Change this log msg to the actual push code when available
+    vlog.info('Config data found')
 
-        extschema = restparser.parseSchema(settings.get('ext_schema'))
-        ovsschema = settings.get('ovs_schema')
-        ovsremote = settings.get('ovs_remote')
+    cfgprofile.phase("prefetch_join")
+    start = ovs.timeval.msec()
+    prefetch_thread.join()
+    record_phase("prefetch_join", start)
 
-        # initialize idl
-        opsidl = ops.dc.register(extschema, ovsschema, ovsremote)
-        curr_seqno = opsidl.change_seqno
+    if "error" in prefetch_result:
+        vlog.err(prefetch_result["error"])
+        return True
+
+    import cfgrestore
+
+    plan = prefetch_result.pop("plan", None)
+    if plan is not None:
+        cfgprofile.phase("write_plan")
+        start = ovs.timeval.msec()
+        result = cfgrestore.execute_plan(plan, prefetch_result.pop("db_name"),
+                                         sessions.remote)
+        record_phase("write_plan", start, result=result)
+        if result == ovs.db.idl.Transaction.SUCCESS:
+            return True
+        vlog.warn("Restore plan not run, pushing the startup config")
+
+    if "data" not in prefetch_result or sessions.extschema is None:
+        # Left for a restore plan that could not be used
+        load_pushed_config()
+        if "error" in prefetch_result:
+            vlog.err(prefetch_result["error"])
+            return True
+
+    data = prefetch_result["data"]
+    extschema = sessions.extschema
+    opsidl = idl
+
+    cfgprofile.phase("write_running")
+
+    import ops.dc
+
+    if restore_direct:
+        # Read, diffed and written with raw transactions, the session
+        # only has the System columns
+        start = ovs.timeval.msec()
+        result = cfgrestore.write_direct(
+            data, extschema, prefetch_result.get("ovsschema", ovs_schema),
+            sessions.remote)
+        record_phase("write_direct", start, result=result)
+    else:
+        # The running db session was synced during the h/w wait; pick up
+        # whatever changed since then (e.g. rows added by the platform
+        # daemons) before writing.
         while True:
             opsidl.run()
-            if curr_seqno != opsidl.change_seqno:
+            start = ovs.timeval.msec()
+            if restore_batch_size > 0:
+                # Writes and commits are interleaved, time them as one phase
+                result = cfgrestore.write_batched(data, extschema, opsidl,
+                                                  restore_batch_size)
+                record_phase("write_batched", start, result=result)
+            else:
+                txn = ovs.db.idl.Transaction(opsidl)
+                result = ops.dc.write(data, extschema, opsidl, txn)
+                record_phase("write", start)
+                if result == ovs.db.idl.Transaction.INCOMPLETE:
+                    start = ovs.timeval.msec()
+                    result = txn.commit_block()
+                    record_phase("commit", start, result=result)
+            if result != ovs.db.idl.Transaction.TRY_AGAIN:
                 break
-            poller = ovs.poller.Poller()
-            opsidl.wait(poller)
-            poller.block()
+            wait_for_idl_change(opsidl)
 
-        txn = ovs.db.idl.Transaction(opsidl)
-        result = ops.dc.write(data, extschema, opsidl, txn)
-        if result == ovs.db.idl.Transaction.INCOMPLETE:
-            result = txn.commit_block()
+    # Keep the decoded config for the re-pushes
+    if resident:
+        startup_data = data
 
-        if result not in [ovs.db.idl.Transaction.SUCCESS, ovs.db.idl.Transaction.UNCHANGED]:
-            return False
+    # On failure the dispatcher runs this step again once the db changes,
+    # with the same session and decoded config, so neither is released
+    # here.
+    if result not in [ovs.db.idl.Transaction.SUCCESS, ovs.db.idl.Transaction.UNCHANGED]:
+        return False
 
     return True
 
 
+#------------------ load_pushed_config() ----------------
+def load_pushed_config():
+    '''
+    When the restore plan of the startup config could not be used, or
+    the main loop did not widen the running db session yet: decode the
+    config (loading the schemas), which prefetch_config() left for the
+    plan, and have the running db session replicate the config tables
+    (unless pushing with --direct).
+    '''
+
+    global idl
+
+    if "data" not in prefetch_result:
+        cfgprofile.phase("decode")
+        decode_startup_config(prefetch_result)
+        if "error" in prefetch_result:
+            return
+
+    if sessions.extschema is None:
+        widen_running_db()
+        if not restore_direct:
+            wait_for_idl_change(idl)
+
+
 #------------------ mark_completion() ----------------
 def mark_completion():
     '''
@@ -255,6 +993,11 @@ def mark_completion():
     if txn.commit_block() != ovs.db.idl.Transaction.SUCCESS:
         return False
 
+    # Resident cfgd does not terminate (wait_for_reset() replaces
+    # terminate()), the stats of each push are written here
+    if resident:
+        write_boot_stats()
+
     return True
 
 
@@ -283,31 +1026,73 @@ def init_dispatcher():
     #   True if the function has completed its job, or
     #   False if it needs to run again
 
+    dispatch_list.append(prefetch_config)
     dispatch_list.append(wait_for_hw_done)
     dispatch_list.append(push_config_to_db)
     dispatch_list.append(mark_completion)
-    dispatch_list.append(terminate)
+    if resident:
+        dispatch_list.append(wait_for_reset)
+    else:
+        dispatch_list.append(terminate)
 
     loop_seq_no = 0
 
 
+def goto_step(func):
+    '''
+    Make func the next function the dispatcher calls. Returns True, for
+    the calling function to return.
+    '''
+
+    global loop_seq_no
+    global step_start_msec
+
+    if step_start_msec is not None:
+        record_phase(dispatch_list[loop_seq_no].__name__, step_start_msec,
+                     passes=step_passes)
+        step_start_msec = None
+    loop_seq_no = dispatch_list.index(func)
+    return True
+
+
 def dispatcher():
     '''
     Call next funtion in the list
     If it returns true, increment the loop counter
     If run out of functions, terminate
+
+    Returns True if the dispatcher made progress (so the main loop should
+    not block before calling it again), False if the current function is
+    waiting for a db change.
     '''
 
     global dispatch_list
     global loop_seq_no
     global exiting
+    global step_start_msec
+    global step_passes
 
     if loop_seq_no < len(dispatch_list):
-        rc = dispatch_list[loop_seq_no]()
+        step = dispatch_list[loop_seq_no]
+        if step_start_msec is None:
+            cfgprofile.phase(step.__name__)
+            step_start_msec = ovs.timeval.msec()
+            step_passes = 0
+        step_passes += 1
+
+        seq_no = loop_seq_no
+        rc = step()
+        if loop_seq_no != seq_no:
+            # The function moved the dispatcher (see goto_step())
+            return True
         if rc:
+            record_phase(step.__name__, step_start_msec, passes=step_passes)
+            step_start_msec = None
             loop_seq_no += 1
+        return bool(rc)
     else:
         exiting = True
+        return True
 
 
 ###############################  main  ###########################
@@ -319,22 +1104,67 @@ def main():
     create IDL session to configdb
     if row with type=startup exists, save off the config data
     close configdb IDL session
+    create the IDL session to the running db (with the tables of
+        the extended schema if there is a config to push)
 
     start main loop and call functions to...
+        start decoding the startup config in the background
         wait for h/w initialization to complete
         if default config (see above), push the config to the db.
         mark configuration completion in the db.
-        terminate
+        terminate (with --resident, watch the db instead and go
+            through the sequence again if it gets reset)
     '''
 
     global exiting
     global idl
     global loop_seq_no
+    global config_wait_msec
+    global poll_timeout_msec
+    global restore_batch_size
+    global restore_direct
+    global boot_stats_file
+    global profile_dir
+    global resident
+    global sessions
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--database', metavar="DATABASE",
                         help="A socket on which ovsdb-server is listening.",
                         dest='database')
+    parser.add_argument('--config-wait', metavar="MSEC", type=int,
+                        default=config_wait_msec,
+                        help="Max time to wait for the configdb to sync.",
+                        dest='config_wait')
+    parser.add_argument('--poll-timeout', metavar="MSEC", type=int,
+                        default=poll_timeout_msec,
+                        help="Max time to block between dispatcher passes "
+                             "when no db event arrives.",
+                        dest='poll_timeout')
+    parser.add_argument('--batch-size', metavar="ROWS", type=int,
+                        default=restore_batch_size,
+                        help="Push the startup config in transactions of at "
+                             "most ROWS rows (0 = single transaction).",
+                        dest='batch_size')
+    parser.add_argument('--direct', action='store_true',
+                        help="Push the startup config with raw db "
+                             "transactions, without replicating the config "
+                             "tables (--batch-size is ignored).",
+                        dest='direct')
+    parser.add_argument('--boot-stats-file', metavar="FILE",
+                        default=boot_stats_file,
+                        help="Write the boot phase timings to FILE when done "
+                             "(empty = don't write them).",
+                        dest='boot_stats_file')
+    parser.add_argument('--profile-dir', metavar="DIR",
+                        default=profile_dir,
+                        help="Write cProfile and memory profiles of each "
+                             "boot phase to DIR.",
+                        dest='profile_dir')
+    parser.add_argument('--resident', action='store_true',
+                        help="Keep running after the boot and push the "
+                             "startup config again if the db is reset.",
+                        dest='resident')
 
     ovs.vlog.add_args(parser)
     ovs.daemon.add_args(parser)
@@ -342,29 +1172,44 @@ def main():
     ovs.vlog.handle_args(args)
     ovs.daemon.handle_args(args)
 
+    config_wait_msec = args.config_wait
+    poll_timeout_msec = args.poll_timeout
+    restore_batch_size = args.batch_size
+    restore_direct = args.direct
+    boot_stats_file = args.boot_stats_file
+    # daemonize() changes to "/"
+    if args.profile_dir:
+        profile_dir = os.path.abspath(args.profile_dir)
+    resident = args.resident
+
+    boot_stats["date"] = cfgdb.current_date()
+
     if args.database is None:
         remote = def_db
     else:
         remote = args.database
 
-    # Locate default config if it exists
-    check_for_startup_config(remote)
+    sessions = BootSessions(remote)
 
-    schema_helper = ovs.db.idl.SchemaHelper(location=ovs_schema)
-    schema_helper.register_columns("System",
-                                   ["cur_hw", "cur_cfg", "next_cfg"])
+    # Locate default config if it exists
+    check_for_startup_config()
 
-    idl = ovs.db.idl.Idl(remote, schema_helper)
+    # One running db session for all the steps
+    open_running_db()
 
     ovs.daemon.daemonize()
 
+    # Profiled from here, in the daemon process. The steps run before
+    # daemonize() are timed in boot_stats.
+    cfgprofile.start("cfgd", profile_dir, "unixctl_setup")
+
     ovs.unixctl.command_register("exit", "", 0, 0, unixctl_exit, None)
+    ovs.unixctl.command_register("cfgd/boot-stats", "", 0, 0,
+                                 unixctl_boot_stats, None)
     error, unixctl_server = ovs.unixctl.server.UnixctlServer.create(None)
     if error:
         ovs.util.ovs_fatal(error, "could not create unixctl server", vlog)
 
-    seqno = idl.change_seqno    # Sequence number when we last processed the db
-
     init_dispatcher()
 
     while not exiting:
@@ -374,27 +1219,31 @@ def main():
             break
 
         # Take a pass at the db to see if anything has come in
-        idl.run()
-
-        # Keeping this here for later when we don't terminate.
-        '''
-        # OPS_TODO: when we want to keep cfgd running, add code
-        # ...to know when the dispatcher is through and then start
-        # ...using this code to block on a db change.
-        if seqno == idl.change_seqno:
-            poller = ovs.poller.Poller()
-            unixctl_server.wait(poller)
-            idl.wait(poller)
-            poller.block()
-        '''
+        sessions.run()
+        if prefetch_wakeup is not None:
+            clear_wakeup()
 
         # Call next method in the sequence
-        dispatcher()
-
-        seqno = idl.change_seqno
+        if dispatcher() or exiting:
+            continue
+
+        # The current step is waiting on the db. Block until the idl or
+        # unixctl server has something for us (or the deadline expires)
+        # so the step re-runs as soon as the change seqno moves.
+        poller = ovs.poller.Poller()
+        unixctl_server.wait(poller)
+        sessions.wait(poller)
+        if prefetch_wakeup is not None:
+            poller.fd_wait(prefetch_wakeup[0], ovs.poller.POLLIN)
+        if poll_timeout_msec is not None:
+            poller.timer_wait(poll_timeout_msec)
+        poller.block()
 
     unixctl_server.close()
-    idl.close()
+    sessions.close()
+
+    cfgprofile.stop()
+    write_boot_stats()
 
     return
 
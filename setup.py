@@ -18,8 +18,11 @@ from setuptools import setup
 setup(
     name='ops_cfgd',
     version='1.0',
-    py_modules=['ops_cfgd','cfgdbutil','cfgdb'],
+    py_modules=['ops_cfgd','cfgdbutil','cfgdb','cfgschema',
+                'cfgrestore','cfgdbd','cfgprofile','cfgautosave',
+                'cfgsnapshot'],
     entry_points={
-        'console_scripts': ['ops_cfgd = ops_cfgd:main','cfgdbutil = cfgdbutil:main']
+        'console_scripts': ['ops_cfgd = ops_cfgd:main','cfgdbutil = cfgdbutil:main',
+                            'ops_cfgdbd = cfgdbd:main']
     }
 )